@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Archivo local de los DTE: objetos guardados por su SHA-256 e indice SQLite por UUID
+"""
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+
+from diario import ruta_xml_diario
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ARCHIVO_FEL_DIR = os.path.join(SCRIPT_DIR, 'archivo_fel')
+
+# Archivo local de cada DTE (seccion "archivo" de config.json): XML enviado, respuesta de INFILE,
+# XML certificado y PDF se guardan en ARCHIVO_FEL_DIR/objetos por su SHA-256 (el mismo contenido
+# se guarda una sola vez) y ARCHIVO_FEL_DIR/indice.db los ubica por UUID, serie/numero, cliente y fecha
+OPCIONES_ARCHIVO = {
+    'habilitado': True
+}
+
+# Huellas (SHA-256 de 32 bytes) que guarda cada documento del archivo y extension al extraerlas
+OBJETOS_ARCHIVO = {
+    'xml': '.xml',
+    'respuesta': '.respuesta.json',
+    'xml_certificado': '.certificado.xml',
+    'pdf': '.pdf',
+    'xml_anulacion': '.anulacion.xml',
+    'respuesta_anulacion': '.anulacion.json',
+}
+
+# Tamano de los bloques en que se leen los objetos para verificar su huella
+TAMANO_BLOQUE_LECTURA = 64 * 1024
+
+_archivo_lock = threading.Lock()
+
+def archivo_habilitado(config):
+    opciones = dict(OPCIONES_ARCHIVO)
+    opciones.update(config.get('archivo', {}))
+    return bool(opciones['habilitado'])
+
+def conectar_archivo():
+    """Abre el indice del archivo de DTE (SQLite), creando la carpeta y la tabla si no existen.
+
+    La tabla no tiene rowid (la clave es el UUID) y las huellas se guardan en
+    binario, asi el indice de varios anos de documentos sigue siendo chico.
+    """
+    os.makedirs(ARCHIVO_FEL_DIR, exist_ok=True)
+    conexion = sqlite3.connect(os.path.join(ARCHIVO_FEL_DIR, 'indice.db'), timeout=30)
+    conexion.row_factory = sqlite3.Row
+    conexion.executescript("""
+        CREATE TABLE IF NOT EXISTS documentos (
+            uuid TEXT PRIMARY KEY,
+            serie TEXT,
+            numero TEXT,
+            invoice_id TEXT,
+            invoice_number TEXT,
+            customer_id TEXT,
+            customer_name TEXT,
+            nit_receptor TEXT,
+            fecha TEXT,
+            estado TEXT,
+            xml BLOB,
+            respuesta BLOB,
+            xml_certificado BLOB,
+            pdf BLOB,
+            xml_anulacion BLOB,
+            respuesta_anulacion BLOB
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_documentos_serie ON documentos (serie, numero);
+        CREATE INDEX IF NOT EXISTS idx_documentos_cliente ON documentos (customer_id, fecha);
+        CREATE INDEX IF NOT EXISTS idx_documentos_fecha ON documentos (fecha);
+        CREATE INDEX IF NOT EXISTS idx_documentos_factura ON documentos (invoice_id);
+    """)
+    return conexion
+
+def ruta_objeto(huella):
+    """Ruta del objeto con esa huella (bytes del SHA-256): objetos/ab/abcdef..."""
+    nombre = huella.hex()
+    return os.path.join(ARCHIVO_FEL_DIR, 'objetos', nombre[:2], nombre)
+
+def guardar_objeto(contenido):
+    """Guarda bytes en el archivo y devuelve su huella; si ya estaban, no se vuelven a escribir"""
+    huella = hashlib.sha256(contenido).digest()
+    ruta = ruta_objeto(huella)
+    if not os.path.exists(ruta):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        with open(temporal, 'wb') as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    return huella
+
+def copiar_a_archivo(bloques, al_terminar):
+    """Devuelve los mismos bloques y los va guardando en el archivo.
+
+    Solo si se recorren completos el objeto queda guardado y se llama a
+    al_terminar(huella); una copia interrumpida se descarta.
+    """
+    directorio = os.path.join(ARCHIVO_FEL_DIR, 'objetos')
+    os.makedirs(directorio, exist_ok=True)
+    temporal = os.path.join(directorio, f"{uuid.uuid4().hex}.tmp")
+    resumen = hashlib.sha256()
+    try:
+        with open(temporal, 'wb') as f:
+            for bloque in bloques:
+                resumen.update(bloque)
+                f.write(bloque)
+                yield bloque
+        huella = resumen.digest()
+        os.makedirs(os.path.dirname(ruta_objeto(huella)), exist_ok=True)
+        os.replace(temporal, ruta_objeto(huella))
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    al_terminar(huella)
+
+def archivar_xml_diario(huella):
+    """Copia a los objetos del archivo el XML del diario con esa huella y la devuelve"""
+    ruta = ruta_objeto(huella)
+    if not os.path.exists(ruta):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(ruta_xml_diario(huella), temporal)
+        os.replace(temporal, ruta)
+    return huella
+
+def abrir_objeto(huella):
+    """Abre en binario el objeto con esa huella, o None si no esta en el archivo"""
+    if not huella:
+        return None
+    try:
+        return open(ruta_objeto(huella), 'rb')
+    except FileNotFoundError:
+        return None
+
+def archivar_documento(uuid_fel, **campos):
+    """Agrega o completa un documento del indice del archivo; los campos en None no cambian"""
+    columnas = ['uuid'] + list(campos)
+    asignaciones = ', '.join(f"{columna} = COALESCE(excluded.{columna}, {columna})" for columna in campos)
+    with _archivo_lock:
+        conexion = conectar_archivo()
+        try:
+            with conexion:
+                conexion.execute(
+                    f"INSERT INTO documentos ({', '.join(columnas)}) VALUES ({', '.join('?' for _ in columnas)}) "
+                    f"ON CONFLICT (uuid) DO UPDATE SET {asignaciones}",
+                    [uuid_fel] + list(campos.values())
+                )
+        finally:
+            conexion.close()
+
+def documento_archivo(uuid_fel):
+    """Documento del archivo con ese UUID (dict con las huellas en bytes), o None"""
+    with _archivo_lock:
+        conexion = conectar_archivo()
+        try:
+            fila = conexion.execute("SELECT * FROM documentos WHERE uuid = ?", (uuid_fel,)).fetchone()
+        finally:
+            conexion.close()
+    return dict(fila) if fila else None
+
+def buscar_archivo(uuid_fel=None, serie=None, numero=None, cliente=None, desde=None, hasta=None):
+    """Documentos del archivo que cumplen todos los filtros dados, del mas antiguo al mas nuevo.
+
+    cliente es el customer_id o parte del nombre; desde y hasta son fechas AAAA-MM-DD (incluidas).
+    """
+    condiciones, parametros = [], []
+    for columna, valor in (('uuid', uuid_fel), ('serie', serie), ('numero', numero)):
+        if valor:
+            condiciones.append(f"{columna} = ?")
+            parametros.append(valor)
+    if cliente:
+        condiciones.append("(customer_id = ? OR customer_name LIKE ?)")
+        parametros += [cliente, f"%{cliente}%"]
+    if desde:
+        condiciones.append("fecha >= ?")
+        parametros.append(desde)
+    if hasta:
+        # La fecha de INFILE lleva hora: todo el dia 'hasta' queda antes de 'hasta~'
+        condiciones.append("fecha < ?")
+        parametros.append(f"{hasta}~")
+    donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    with _archivo_lock:
+        conexion = conectar_archivo()
+        try:
+            filas = conexion.execute(f"SELECT * FROM documentos {donde} ORDER BY fecha, serie, numero", parametros).fetchall()
+        finally:
+            conexion.close()
+    return [dict(fila) for fila in filas]
+
+def archivar_certificacion(config, factura, receptor, huella_xml, resultado_cert):
+    """Guarda en el archivo el XML enviado (huella_xml, del diario), la respuesta de INFILE y el XML certificado de un DTE.
+
+    Un error del archivo solo se avisa: el DTE ya esta certificado en SAT.
+    """
+    if not archivo_habilitado(config):
+        return
+    respuesta = {clave: valor for clave, valor in resultado_cert.items() if clave != 'xml_certificado'}
+    try:
+        xml_certificado = resultado_cert.get('xml_certificado')
+        archivar_documento(
+            resultado_cert.get('uuid', ''),
+            serie=resultado_cert.get('serie', ''),
+            numero=resultado_cert.get('numero', ''),
+            invoice_id=factura.invoice_id,
+            invoice_number=factura.invoice_number,
+            customer_id=factura.customer_id,
+            customer_name=factura.customer_name,
+            nit_receptor=receptor['id_receptor'],
+            fecha=resultado_cert.get('fecha', ''),
+            estado='Vigente',
+            xml=archivar_xml_diario(huella_xml),
+            respuesta=guardar_objeto(json.dumps(respuesta, ensure_ascii=False, sort_keys=True).encode('utf-8')),
+            xml_certificado=guardar_objeto(base64.b64decode(xml_certificado)) if xml_certificado else None
+        )
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"   AVISO: No se pudo guardar el DTE en el archivo local: {e}")
+
+def archivar_anulacion(config, uuid_fel, huella_xml, resultado):
+    """Guarda en el archivo el XML (huella_xml, del diario) y la respuesta de la anulacion, y marca el DTE como Anulado"""
+    if not archivo_habilitado(config) or not uuid_fel:
+        return
+    try:
+        archivar_documento(
+            uuid_fel,
+            estado='Anulado',
+            xml_anulacion=archivar_xml_diario(huella_xml),
+            respuesta_anulacion=guardar_objeto(json.dumps(resultado, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        )
+    except (OSError, sqlite3.Error) as e:
+        print(f"   AVISO: No se pudo guardar la anulacion en el archivo local: {e}")
+
+def archivar_pdf(uuid_fel, huella):
+    try:
+        archivar_documento(uuid_fel, pdf=huella)
+    except sqlite3.Error as e:
+        print(f"   AVISO: No se pudo registrar el PDF en el archivo local: {e}")
+
+def abrir_pdf_archivado(config, uuid_fel):
+    """Abre el PDF del DTE guardado en el archivo, o None si no esta (o el archivo esta deshabilitado)"""
+    if not uuid_fel or not archivo_habilitado(config):
+        return None
+    try:
+        documento = documento_archivo(uuid_fel)
+    except sqlite3.Error:
+        return None
+    return abrir_objeto(documento['pdf']) if documento else None
+
+def dte_certificados_archivo():
+    """DTE del archivo por factura ({invoice_id: {'invoice_number', 'uuid'}}) y los UUID que el archivo tiene como anulados"""
+    with _archivo_lock:
+        conexion = conectar_archivo()
+        try:
+            filas = conexion.execute(
+                "SELECT uuid, invoice_id, invoice_number, estado FROM documentos WHERE invoice_id IS NOT NULL ORDER BY fecha"
+            ).fetchall()
+        finally:
+            conexion.close()
+    certificados = {fila['invoice_id']: {'invoice_number': fila['invoice_number'], 'uuid': fila['uuid']} for fila in filas}
+    return certificados, {fila['uuid'] for fila in filas if fila['estado'] == 'Anulado'}
+
+def verificar_documento_archivo(documento):
+    """Lista los objetos del documento que faltan o no coinciden con su huella"""
+    problemas = []
+    for objeto in OBJETOS_ARCHIVO:
+        huella = documento[objeto]
+        if not huella:
+            continue
+        archivo = abrir_objeto(huella)
+        if archivo is None:
+            problemas.append(f"{objeto}: no esta en el archivo")
+            continue
+        resumen = hashlib.sha256()
+        with archivo:
+            for bloque in iter(lambda: archivo.read(TAMANO_BLOQUE_LECTURA), b''):
+                resumen.update(bloque)
+        if resumen.digest() != huella:
+            problemas.append(f"{objeto}: el contenido no coincide con la huella")
+    return problemas
+
+def extraer_documento_archivo(documento, carpeta):
+    """Copia los objetos del documento a carpeta como SERIE-NUMERO_UUID.<extension>; devuelve las rutas"""
+    os.makedirs(carpeta, exist_ok=True)
+    base = f"{documento['serie']}-{documento['numero']}_{documento['uuid']}"
+    rutas = []
+    for objeto, extension in OBJETOS_ARCHIVO.items():
+        origen = ruta_objeto(documento[objeto]) if documento[objeto] else None
+        if origen and os.path.exists(origen):
+            destino = os.path.join(carpeta, base + extension)
+            shutil.copyfile(origen, destino)
+            rutas.append(destino)
+    return rutas
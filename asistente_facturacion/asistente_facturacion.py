@@ -2,360 +2,1403 @@
 """
 Asistente de Facturacion ADSTTER
 Certifica facturas de Zoho Books con INFILE (FEL Guatemala)
+
+Uso:
+    python asistente_facturacion.py                          (menu interactivo)
+    python asistente_facturacion.py certify --all-drafts
+    python asistente_facturacion.py certify --ids ID [ID ...]
+    python asistente_facturacion.py certify --resume
+    python asistente_facturacion.py void --uuids UUID [UUID ...] --yes
+    python asistente_facturacion.py void --resume --yes
+    python asistente_facturacion.py outbox [--procesar] [--reintentar-fallidas]
+    python asistente_facturacion.py archive [--uuid UUID] [--cliente ID] [--desde FECHA] [--extraer CARPETA]
+
+En modo sin consola los resultados salen en JSONL (o JSON con --formato json)
+por stdout y el avance por stderr. Codigo de salida: 0 ok, 1 con fallidas, 2 error.
+Con --traza RUTA (o traza.habilitada en config.json) se guardan los tiempos de
+cada etapa en JSONL y se muestra un resumen al final.
 """
 
+import argparse
+import csv
+import functools
 import json
 import requests
 import os
 import sys
 import tempfile
+import io
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import dataclass
 from datetime import datetime
+from decimal import Decimal
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
 import uuid
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 
+from archivo_dte import (
+    OBJETOS_ARCHIVO, abrir_pdf_archivado, archivar_anulacion, archivar_certificacion, archivar_pdf,
+    archivo_habilitado, buscar_archivo, copiar_a_archivo, dte_certificados_archivo,
+    extraer_documento_archivo, verificar_documento_archivo
+)
+from bandeja import (
+    TrabajadoresBandeja, encolar_pdf_y_email, imprimir_resumen_bandeja, listar_tareas_bandeja,
+    mostrar_bandeja, recuperar_tareas_interrumpidas, reintentar_fallidas_bandeja, resumen_bandeja
+)
+from consola import capturar_salida, escribir_consola, instalar_salida_por_hilo
+from diario import (
+    ETAPAS_FINALES_DIARIO, descartar_xml_diario, dte_certificados_diario, estado_diario, guardar_xml_diario,
+    identificador_estable, pendientes_diario, registrar_etapa, ruta_xml_diario
+)
+from indice_fel import (
+    OPCIONES_SINCRONIZACION, RECURSOS_SINCRONIZACION, descartar_copia_local, fel_zoho_guardados,
+    guardar_fel_zoho, guardar_nit_verificado, guardar_sincronizacion, guardar_uuids_verificados,
+    indice_completo, listar_certificadas_indice, listar_copia_local, marca_sincronizacion,
+    marcar_anulada_indice, marcar_indice_completo, nit_verificado, quitar_borradores_ausentes,
+    registrar_detalle_indice, registrar_factura_indice, sincronizacion_habilitada, uuids_verificados
+)
+from traza import configurar_traza, imprimir_resumen_tramos, medir, tramo
+from webhook import OPCIONES_WEBHOOK, ServicioWebhook
+
 # Configuracion de consola para Windows
 if sys.platform == 'win32':
     os.system('chcp 65001 >nul 2>&1')
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, 'config.json')
+TOKEN_FILE = os.path.join(SCRIPT_DIR, 'token_zoho.json')
+
+# Segundos antes del vencimiento en que se renueva el access token de Zoho
+MARGEN_RENOVACION_TOKEN = 300
+
+# Limites de concurrencia por defecto (se pueden cambiar en la seccion "concurrencia" de config.json)
+# "facturas" es cuantas facturas se procesan a la vez; 1 = modo secuencial original
+# "anulaciones" es lo mismo para la anulacion en lote; una misma factura nunca se anula en dos hilos a la vez
+LIMITES_CONCURRENCIA = {
+    'facturas': 1,
+    'anulaciones': 4,
+    'zoho': 4,
+    'infile': 2,
+    'reportes': 2
+}
+
+_semaforos_servicio = {}
+
+# Parametros del cliente HTTP compartido (seccion "http" de config.json)
+# Se mantiene una sesion con keep-alive por host para reutilizar conexiones TCP/TLS
+OPCIONES_HTTP = {
+    'pool_conexiones': 4,
+    'pool_maximo': 10,
+    'timeout': 30
+}
+
+# Cache de contactos por customer_id (seccion "cache_contactos" de config.json)
+OPCIONES_CACHE_CONTACTOS = {
+    'ttl_segundos': 900,
+    'max_contactos': 500
+}
+
+# Precarga del detalle y el contacto de las siguientes facturas del lote (seccion "precarga" de config.json)
+# profundidad = cuantas facturas por delante del procesamiento se cargan en segundo plano; 0 = sin precarga
+OPCIONES_PRECARGA = {
+    'profundidad': 2
+}
+
+# Zoho Books devuelve como maximo 200 registros por pagina
+MAX_POR_PAGINA_ZOHO = 200
+
+# Tamano de los bloques al pasar el PDF de INFILE al adjunto de Zoho
+TAMANO_BLOQUE_PDF = 64 * 1024
+
+# Tamano aproximado de los bloques de bytes que entrega escribir_xml_factura
+TAMANO_BLOQUE_XML = 64 * 1024
+
+# Limite de peticiones a la API de Zoho Books (seccion "limite_zoho" de config.json)
+# Zoho permite 100 peticiones por minuto por organizacion; el limite diario depende del plan
+# (0 = no se lleva la cuenta local). "organizaciones" admite valores propios por organization_id
+OPCIONES_LIMITE_ZOHO = {
+    'por_minuto': 100,
+    'rafaga': 10,
+    'por_dia': 0,
+    'reintentos_429': 3,
+    'espera_maxima_429': 120,
+    'organizaciones': {}
+}
+
+# Conciliacion Zoho vs INFILE/SAT (seccion "reconciliacion" de config.json)
+# Un UUID anulado en SAT no cambia mas y queda verificado para siempre; uno vigente se vuelve
+# a consultar pasadas vigencia_verificacion_horas. La consulta es GET a infile.url_consulta con el
+# UUID en el parametro consulta_parametro_uuid; de la respuesta JSON se leen los campos consulta_campo_*
+# y el estado se compara (sin tildes ni mayusculas) con consulta_estados_vigente / consulta_estados_anulado.
+# Una respuesta que no trae esos campos o un estado que no esta en las listas queda como desconocida
+OPCIONES_RECONCILIACION = {
+    'hilos': 8,
+    'vigencia_verificacion_horas': 24,
+    'consulta_parametro_uuid': 'uuid',
+    'consulta_campo_resultado': 'resultado',
+    'consulta_campo_estado': 'estado',
+    'consulta_campo_serie': 'serie',
+    'consulta_campo_numero': 'numero',
+    'consulta_estados_vigente': ['vigente', 'valido', 'certificado', 'certificada'],
+    'consulta_estados_anulado': ['anulado', 'anulada']
+}
+
+# Verificacion del NIT del receptor en SAT con la consulta de receptores de INFILE
+# (seccion "verificacion_nit" de config.json; la URL va en infile.url_consulta_nit).
+# Cada NIT registrado se consulta como maximo una vez cada vigencia_horas y uno que SAT no
+# reconoce, una vez cada vigencia_negativa_horas (se corrige en SAT o en Zoho); el resultado
+# queda en el indice local. Los errores del servicio o de credenciales no se guardan
+OPCIONES_VERIFICACION_NIT = {
+    'habilitada': True,
+    'vigencia_horas': 168,
+    'vigencia_negativa_horas': 1
+}
+URL_CONSULTA_NIT = 'https://consultareceptores.feel.com.gt/rest/action'
+
+# Mensajes de la consulta de NIT que significan que SAT no tiene el NIT (sin tildes, en minusculas);
+# cualquier otro mensaje sin nombre es un error del servicio o de credenciales
+MENSAJES_NIT_INEXISTENTE = ('no valido', 'invalido', 'no existe', 'no encontrado', 'no registrado')
+
+_opciones_http = dict(OPCIONES_HTTP)
+_sesiones_http = {}
+_sesiones_lock = threading.Lock()
+_opciones_limite_zoho = dict(OPCIONES_LIMITE_ZOHO)
+_limitadores_zoho = {}
+_limitadores_lock = threading.Lock()
+_nits_en_curso = {}
+_nits_lock = threading.Lock()
+
+class CacheContactos:
+    """Cache en memoria de contactos de Zoho por customer_id, con TTL y limite LRU.
+
+    Si varios hilos piden el mismo contacto que no esta en cache, solo uno
+    lo descarga y los demas esperan ese mismo resultado.
+    """
+
+    def __init__(self, ttl_segundos, max_contactos):
+        self.ttl_segundos = ttl_segundos
+        self.max_contactos = max_contactos
+        self.entradas = OrderedDict()
+        self.en_curso = {}
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, contact_id, cargar):
+        """Devuelve el contacto desde cache o lo carga con cargar(contact_id)"""
+        with self.lock:
+            entrada = self.entradas.get(contact_id)
+            if entrada is not None and entrada[0] > time.monotonic():
+                self.entradas.move_to_end(contact_id)
+                self.aciertos += 1
+                return entrada[1]
+            futuro = self.en_curso.get(contact_id)
+            descargar = futuro is None
+            if descargar:
+                futuro = Future()
+                self.en_curso[contact_id] = futuro
+                self.fallos += 1
+            else:
+                self.aciertos += 1
+
+        if not descargar:
+            return futuro.result()
+
+        try:
+            contacto = cargar(contact_id)
+        except BaseException as e:
+            with self.lock:
+                del self.en_curso[contact_id]
+            futuro.set_exception(e)
+            raise
+
+        with self.lock:
+            # Los errores (None) no se guardan para reintentar en la siguiente factura
+            if contacto is not None:
+                self.entradas[contact_id] = (time.monotonic() + self.ttl_segundos, contacto)
+                self.entradas.move_to_end(contact_id)
+                while len(self.entradas) > self.max_contactos:
+                    self.entradas.popitem(last=False)
+            del self.en_curso[contact_id]
+        futuro.set_result(contacto)
+        return contacto
+
+    def descartar(self, contact_id):
+        """Quita un contacto de la cache (cambio en Zoho) para que la proxima consulta lo descargue"""
+        with self.lock:
+            self.entradas.pop(contact_id, None)
+
+    def estadisticas(self):
+        """Devuelve los contadores de aciertos y fallos (consultas a Zoho)"""
+        with self.lock:
+            return {'aciertos': self.aciertos, 'fallos': self.fallos}
+
+_cache_contactos = CacheContactos(OPCIONES_CACHE_CONTACTOS['ttl_segundos'], OPCIONES_CACHE_CONTACTOS['max_contactos'])
+
+class LimitadorZoho:
+    """Cubeta de fichas compartida por todas las llamadas a Zoho de una organizacion.
+
+    Cada peticion toma una ficha; las fichas se reponen a por_minuto/60 por
+    segundo hasta 'rafaga'. Un 429 pausa la cubeta hasta el Retry-After y
+    baja la tasa a la mitad; cada respuesta correcta la recupera de a poco
+    hasta la configurada.
+    """
+
+    def __init__(self, por_minuto, rafaga, por_dia=0, espera_maxima_429=120):
+        self.tasa_maxima = max(float(por_minuto), 1.0) / 60
+        self.tasa = self.tasa_maxima
+        self.capacidad = max(1, int(rafaga))
+        self.fichas = float(self.capacidad)
+        self.ultima = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.por_dia = int(por_dia or 0)
+        self.espera_maxima_429 = float(espera_maxima_429)
+        self.dia = datetime.now().date()
+        self.usadas_dia = 0
+        self.peticiones = 0
+        self.respuestas_429 = 0
+        self.espera_total = 0.0
+        self.limite_servidor = None
+        self.restante_servidor = None
+        self.lock = threading.Lock()
+
+    def tomar(self):
+        """Espera hasta que haya una ficha y la consume; devuelve los segundos esperados"""
+        esperado = 0.0
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                self.fichas = min(self.capacidad, self.fichas + (ahora - self.ultima) * self.tasa)
+                self.ultima = ahora
+                espera = self.pausa_hasta - ahora
+                if espera <= 0:
+                    if self.fichas >= 1:
+                        self.fichas -= 1
+                        self.peticiones += 1
+                        self.espera_total += esperado
+                        hoy = datetime.now().date()
+                        if hoy != self.dia:
+                            self.dia, self.usadas_dia = hoy, 0
+                        self.usadas_dia += 1
+                        return esperado
+                    espera = (1 - self.fichas) / self.tasa
+            time.sleep(espera)
+            esperado += espera
+
+    def registrar(self, response):
+        """Ajusta la tasa segun la respuesta: 429 pausa y la reduce, el resto la recupera"""
+        with self.lock:
+            limite = response.headers.get('X-Rate-Limit-Limit')
+            restante = response.headers.get('X-Rate-Limit-Remaining')
+            if restante is not None and restante.strip().isdigit():
+                self.restante_servidor = int(restante)
+                if limite is not None and limite.strip().isdigit():
+                    self.limite_servidor = int(limite)
+            if response.status_code == 429:
+                self.respuestas_429 += 1
+                self.tasa = max(self.tasa_maxima / 10, self.tasa / 2)
+                espera = segundos_retry_after(response.headers.get('Retry-After'))
+                if espera is None:
+                    espera = 1 / self.tasa
+                espera = min(espera, self.espera_maxima_429)
+                self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + espera)
+                self.fichas = 0.0
+            elif self.tasa < self.tasa_maxima:
+                self.tasa = min(self.tasa_maxima, self.tasa + self.tasa_maxima / 20)
+
+    def estadisticas(self):
+        """Contadores de peticiones, 429 y espera, mas la cuota restante conocida"""
+        with self.lock:
+            restante = None
+            if self.por_dia:
+                restante = max(0, self.por_dia - self.usadas_dia)
+            if self.restante_servidor is not None:
+                restante = self.restante_servidor if restante is None else min(restante, self.restante_servidor)
+            return {
+                'peticiones': self.peticiones,
+                'respuestas_429': self.respuestas_429,
+                'espera_total': self.espera_total,
+                'por_minuto': self.tasa * 60,
+                'por_minuto_maximo': self.tasa_maxima * 60,
+                'restante': restante,
+                'limite': self.limite_servidor or self.por_dia or None
+            }
+
+def segundos_retry_after(valor):
+    """Segundos indicados en un header Retry-After (numero o fecha HTTP); None si no se entiende"""
+    if not valor:
+        return None
+    valor = valor.strip()
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        fecha = parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, fecha.timestamp() - time.time())
+
 
-def cargar_config():
-    """Carga la configuracion desde el archivo JSON"""
-    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+def cargar_config(ruta=None):
+    """Carga la configuracion desde el archivo JSON (por defecto config.json junto al script)"""
+    with open(ruta or CONFIG_FILE, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def obtener_access_token(config):
-    """Obtiene un nuevo access token usando el refresh token"""
-    url = "https://accounts.zoho.com/oauth/v2/token"
+def configurar_concurrencia(config):
+    """Crea los semaforos por servicio segun la seccion 'concurrencia' del config"""
+    limites = dict(LIMITES_CONCURRENCIA)
+    limites.update(config.get('concurrencia', {}))
+    for servicio in ('zoho', 'infile', 'reportes'):
+        _semaforos_servicio[servicio] = threading.BoundedSemaphore(max(1, int(limites[servicio])))
+    return limites
+
+@contextmanager
+def limite_servicio(servicio):
+    """Limita las llamadas simultaneas a un servicio (zoho, infile, reportes)"""
+    semaforo = _semaforos_servicio.get(servicio)
+    if semaforo is None:
+        yield
+        return
+    with semaforo:
+        yield
+
+def configurar_http(config):
+    """Aplica la seccion 'http' del config y descarta las sesiones creadas con la configuracion anterior"""
+    opciones = dict(OPCIONES_HTTP)
+    opciones.update(config.get('http', {}))
+    with _sesiones_lock:
+        _opciones_http.update(opciones)
+        for sesion in _sesiones_http.values():
+            sesion.close()
+        _sesiones_http.clear()
+    return opciones
+
+def obtener_sesion(url):
+    """Devuelve la sesion HTTP (pool de conexiones con keep-alive) del host de la URL"""
+    partes = urlsplit(url)
+    host = f"{partes.scheme}://{partes.netloc}"
+    with _sesiones_lock:
+        sesion = _sesiones_http.get(host)
+        if sesion is None:
+            sesion = requests.Session()
+            adaptador = HTTPAdapter(
+                pool_connections=int(_opciones_http['pool_conexiones']),
+                pool_maxsize=int(_opciones_http['pool_maximo'])
+            )
+            sesion.mount('http://', adaptador)
+            sesion.mount('https://', adaptador)
+            _sesiones_http[host] = sesion
+    return sesion
+
+def solicitud_http(servicio, metodo, url, **kwargs):
+    """Hace una peticion por la sesion compartida del host, con timeout por defecto y limite del servicio"""
+    kwargs.setdefault('timeout', _opciones_http['timeout'])
+    with limite_servicio(servicio), tramo(f"http_{servicio}"):
+        return obtener_sesion(url).request(metodo, url, **kwargs)
+
+def configurar_limite_zoho(config):
+    """Aplica la seccion 'limite_zoho' del config y descarta los limitadores anteriores"""
+    opciones = dict(OPCIONES_LIMITE_ZOHO)
+    opciones.update(config.get('limite_zoho', {}))
+    with _limitadores_lock:
+        _opciones_limite_zoho.clear()
+        _opciones_limite_zoho.update(opciones)
+        _limitadores_zoho.clear()
+    return opciones
+
+def limitador_zoho(config):
+    """Devuelve el limitador de la organizacion del config (uno por organization_id)"""
+    organizacion = str(config['zoho']['organization_id'])
+    with _limitadores_lock:
+        limitador = _limitadores_zoho.get(organizacion)
+        if limitador is None:
+            opciones = dict(_opciones_limite_zoho)
+            opciones.update(opciones.get('organizaciones', {}).get(organizacion, {}))
+            limitador = LimitadorZoho(opciones['por_minuto'], opciones['rafaga'],
+                                      opciones['por_dia'], opciones['espera_maxima_429'])
+            _limitadores_zoho[organizacion] = limitador
+    return limitador
+
+def estadisticas_cuota_zoho():
+    """Devuelve {organization_id: estadisticas del limitador}"""
+    with _limitadores_lock:
+        limitadores = dict(_limitadores_zoho)
+    return {organizacion: limitador.estadisticas() for organizacion, limitador in limitadores.items()}
+
+def imprimir_cuota_zoho(inicio):
+    """Imprime las peticiones a Zoho, los 429 y la cuota restante desde el snapshot 'inicio'"""
+    for organizacion, actual in estadisticas_cuota_zoho().items():
+        anterior = inicio.get(organizacion, {})
+        peticiones = actual['peticiones'] - anterior.get('peticiones', 0)
+        respuestas_429 = actual['respuestas_429'] - anterior.get('respuestas_429', 0)
+        espera = actual['espera_total'] - anterior.get('espera_total', 0.0)
+        linea = (f"Cuota Zoho: {peticiones} peticion(es), {respuestas_429} respuesta(s) 429, "
+                 f"{espera:.1f}s de espera por limite, tasa {actual['por_minuto']:.0f}/{actual['por_minuto_maximo']:.0f} por minuto")
+        if actual['restante'] is not None:
+            linea += f", cuota restante: {actual['restante']}"
+            if actual['limite']:
+                linea += f" de {actual['limite']}"
+        print(linea)
+
+def solicitud_zoho(config, access_token, metodo, ruta, params=None, **kwargs):
+    """Peticion a la API de Zoho Books: agrega autenticacion y organization_id.
+
+    ruta es relativa a /books/v3 (ej: 'invoices/123/status/sent').
+    access_token puede ser el token (str) o un GestorToken; con un GestorToken,
+    una respuesta 401 renueva el token y repite la peticion una vez.
+    Cada peticion pasa por el limitador de la organizacion y un 429 se repite
+    (hasta reintentos_429 veces) despues del Retry-After. Un cuerpo en
+    streaming (generador) no se repite.
+    """
+    url = f"{config['zoho']['api_domain']}/books/v3/{ruta}"
+    gestor = access_token if isinstance(access_token, GestorToken) else None
+    token = gestor.obtener() if gestor else access_token
+    headers = {}
+    if 'files' not in kwargs:
+        headers["Content-Type"] = "application/json"
+    headers.update(kwargs.pop('headers', {}))
+    parametros = {"organization_id": config['zoho']['organization_id']}
+    parametros.update(params or {})
+    limitador = limitador_zoho(config)
+    # Un cuerpo en streaming (generador) ya se consumio y no se puede repetir
+    repetible = not hasattr(kwargs.get('data'), '__next__')
+    renovado = False
+    reintentos_429 = int(_opciones_limite_zoho['reintentos_429'])
+
+    while True:
+        headers["Authorization"] = f"Zoho-oauthtoken {token}"
+        limitador.tomar()
+        response = solicitud_http('zoho', metodo, url, headers=headers, params=parametros, **kwargs)
+        limitador.registrar(response)
+        if not repetible:
+            return response
+        if response.status_code == 401 and gestor and not renovado:
+            renovado = True
+            nuevo_token = gestor.renovar(rechazado=token)
+            if not nuevo_token or nuevo_token == token:
+                return response
+            token = nuevo_token
+        elif response.status_code == 429 and reintentos_429 > 0:
+            # La espera del Retry-After la hace el limitador antes de la siguiente ficha
+            reintentos_429 -= 1
+        else:
+            return response
+        # Los archivos adjuntos ya se leyeron en el intento anterior
+        for archivo in kwargs.get('files', {}).values():
+            if hasattr(archivo[1], 'seek'):
+                archivo[1].seek(0)
+
+def configurar_cache_contactos(config):
+    """Reemplaza la cache de contactos segun la seccion 'cache_contactos' del config"""
+    global _cache_contactos
+    opciones = dict(OPCIONES_CACHE_CONTACTOS)
+    opciones.update(config.get('cache_contactos', {}))
+    _cache_contactos = CacheContactos(float(opciones['ttl_segundos']), int(opciones['max_contactos']))
+    return opciones
+
+def imprimir_estadisticas_cache(inicio):
+    """Imprime los aciertos de la cache de contactos desde el snapshot 'inicio'"""
+    actual = _cache_contactos.estadisticas()
+    aciertos = actual['aciertos'] - inicio['aciertos']
+    fallos = actual['fallos'] - inicio['fallos']
+    print(f"Cache de contactos: {aciertos} acierto(s), {fallos} fallo(s) -> {aciertos} consulta(s) a Zoho ahorrada(s)")
+
+def ejecutar_lote(funcion, elementos, hilos, al_fallar, al_completar=None):
+    """Ejecuta funcion(elemento) para cada elemento con hasta 'hilos' en paralelo.
+
+    Cada elemento conserva el orden de sus pasos. La salida de cada uno se
+    guarda aparte y se imprime en el orden original de la seleccion.
+    Si un elemento lanza una excepcion, su resultado es al_fallar(elemento, error).
+    al_completar(elemento, resultado), si se indica, se llama en ese mismo orden
+    a medida que cada elemento termina.
+    Devuelve la lista de resultados en ese mismo orden.
+    """
+    if hilos <= 1 or len(elementos) <= 1:
+        resultados = []
+        for elemento in elementos:
+            try:
+                resultado = funcion(elemento)
+            except Exception as e:
+                print(f"   ERROR INESPERADO: {e}")
+                resultado = al_fallar(elemento, e)
+            if al_completar:
+                al_completar(elemento, resultado)
+            resultados.append(resultado)
+        return resultados
+
+    def ejecutar_capturando(elemento):
+        with capturar_salida(io.StringIO()) as buffer:
+            try:
+                resultado = funcion(elemento)
+            except Exception as e:
+                print(f"   ERROR INESPERADO: {e}")
+                resultado = al_fallar(elemento, e)
+        return resultado, buffer.getvalue()
+
+    resultados = []
+    with ThreadPoolExecutor(max_workers=hilos) as executor:
+        futuros = [executor.submit(ejecutar_capturando, elemento) for elemento in elementos]
+        for futuro in futuros:
+            elemento, (resultado, texto) = elementos[len(resultados)], futuro.result()
+            escribir_consola(texto)
+            if al_completar:
+                al_completar(elemento, resultado)
+            resultados.append(resultado)
+    return resultados
+
+@medir('token')
+def solicitar_access_token(config):
+    """Pide un access token a Zoho. Devuelve (token, segundos_de_validez) o (None, 0)"""
+    url = f"{config['zoho'].get('accounts_url', 'https://accounts.zoho.com')}/oauth/v2/token"
     data = {
         "refresh_token": config['zoho']['refresh_token'],
         "client_id": config['zoho']['client_id'],
         "client_secret": config['zoho']['client_secret'],
         "grant_type": "refresh_token"
     }
-    response = requests.post(url, data=data)
-    if response.status_code == 200:
-        return response.json().get('access_token')
+    response = solicitud_http('zoho', 'POST', url, data=data)
+    if response.status_code == 200 and response.json().get('access_token'):
+        datos = response.json()
+        return datos['access_token'], int(datos.get('expires_in', 3600))
     else:
         print(f"Error al obtener token: {response.text}")
-        return None
-
-def obtener_facturas_borrador(config, access_token):
-    """Obtiene las facturas en estado borrador de Zoho Books"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {
-        "organization_id": org_id,
-        "status": "draft"
-    }
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code == 200:
-        return response.json().get('invoices', [])
-    else:
-        print(f"Error al obtener facturas: {response.text}")
-        return []
-
+        return None, 0
+
+class GestorToken:
+    """Access token de Zoho guardado junto a config.json y renovado antes de vencer.
+
+    Se pasa a las funciones en lugar del token (parametro access_token);
+    solicitud_zoho lo usa para obtener el token vigente y renovarlo ante un 401.
+    """
+
+    def __init__(self, config, archivo=None, margen_segundos=MARGEN_RENOVACION_TOKEN):
+        self.config = config
+        self.archivo = archivo or TOKEN_FILE
+        self.margen_segundos = margen_segundos
+        self.lock = threading.Lock()
+        self.token = None
+        self.expira = 0.0
+        self.cargar()
+
+    def cargar(self):
+        """Lee el token guardado si pertenece al mismo client_id de Zoho"""
+        try:
+            with open(self.archivo, 'r', encoding='utf-8') as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            return
+        if datos.get('client_id') == self.config['zoho']['client_id']:
+            self.token = datos.get('access_token')
+            self.expira = float(datos.get('expira', 0))
+
+    def guardar(self):
+        """Escribe el token y su vencimiento (epoch) de forma atomica"""
+        temporal = self.archivo + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump({
+                'client_id': self.config['zoho']['client_id'],
+                'access_token': self.token,
+                'expira': self.expira
+            }, f)
+        if sys.platform != 'win32':
+            os.chmod(temporal, 0o600)
+        os.replace(temporal, self.archivo)
+
+    def vigente(self):
+        return bool(self.token) and time.time() < self.expira - self.margen_segundos
+
+    def obtener(self):
+        """Devuelve un token vigente, renovandolo si hace falta"""
+        with self.lock:
+            if self.vigente():
+                return self.token
+        return self.renovar()
+
+    def renovar(self, rechazado=None):
+        """Pide un token nuevo a Zoho.
+
+        Si se indica el token rechazado y otro hilo ya lo renovo, devuelve el nuevo sin pedir otro.
+        """
+        with self.lock:
+            if self.vigente() and (rechazado is None or self.token != rechazado):
+                return self.token
+            token, segundos = solicitar_access_token(self.config)
+            if token:
+                self.token = token
+                self.expira = time.time() + segundos
+                try:
+                    self.guardar()
+                except OSError as e:
+                    print(f"   [DEBUG] No se pudo guardar el token: {e}")
+            return self.token if token else None
+
+    def iniciar_renovacion_automatica(self):
+        """Lanza un hilo de fondo que renueva el token antes de que venza"""
+        def renovar_periodicamente():
+            while True:
+                with self.lock:
+                    espera = self.expira - self.margen_segundos - time.time()
+                if espera > 0:
+                    time.sleep(min(espera, 60))
+                    continue
+                with capturar_salida(io.StringIO()):
+                    try:
+                        renovado = self.renovar()
+                    except requests.RequestException:
+                        renovado = None
+                if not renovado:
+                    time.sleep(30)
+
+        hilo = threading.Thread(target=renovar_periodicamente, name='renovar-token', daemon=True)
+        hilo.start()
+        return hilo
+
+def paginar_zoho(config, access_token, ruta, clave, params=None, por_pagina=None, estricto=False):
+    """Generador de los registros 'clave' de un listado de Zoho (ruta), pagina por pagina.
+
+    Mientras se procesa una pagina, la siguiente ya se esta descargando en segundo plano.
+    por_pagina se toma de zoho.por_pagina en config.json (maximo 200).
+    Si una pagina falla se imprime el error y se termina; con estricto=True se lanza HTTPError.
+    """
+    if por_pagina is None:
+        por_pagina = config['zoho'].get('por_pagina', MAX_POR_PAGINA_ZOHO)
+    por_pagina = max(1, min(int(por_pagina), MAX_POR_PAGINA_ZOHO))
+
+    def pedir_pagina(pagina):
+        parametros = dict(params or {})
+        parametros.update({"page": pagina, "per_page": por_pagina})
+        response = solicitud_zoho(config, access_token, 'GET', ruta, params=parametros)
+        if response.status_code != 200:
+            nombre = {'invoices': 'facturas', 'contacts': 'contactos'}.get(ruta, ruta)
+            if estricto:
+                raise requests.HTTPError(f"Error al obtener {nombre}: {response.status_code}", response=response)
+            print(f"Error al obtener {nombre}: {response.text}")
+            return [], False
+        datos = response.json()
+        hay_mas = datos.get('page_context', {}).get('has_more_page', False)
+        return datos.get(clave, []), hay_mas
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pagina = 1
+        futuro = executor.submit(pedir_pagina, pagina)
+        while futuro is not None:
+            registros, hay_mas = futuro.result()
+            pagina += 1
+            futuro = executor.submit(pedir_pagina, pagina) if hay_mas else None
+            yield from registros
+
+def paginar_facturas(config, access_token, status, por_pagina=None):
+    """Generador que devuelve las facturas de Zoho con el status indicado, pagina por pagina"""
+    return paginar_zoho(config, access_token, 'invoices', 'invoices', {"status": status}, por_pagina)
+
+def campos_por_etiqueta(custom_fields):
+    """Campos personalizados de Zoho como {label: value}; si una etiqueta se repite queda la primera"""
+    campos = {}
+    for cf in custom_fields or []:
+        campos.setdefault(cf.get('label', '') or '', cf.get('value', '') or '')
+    return campos
+
+@dataclass(frozen=True, slots=True)
+class LineItem:
+    """Linea de una factura de Zoho; precio es el rate de Zoho (SIN IVA)"""
+    nombre: str
+    descripcion: str
+    cantidad: float
+    precio: float
+    descuento: float
+
+    @classmethod
+    def desde_zoho(cls, item):
+        return cls(
+            item.get('name', '') or '',
+            item.get('description', '') or '',
+            float(item.get('quantity', 1)),
+            float(item.get('rate', 0)),
+            float(item.get('discount_amount', 0) or 0)
+        )
+
+    @property
+    def monto_gravable(self):
+        return (self.cantidad * self.precio) - self.descuento
+
+@dataclass(frozen=True, slots=True)
+class DatosCertificacion:
+    """Datos del DTE certificado (respuesta de INFILE o campos fel_* de la factura en Zoho)"""
+    uuid: str = ''
+    serie: str = ''
+    numero: str = ''
+    fecha: str = ''
+    estado: str = ''
+
+    @classmethod
+    def desde_infile(cls, resultado):
+        return cls(resultado.get('uuid', ''), resultado.get('serie', ''), resultado.get('numero', ''),
+                   resultado.get('fecha', ''), 'Certificada')
+
+    @classmethod
+    def desde_campos(cls, campos):
+        return cls(campos.get('fel_uuid', ''), campos.get('fel_serie', ''), campos.get('fel_numero', ''),
+                   campos.get('fel_fecha_certificacion', ''), campos.get('fel_estado', ''))
+
+@dataclass(frozen=True, slots=True)
+class Factura:
+    """Factura de Zoho con solo lo que usan el XML, las validaciones, el indice y la anulacion"""
+    invoice_id: str
+    invoice_number: str
+    status: str
+    customer_id: str
+    customer_name: str
+    currency_code: str
+    total: float
+    line_items: tuple
+    campos: dict
+
+    @classmethod
+    def desde_zoho(cls, detalle):
+        return cls(
+            detalle.get('invoice_id', ''),
+            detalle.get('invoice_number', '') or '',
+            detalle.get('status', '') or '',
+            detalle.get('customer_id', '') or '',
+            detalle.get('customer_name', '') or '',
+            detalle.get('currency_code', 'GTQ') or 'GTQ',
+            float(detalle.get('total', 0) or 0),
+            tuple(LineItem.desde_zoho(item) for item in detalle.get('line_items', []) or []),
+            campos_por_etiqueta(detalle.get('custom_fields'))
+        )
+
+    @property
+    def certificacion(self):
+        return DatosCertificacion.desde_campos(self.campos)
+
+# Campos de billing_address que usa el receptor del XML
+CAMPOS_DIRECCION = ('address', 'city', 'state', 'zip', 'country')
+
+@dataclass(frozen=True, slots=True)
+class Contacto:
+    """Contacto de Zoho: identificacion fiscal, email y direccion de facturacion"""
+    contact_id: str
+    contact_name: str
+    company_name: str
+    email: str
+    tax_number: str
+    last_modified_time: str
+    campos: dict
+    direccion: dict
+
+    @classmethod
+    def desde_zoho(cls, contacto):
+        direccion = contacto.get('billing_address', {}) or {}
+        return cls(
+            contacto.get('contact_id'),
+            contacto.get('contact_name', '') or '',
+            contacto.get('company_name', '') or '',
+            contacto.get('email', '') or '',
+            contacto.get('tax_number', '') or '',
+            contacto.get('last_modified_time'),
+            campos_por_etiqueta(contacto.get('custom_fields')),
+            {campo: direccion.get(campo, '') or '' for campo in CAMPOS_DIRECCION}
+        )
+
+# Cliente sin datos (contacto que Zoho no devolvio): se factura como Consumidor Final
+CONTACTO_VACIO = Contacto.desde_zoho({})
+
+@medir('detalle')
 def obtener_detalle_factura(config, access_token, invoice_id):
     """Obtiene el detalle completo de una factura"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
-    response = requests.get(url, headers=headers, params=params)
+    response = solicitud_zoho(config, access_token, 'GET', f"invoices/{invoice_id}")
     if response.status_code == 200:
         return response.json().get('invoice', {})
     else:
+        if response.status_code == 404:
+            # Borrada en Zoho: que no siga en los menus hasta la proxima sincronizacion completa
+            descartar_copia_local([invoice_id])
         print(f"Error al obtener detalle de factura: {response.text}")
         return None
 
+def obtener_factura(config, access_token, invoice_id):
+    """Detalle de la factura como Factura (None si Zoho no lo devolvio)"""
+    detalle = obtener_detalle_factura(config, access_token, invoice_id)
+    return Factura.desde_zoho(detalle) if detalle else None
+
+@medir('contacto')
 def obtener_contacto(config, access_token, contact_id):
-    """Obtiene los datos de un contacto"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/contacts/{contact_id}"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
-    response = requests.get(url, headers=headers, params=params)
+    """Obtiene el Contacto (usa la cache de contactos); None si Zoho no lo devolvio"""
+    return _cache_contactos.obtener(contact_id, lambda cid: descargar_contacto(config, access_token, cid))
+
+def descargar_contacto(config, access_token, contact_id):
+    """Descarga un contacto desde Zoho, sin cache"""
+    response = solicitud_zoho(config, access_token, 'GET', f"contacts/{contact_id}")
     if response.status_code == 200:
-        return response.json().get('contact', {})
+        return Contacto.desde_zoho(response.json().get('contact', {}))
     else:
         return None
 
-def generar_xml_factura(config, factura, contacto):
-    """Genera el XML FEL para certificacion en INFILE"""
+# Namespaces del DTE y del complemento de exportacion
+NS_DTE = "http://www.sat.gob.gt/dte/fel/0.2.0"
+NS_EXPORTACION = "http://www.sat.gob.gt/face2/ComplementoExportaciones/0.1.0"
+
+# Valores de pais que indican Guatemala o local (vacio = local)
+PAISES_LOCALES = frozenset(['guatemala', 'gt', 'gua', ''])
+
+# Codigos de pais ISO validos
+CODIGOS_PAIS_VALIDOS = frozenset(['AF', 'AL', 'DE', 'AD', 'AO', 'AI', 'AQ', 'AG', 'SA', 'DZ', 'AR', 'AM', 'AW', 'AU', 'AT', 'AZ', 'BS', 'BD', 'BB', 'BH', 'BE', 'BZ', 'BJ', 'BM', 'BY', 'BO', 'BA', 'BW', 'BR', 'BN', 'BG', 'BF', 'BI', 'BT', 'CV', 'KH', 'CM', 'CA', 'QA', 'TD', 'CL', 'CN', 'CY', 'CO', 'KM', 'KP', 'KR', 'CR', 'CI', 'HR', 'CU', 'CW', 'DK', 'DM', 'EC', 'EG', 'SV', 'AE', 'ER', 'SK', 'SI', 'ES', 'US', 'EE', 'ET', 'PH', 'FI', 'FJ', 'FR', 'GA', 'GM', 'GE', 'GH', 'GI', 'GD', 'GR', 'GL', 'GP', 'GU', 'GT', 'GF', 'GG', 'GN', 'GQ', 'GW', 'GY', 'HT', 'HN', 'HK', 'HU', 'IN', 'ID', 'IQ', 'IR', 'IE', 'IS', 'IL', 'IT', 'JM', 'JP', 'JE', 'JO', 'KZ', 'KE', 'KG', 'KI', 'KW', 'LA', 'LS', 'LV', 'LB', 'LR', 'LY', 'LI', 'LT', 'LU', 'MO', 'MK', 'MG', 'MY', 'MW', 'MV', 'ML', 'MT', 'MA', 'MQ', 'MU', 'MR', 'MX', 'FM', 'MD', 'MC', 'MN', 'ME', 'MS', 'MZ', 'MM', 'NA', 'NR', 'NP', 'NI', 'NE', 'NG', 'NO', 'NC', 'NZ', 'OM', 'NL', 'PK', 'PW', 'PS', 'PA', 'PG', 'PY', 'PE', 'PF', 'PL', 'PT', 'PR', 'GB', 'CF', 'CZ', 'CG', 'CD', 'DO', 'RE', 'RW', 'RO', 'RU', 'EH', 'WS', 'AS', 'BL', 'KN', 'SM', 'MF', 'PM', 'VC', 'SH', 'LC', 'ST', 'SN', 'RS', 'SC', 'SL', 'SG', 'SX', 'SY', 'SO', 'LK', 'SZ', 'ZA', 'SD', 'SS', 'SE', 'CH', 'SR', 'TH', 'TW', 'TZ', 'TJ', 'IO', 'TF', 'TL', 'TG', 'TK', 'TO', 'TT', 'TN', 'TM', 'TR', 'TV', 'UA', 'UG', 'UY', 'UZ', 'VU', 'VA', 'VE', 'VN', 'WF', 'YE', 'DJ', 'ZM', 'ZW'])
+
+# Nombres de pais frecuentes convertidos a codigo ISO
+PAISES_NOMBRE_A_CODIGO = {
+    'guatemala': 'GT', 'mexico': 'MX', 'estados unidos': 'US', 'usa': 'US', 'united states': 'US',
+    'el salvador': 'SV', 'honduras': 'HN', 'nicaragua': 'NI', 'costa rica': 'CR', 'panama': 'PA',
+    'colombia': 'CO', 'españa': 'ES', 'spain': 'ES', 'canada': 'CA', 'argentina': 'AR',
+    'chile': 'CL', 'peru': 'PE', 'brasil': 'BR', 'brazil': 'BR', 'ecuador': 'EC'
+}
+
+# Etiquetas de campos personalizados del contacto con el NIT y con el nombre a facturar
+ETIQUETAS_NIT = frozenset(['TAX ID', 'TAX NUMBER', 'NUMERO FISCAL', 'ID FISCAL', 'RFC', 'RUC', 'RUT', 'ID EMPRESA'])
+ETIQUETAS_NOMBRE_FISCAL = frozenset(['NOMBRE A FACTURAR', 'RAZON SOCIAL', 'NOMBRE FISCAL'])
+VALORES_CONSUMIDOR_FINAL = frozenset(['CF', 'C/F', 'CONSUMIDORFINAL', 'CONSUMIDOR FINAL', 'N/A'])
+
+# Limite para CF en Guatemala es Q2,500 (no aplica a exportaciones)
+LIMITE_CF_GTQ = 2500.00
+
+# Receptores ya resueltos por (contact_id, last_modified_time)
+MAX_RECEPTORES_MEMORIZADOS = 1000
+_receptores = OrderedDict()
+_receptores_lock = threading.Lock()
+
+def construir_receptor(contacto):
+    """Datos fiscales del cliente a partir del Contacto (ver resolver_receptor)"""
+
+    # NIT: SIEMPRE buscar primero en campos personalizados (tienen prioridad)
+    # Cualquier campo que contenga "NIT" o sea identificador fiscal; incluye
+    # "ID DE EMPRESA" que es donde Zoho guarda el NIT
+    nit, campo_nit = '', ''
+    nombre_fiscal = ''
+    for etiqueta_zoho, valor in contacto.campos.items():
+        label = etiqueta_zoho.upper()
+        etiqueta = label.strip()
+        if not nombre_fiscal and label in ETIQUETAS_NOMBRE_FISCAL:
+            nombre_fiscal = valor
+        if not campo_nit and ('NIT' in etiqueta or 'ID DE EMPRESA' in etiqueta or etiqueta in ETIQUETAS_NIT):
+            nit = str(valor)
+            if nit and nit.upper() not in ['N/A', 'CF', '']:
+                campo_nit = etiqueta_zoho
+
+    # Si no hay NIT en campos personalizados, usar tax_number como fallback
+    if not nit or nit.upper() in ['N/A', 'CF', '']:
+        nit = contacto.tax_number
+
+    # Limpiar NIT - solo numeros, letras y guion; vacio o consumidor final = CF
+    nit = ''.join(c for c in str(nit) if c.isalnum() or c == '-')
+    if not nit or nit.upper() in VALORES_CONSUMIDOR_FINAL:
+        nit = 'CF'
+    nit = nit.upper()
+
+    # Direccion y pais. Si el pais esta vacio, asumir que es LOCAL (Guatemala)
+    direccion = contacto.direccion
+    pais = direccion['country'].strip().lower()
+    es_exportacion = pais not in PAISES_LOCALES
+    direccion_xml = limpiar_xml(direccion['address']) or 'Ciudad'
+    municipio_xml = limpiar_xml(direccion['city']) or 'Guatemala'
+    departamento_xml = limpiar_xml(direccion['state']) or 'Guatemala'
+
+    # Si es nombre de pais, convertir a codigo; si no es un codigo valido, usar GT por defecto
+    codigo_pais = direccion['country'] or 'GT'
+    codigo_pais = PAISES_NOMBRE_A_CODIGO.get(codigo_pais.lower(), codigo_pais).upper()
+    pais_reconocido = codigo_pais in CODIGOS_PAIS_VALIDOS
+    if not pais_reconocido:
+        codigo_pais = 'GT'
+
+    nombre_visualizacion = contacto.contact_name
+    nombre = nombre_fiscal or contacto.contact_name or 'Consumidor Final'
+    return {
+        'nit': nit,
+        'campo_nit': campo_nit,
+        'es_consumidor_final': nit == 'CF',
+        # Para exportaciones, el ID del receptor debe ser "CF" segun normativa SAT
+        'id_receptor': 'CF' if es_exportacion else nit,
+        'nombre': nombre,
+        'nombre_xml': limpiar_xml(nombre) or 'Consumidor Final',
+        'nombre_visualizacion': nombre_visualizacion,
+        'razon_social': nombre_fiscal or contacto.company_name or nombre_visualizacion,
+        'email': contacto.email,
+        'pais': pais,
+        'es_exportacion': es_exportacion,
+        'codigo_pais': codigo_pais,
+        'pais_reconocido': pais_reconocido,
+        'direccion_xml': direccion_xml,
+        'codigo_postal': direccion['zip'] or '01001',
+        'municipio_xml': municipio_xml,
+        'departamento_xml': departamento_xml,
+        'etiquetas': list(contacto.campos)
+    }
+
+def resolver_receptor(contacto):
+    """Registro del receptor (NIT, nombre, pais, exportacion, direccion) del contacto.
+
+    Se calcula una vez por (contact_id, last_modified_time) y se comparte entre
+    el XML de certificacion, el de anulacion, la validacion de CF y el email.
+    El dict devuelto es compartido: no se debe modificar.
+    """
+    contacto = contacto or CONTACTO_VACIO
+    clave = (contacto.contact_id, contacto.last_modified_time)
+    if clave[0] is None:
+        return construir_receptor(contacto)
+    with _receptores_lock:
+        receptor = _receptores.get(clave)
+        if receptor is not None:
+            _receptores.move_to_end(clave)
+            return receptor
+    receptor = construir_receptor(contacto)
+    with _receptores_lock:
+        _receptores[clave] = receptor
+        while len(_receptores) > MAX_RECEPTORES_MEMORIZADOS:
+            _receptores.popitem(last=False)
+    return receptor
+
+# Campos del emisor que usa la plantilla del XML
+CAMPOS_EMISOR = ('nit', 'nombre', 'nombre_comercial', 'afiliacion_iva', 'codigo_establecimiento',
+                 'direccion', 'codigo_postal', 'municipio', 'departamento', 'pais')
+
+def digito_verificador_nit(cuerpo):
+    """Digito verificador (modulo 11) de un NIT guatemalteco sin el digito; 10 se escribe 'K'"""
+    suma = sum(int(digito) * (len(cuerpo) + 1 - i) for i, digito in enumerate(cuerpo))
+    digito = (11 - suma % 11) % 11
+    return 'K' if digito == 10 else str(digito)
+
+def nit_valido(nit):
+    """True si el NIT tiene formato (digitos, guion opcional, verificador 0-9 o K) y digito verificador correcto"""
+    nit = str(nit or '').replace('-', '').strip().upper()
+    if len(nit) < 2 or not nit[:-1].isdigit() or not (nit[-1].isdigit() or nit[-1] == 'K'):
+        return False
+    return digito_verificador_nit(nit[:-1]) == nit[-1]
+
+def validar_emisor(config):
+    """Errores de la seccion emisor/frases del config que harian rechazar cualquier DTE"""
+    emisor = config.get('emisor') or {}
+    errores = [f"Falta emisor.{campo} en config.json" for campo in CAMPOS_EMISOR if not str(emisor.get(campo, '')).strip()]
+    if emisor.get('nit') and not nit_valido(emisor['nit']):
+        errores.append(f"NIT del emisor invalido: {emisor['nit']}")
+    if not config.get('frases'):
+        errores.append("Faltan las frases del emisor en config.json")
+    return errores
+
+def impuesto_y_total_linea(monto_gravable, es_exportacion):
+    """(MontoImpuesto, Total) de una linea del XML FEL, como texto con 6 decimales"""
+    if es_exportacion:
+        return '0.000000', '%.6f' % monto_gravable
+    monto_impuesto = monto_gravable * 0.12
+    return '%.6f' % monto_impuesto, '%.6f' % (monto_gravable + monto_impuesto)
+
+def total_lineas_fel(factura, es_exportacion):
+    """GranTotal que tendra el XML: la misma suma de partes_xml_factura, en millonesimas enteras"""
+    total = 0
+    for item in factura.line_items:
+        total += int(impuesto_y_total_linea(item.monto_gravable, es_exportacion)[1].replace('.', ''))
+    return Decimal(total).scaleb(-6)
+
+def validar_factura_local(factura, contacto):
+    """Reglas que se pueden revisar sin llamar a INFILE; devuelve (errores, avisos).
+
+    Los errores harian que INFILE o SAT rechacen el DTE (o emitirlo con datos
+    equivocados); los avisos solo se informan.
+    """
+    errores, avisos = [], []
+    if not contacto:
+        return ["No se pudo obtener el cliente de Zoho"], avisos
+    receptor = resolver_receptor(contacto)
+    es_exportacion = receptor['es_exportacion']
+    moneda = factura.currency_code
+    total_zoho = factura.total
+
+    if receptor['es_consumidor_final'] and moneda == 'GTQ' and total_zoho > LIMITE_CF_GTQ and not es_exportacion:
+        errores.append(f"Consumidor Final excede limite de Q{LIMITE_CF_GTQ:,.2f} (total Q{total_zoho:,.2f}); configure el NIT en Zoho")
+    if not es_exportacion and not receptor['es_consumidor_final'] and not nit_valido(receptor['nit']):
+        errores.append(f"NIT del cliente invalido: {receptor['nit']}")
+    if es_exportacion and not receptor['pais_reconocido']:
+        errores.append(f"Pais del cliente sin codigo ISO: '{receptor['pais']}' (se enviaria como GT)")
+    if not receptor['email']:
+        avisos.append("El cliente no tiene email; no se enviara la factura")
+
+    lineas = factura.line_items
+    if not lineas:
+        errores.append("La factura no tiene lineas")
+    for i, item in enumerate(lineas, 1):
+        if item.cantidad <= 0:
+            errores.append(f"Linea {i}: cantidad {item.cantidad:g} no es positiva")
+        elif item.monto_gravable < 0:
+            errores.append(f"Linea {i}: el descuento supera el monto ({item.monto_gravable:,.2f})")
+    if lineas:
+        gran_total = total_lineas_fel(factura, es_exportacion)
+        if gran_total <= 0:
+            errores.append("El total de la factura debe ser mayor que cero")
+        elif abs(gran_total - Decimal(str(total_zoho))) > Decimal('0.01') * max(1, len(lineas)):
+            avisos.append(f"Total del DTE {gran_total:,.2f} no cuadra con el de Zoho {total_zoho:,.2f} {moneda}")
+    return errores, avisos
+
+def nombre_sat(nombre):
+    """Nombre de la consulta de NIT tal como va en el XML.
+
+    SAT devuelve a las personas como 'APELLIDO1,APELLIDO2,,NOMBRE1,NOMBRE2'; las
+    empresas traen su razon social, que puede llevar ', ' (', SOCIEDAD ANONIMA').
+    """
+    nombre = (nombre or '').strip()
+    if ', ' in nombre:
+        return nombre
+    return ' '.join(parte.strip() for parte in nombre.split(',') if parte.strip())
+
+@medir('infile_nit')
+def consultar_nit_infile(config, nit):
+    """Consulta el NIT en SAT por medio de INFILE: {'nit', 'nombre', 'encontrado'}.
+
+    Devuelve None si no hubo respuesta valida: error HTTP, o una respuesta sin
+    nombre cuyo mensaje no dice que el NIT no existe (credenciales, servicio caido).
+    """
+    infile = config['infile']
+    datos = {'emisor_codigo': infile['usuario_api'], 'emisor_clave': infile['llave_api'], 'nit_consulta': nit}
+    try:
+        response = solicitud_http('infile', 'POST', infile.get('url_consulta_nit', URL_CONSULTA_NIT), json=datos)
+    except requests.RequestException as e:
+        print(f"   [DEBUG] Error al consultar el NIT {nit}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"   [DEBUG] Error al consultar el NIT {nit}: {response.status_code}")
+        return None
+    try:
+        datos = response.json()
+    except ValueError:
+        print(f"   [DEBUG] Respuesta invalida al consultar el NIT {nit}: {response.text[:200]}")
+        return None
+    nombre = nombre_sat(datos.get('nombre', ''))
+    if nombre:
+        return {'nit': nit, 'nombre': nombre, 'encontrado': True}
+    mensaje = str(datos.get('mensaje', ''))
+    sin_tildes = unicodedata.normalize('NFKD', mensaje).encode('ascii', 'ignore').decode('ascii').lower()
+    if any(texto in sin_tildes for texto in MENSAJES_NIT_INEXISTENTE):
+        return {'nit': nit, 'nombre': '', 'encontrado': False}
+    print(f"   [DEBUG] La consulta del NIT {nit} no respondio: {mensaje or 'sin nombre ni mensaje'}")
+    return None
+
+def verificar_nit(config, nit):
+    """Resultado de la consulta del NIT en SAT ({'nit', 'nombre', 'encontrado'}), o None si no se pudo consultar.
+
+    Se guarda en el indice local y se reutiliza durante vigencia_horas (un NIT
+    que SAT no reconoce, solo vigencia_negativa_horas). Si varios hilos piden
+    el mismo NIT a la vez, solo uno consulta a INFILE.
+    """
+    nit = str(nit).replace('-', '').strip().upper()
+    opciones = dict(OPCIONES_VERIFICACION_NIT)
+    opciones.update(config.get('verificacion_nit', {}))
+    fila = nit_verificado(nit)
+    if fila:
+        vigencia = opciones['vigencia_horas'] if fila['encontrado'] else opciones['vigencia_negativa_horas']
+        if fila['verificado'] > time.time() - float(vigencia) * 3600:
+            return {'nit': nit, 'nombre': fila['nombre'], 'encontrado': bool(fila['encontrado'])}
+
+    with _nits_lock:
+        futuro = _nits_en_curso.get(nit)
+        consultar = futuro is None
+        if consultar:
+            futuro = _nits_en_curso[nit] = Future()
+    if not consultar:
+        return futuro.result()
+
+    try:
+        resultado = consultar_nit_infile(config, nit)
+        if resultado:
+            guardar_nit_verificado(nit, resultado['nombre'], resultado['encontrado'])
+    except BaseException as e:
+        with _nits_lock:
+            del _nits_en_curso[nit]
+        futuro.set_exception(e)
+        raise
+    with _nits_lock:
+        del _nits_en_curso[nit]
+    futuro.set_result(resultado)
+    return resultado
+
+def requiere_verificacion_nit(config, receptor):
+    """True si el NIT del receptor se verifica en SAT (ventas locales con NIT bien formado)"""
+    opciones = dict(OPCIONES_VERIFICACION_NIT)
+    opciones.update(config.get('verificacion_nit', {}))
+    return (bool(opciones['habilitada']) and not receptor['es_exportacion']
+            and not receptor['es_consumidor_final'] and nit_valido(receptor['nit']))
+
+def validar_nit_sat(config, contacto):
+    """Revision del NIT del cliente contra SAT para la prevalidacion; devuelve (errores, avisos)"""
+    receptor = resolver_receptor(contacto)
+    if not requiere_verificacion_nit(config, receptor):
+        return [], []
+    verificacion = verificar_nit(config, receptor['nit'])
+    if verificacion is None:
+        return [], [f"No se pudo verificar el NIT {receptor['nit']} en SAT"]
+    if not verificacion['encontrado']:
+        return [f"NIT del cliente no registrado en SAT: {receptor['nit']}"], []
+    if verificacion['nombre'].upper() != receptor['nombre'].strip().upper():
+        return [], [f"Se facturara a nombre de '{verificacion['nombre']}' (SAT); en Zoho: '{receptor['nombre']}'"]
+    return [], []
+
+# Plantillas del XML FEL. Las partes que no cambian entre facturas (emisor y frases)
+# se pre-renderizan una vez por configuracion en plantilla_emisor(); las que se
+# repiten por factura o por linea usan formato %, que es el mas rapido de Python
+_PLANTILLA_ENCABEZADO = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    f'<dte:GTDocumento xmlns:dte="{NS_DTE}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="0.1">\n'
+    '  <dte:SAT ClaseDocumento="dte">\n'
+    '    <dte:DTE ID="DatosCertificados">\n'
+    '      <dte:DatosEmision ID="DatosEmision">\n'
+    '        <dte:DatosGenerales CodigoMoneda="%s"%s FechaHoraEmision="%s" Tipo="%s"/>\n'
+)
+
+_PLANTILLA_EMISOR = (
+    '        <dte:Emisor AfiliacionIVA="{afiliacion_iva}" CodigoEstablecimiento="{codigo_establecimiento}" CorreoEmisor="" NITEmisor="{nit}" NombreComercial="{nombre_comercial}" NombreEmisor="{nombre}">\n'
+    '          <dte:DireccionEmisor>\n'
+    '            <dte:Direccion>{direccion}</dte:Direccion>\n'
+    '            <dte:CodigoPostal>{codigo_postal}</dte:CodigoPostal>\n'
+    '            <dte:Municipio>{municipio}</dte:Municipio>\n'
+    '            <dte:Departamento>{departamento}</dte:Departamento>\n'
+    '            <dte:Pais>{pais}</dte:Pais>\n'
+    '          </dte:DireccionEmisor>\n'
+    '        </dte:Emisor>\n'
+)
+
+_PLANTILLA_RECEPTOR = (
+    '        <dte:Receptor CorreoReceptor="%s" IDReceptor="%s" NombreReceptor="%s">\n'
+    '          <dte:DireccionReceptor>\n'
+    '            <dte:Direccion>%s</dte:Direccion>\n'
+    '            <dte:CodigoPostal>%s</dte:CodigoPostal>\n'
+    '            <dte:Municipio>%s</dte:Municipio>\n'
+    '            <dte:Departamento>%s</dte:Departamento>\n'
+    '            <dte:Pais>%s</dte:Pais>\n'
+    '          </dte:DireccionReceptor>\n'
+    '        </dte:Receptor>\n'
+)
+
+_PLANTILLA_FRASE = '          <dte:Frase CodigoEscenario="{codigo_escenario}" TipoFrase="{tipo_frase}"/>\n'
+
+# Para exportaciones: Frase tipo 4 (Exento o no afecto al IVA) es obligatoria
+_FRASES_EXPORTACION = (
+    '        <dte:Frases>\n'
+    '          <dte:Frase CodigoEscenario="1" TipoFrase="4"/>\n'
+    '        </dte:Frases>\n'
+)
+
+_PLANTILLA_ITEM = (
+    '          <dte:Item BienOServicio="S" NumeroLinea="%d">\n'
+    '            <dte:Cantidad>%.2f</dte:Cantidad>\n'
+    '            <dte:UnidadMedida>UND</dte:UnidadMedida>\n'
+    '            <dte:Descripcion>%s</dte:Descripcion>\n'
+    '            <dte:PrecioUnitario>%.6f</dte:PrecioUnitario>\n'
+    '            <dte:Precio>%.6f</dte:Precio>\n'
+    '            <dte:Descuento>%.6f</dte:Descuento>\n'
+    '            <dte:Impuestos>\n'
+    '              <dte:Impuesto>\n'
+    '                <dte:NombreCorto>IVA</dte:NombreCorto>\n'
+    '                <dte:CodigoUnidadGravable>%s</dte:CodigoUnidadGravable>\n'
+    '                <dte:MontoGravable>%.6f</dte:MontoGravable>\n'
+    '                <dte:MontoImpuesto>%s</dte:MontoImpuesto>\n'
+    '              </dte:Impuesto>\n'
+    '            </dte:Impuestos>\n'
+    '            <dte:Total>%s</dte:Total>\n'
+    '          </dte:Item>\n'
+)
+
+_PLANTILLA_TOTALES = (
+    '        </dte:Items>\n'
+    '        <dte:Totales>\n'
+    '          <dte:TotalImpuestos>\n'
+    '            <dte:TotalImpuesto NombreCorto="IVA" TotalMontoImpuesto="{total_iva:.6f}"/>\n'
+    '          </dte:TotalImpuestos>\n'
+    '          <dte:GranTotal>{gran_total:.6f}</dte:GranTotal>\n'
+    '        </dte:Totales>\n'
+)
+
+_PLANTILLA_COMPLEMENTO_EXPORTACION = (
+    '        <dte:Complementos>\n'
+    f'          <dte:Complemento IDComplemento="ID_EXPORTACION" NombreComplemento="Exportacion" URIComplemento="{NS_EXPORTACION}">\n'
+    f'            <cex:Exportacion xmlns:cex="{NS_EXPORTACION}" Version="1">\n'
+    '              <cex:NombreConsignatarioODestinatario>{nombre}</cex:NombreConsignatarioODestinatario>\n'
+    '              <cex:DireccionConsignatario>{direccion}</cex:DireccionConsignatario>\n'
+    '              <cex:NombreComprador>{nombre}</cex:NombreComprador>\n'
+    '              <cex:DireccionComprador>{direccion}</cex:DireccionComprador>\n'
+    '              <cex:CodigoComprador>CF</cex:CodigoComprador>\n'
+    '              <cex:NombreExportador>{nombre_exportador}</cex:NombreExportador>\n'
+    '              <cex:CodigoExportador>{codigo_exportador}</cex:CodigoExportador>\n'
+    '            </cex:Exportacion>\n'
+    '          </dte:Complemento>\n'
+    '        </dte:Complementos>\n'
+)
+
+_PLANTILLA_CIERRE = (
+    '      </dte:DatosEmision>\n'
+    '    </dte:DTE>\n'
+    '  </dte:SAT>\n'
+    '</dte:GTDocumento>'
+)
+
+# Ultima configuracion usada: (emisor, frases, bloques pre-renderizados)
+_plantilla_emisor_actual = (None, None, None)
+
+def limpiar_xml(texto):
+    """Escapa los caracteres especiales de XML y quita espacios al inicio y al final"""
+    if not texto:
+        return ''
+    # replace encadenado: en CPython es varias veces mas rapido que str.translate
+    # cuando los reemplazos tienen mas de un caracter
+    return str(texto).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;').strip()
+
+def plantilla_emisor(config):
+    """Devuelve (bloque_emisor, bloque_frases_locales) pre-renderizados para esta configuracion"""
+    global _plantilla_emisor_actual
     emisor = config['emisor']
     frases = config['frases']
+    emisor_actual, frases_actual, bloques = _plantilla_emisor_actual
+    if emisor is not emisor_actual or frases is not frases_actual:
+        bloque_emisor = _PLANTILLA_EMISOR.format(**emisor)
+        bloque_frases = (
+            '        <dte:Frases>\n'
+            + ''.join(_PLANTILLA_FRASE.format(**frase) for frase in frases)
+            + '        </dte:Frases>\n'
+        )
+        bloques = (bloque_emisor, bloque_frases)
+        _plantilla_emisor_actual = (emisor, frases, bloques)
+    return bloques
+
+@medir('xml')
+def guardar_xml_factura(config, factura, contacto, nombre_receptor=None):
+    """Escribe el XML FEL en bloques al diario (guardar_xml_diario) y devuelve su huella"""
+    return guardar_xml_diario(escribir_xml_factura(config, factura, contacto, nombre_receptor=nombre_receptor))
+
+@medir('xml')
+def generar_xml_factura(config, factura, contacto, fecha_emision=None, nombre_receptor=None):
+    """Genera el XML FEL para certificacion en INFILE a partir de la Factura y el Contacto.
+
+    fecha_emision (formato '%Y-%m-%dT%H:%M:%S-06:00') es la fecha actual si no se indica.
+    nombre_receptor es el nombre verificado en SAT; sin el se usa el del contacto.
+    """
+    return ''.join(partes_xml_factura(config, factura, contacto, fecha_emision, nombre_receptor))
+
+def escribir_xml_factura(config, factura, contacto, fecha_emision=None, tamano_bloque=TAMANO_BLOQUE_XML,
+                         nombre_receptor=None):
+    """Generador del mismo XML que generar_xml_factura, en bloques de bytes UTF-8.
+
+    Los bloques salen a medida que se recorren las lineas, asi el XML completo
+    nunca esta en memoria; guardar_xml_factura los escribe al diario.
+    """
+    pendientes = []
+    tamano = 0
+    for parte in partes_xml_factura(config, factura, contacto, fecha_emision, nombre_receptor):
+        pendientes.append(parte)
+        tamano += len(parte)
+        if tamano >= tamano_bloque:
+            yield ''.join(pendientes).encode('utf-8')
+            pendientes.clear()
+            tamano = 0
+    if pendientes:
+        yield ''.join(pendientes).encode('utf-8')
+
+def partes_xml_factura(config, factura, contacto, fecha_emision=None, nombre_receptor=None):
+    """Generador de los fragmentos (str) del XML FEL: encabezado, una parte por linea, totales y cierre"""
+    emisor = config['emisor']
 
     # Datos del receptor (cliente)
-    # SIEMPRE buscar primero en campos personalizados (tienen prioridad)
-    nit_receptor = ''
-    custom_fields = contacto.get('custom_fields', [])
-    # Debug: mostrar campos personalizados disponibles
-    if custom_fields:
-        print(f"   [DEBUG] Campos personalizados: {[cf.get('label', '') for cf in custom_fields]}")
-    for cf in custom_fields:
-        label = cf.get('label', '').upper().strip()
-        # Buscar cualquier campo que contenga "NIT" o sea identificador fiscal
-        # Incluye "ID DE EMPRESA" que es donde Zoho guarda el NIT
-        if 'NIT' in label or 'ID DE EMPRESA' in label or label in ['TAX ID', 'TAX NUMBER', 'NUMERO FISCAL', 'ID FISCAL', 'RFC', 'RUC', 'RUT', 'ID EMPRESA']:
-            nit_receptor = cf.get('value', '') or ''
-            if nit_receptor and nit_receptor.upper() not in ['N/A', 'CF', '']:
-                print(f"   [DEBUG] NIT encontrado en campo '{cf.get('label')}': {nit_receptor}")
-                break
-
-    # Si no hay NIT en campos personalizados, usar tax_number como fallback
-    if not nit_receptor or nit_receptor.upper() in ['N/A', 'CF', '']:
-        nit_receptor = contacto.get('tax_number', '') or ''
-
-    # Limpiar NIT - solo numeros, letras y guion
-    nit_receptor = ''.join(c for c in str(nit_receptor) if c.isalnum() or c == '-')
-    # Si esta vacio o es consumidor final
-    if not nit_receptor or nit_receptor.upper() in ['CF', 'C/F', 'CONSUMIDORFINAL', 'CONSUMIDOR FINAL', 'N/A']:
-        nit_receptor = 'CF'
-    # Convertir a mayusculas
-    nit_receptor = nit_receptor.upper()
-
-    # Buscar nombre a facturar en campos personalizados, si no usar contact_name
-    nombre_receptor = ''
-    custom_fields = contacto.get('custom_fields', [])
-    for cf in custom_fields:
-        label = cf.get('label', '').upper()
-        if label in ['NOMBRE A FACTURAR', 'RAZON SOCIAL', 'NOMBRE FISCAL']:
-            nombre_receptor = cf.get('value', '') or ''
-            break
-
-    if not nombre_receptor:
-        nombre_receptor = contacto.get('contact_name') or 'Consumidor Final'
-    email_receptor = contacto.get('email', '') or ''
-    direccion_receptor = contacto.get('billing_address', {}) or {}
+    receptor = resolver_receptor(contacto)
+    if receptor['etiquetas']:
+        print(f"   [DEBUG] Campos personalizados: {receptor['etiquetas']}")
+    if receptor['campo_nit']:
+        print(f"   [DEBUG] NIT encontrado en campo '{receptor['campo_nit']}': {receptor['nit']}")
+    es_exportacion = receptor['es_exportacion']
+    nombre_receptor = limpiar_xml(nombre_receptor) if nombre_receptor else receptor['nombre_xml']
 
     # Fecha y hora actual
-    fecha_emision = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-06:00')
+    if fecha_emision is None:
+        fecha_emision = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-06:00')
 
     # Moneda
-    moneda = factura.get('currency_code', 'GTQ')
-
-    # Crear XML
-    ns = "http://www.sat.gob.gt/dte/fel/0.2.0"
-    ns_map = {
-        'dte': ns,
-        'xsi': "http://www.w3.org/2001/XMLSchema-instance"
-    }
-
-    # Detectar si es exportacion (pais diferente de Guatemala)
-    # Si el país está vacío o no definido, asumir que es LOCAL (Guatemala)
-    pais_cliente = direccion_receptor.get('country', '') or ''
-    pais_cliente = pais_cliente.strip().lower()
-
-    # Lista de valores que indican Guatemala o local
-    paises_locales = ['guatemala', 'gt', 'gua', '']
-    es_exportacion = pais_cliente not in paises_locales
-
-    # Construir XML como string para mayor control
-    xml_lines = []
-    xml_lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-    xml_lines.append(f'<dte:GTDocumento xmlns:dte="{ns}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="0.1">')
-    xml_lines.append('  <dte:SAT ClaseDocumento="dte">')
-    xml_lines.append('    <dte:DTE ID="DatosCertificados">')
-    xml_lines.append(f'      <dte:DatosEmision ID="DatosEmision">')
-
-    # Datos Generales - FACT para local, FACT para exportacion de servicios
-    tipo_doc = "FACT"
-    # Para exportacion se agrega atributo Exp
-    if es_exportacion:
-        xml_lines.append(f'        <dte:DatosGenerales CodigoMoneda="{moneda}" Exp="SI" FechaHoraEmision="{fecha_emision}" Tipo="{tipo_doc}"/>')
-    else:
-        xml_lines.append(f'        <dte:DatosGenerales CodigoMoneda="{moneda}" FechaHoraEmision="{fecha_emision}" Tipo="{tipo_doc}"/>')
-
-    # Emisor
-    xml_lines.append(f'        <dte:Emisor AfiliacionIVA="{emisor["afiliacion_iva"]}" CodigoEstablecimiento="{emisor["codigo_establecimiento"]}" CorreoEmisor="" NITEmisor="{emisor["nit"]}" NombreComercial="{emisor["nombre_comercial"]}" NombreEmisor="{emisor["nombre"]}">')
-    xml_lines.append(f'          <dte:DireccionEmisor>')
-    xml_lines.append(f'            <dte:Direccion>{emisor["direccion"]}</dte:Direccion>')
-    xml_lines.append(f'            <dte:CodigoPostal>{emisor["codigo_postal"]}</dte:CodigoPostal>')
-    xml_lines.append(f'            <dte:Municipio>{emisor["municipio"]}</dte:Municipio>')
-    xml_lines.append(f'            <dte:Departamento>{emisor["departamento"]}</dte:Departamento>')
-    xml_lines.append(f'            <dte:Pais>{emisor["pais"]}</dte:Pais>')
-    xml_lines.append(f'          </dte:DireccionEmisor>')
-    xml_lines.append(f'        </dte:Emisor>')
-
-    # Funcion para limpiar texto XML
-    def limpiar_xml(texto):
-        if not texto:
-            return ''
-        texto = str(texto)
-        texto = texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;')
-        return texto.strip()
-
-    # Codigos de pais ISO validos
-    codigos_pais_validos = ['AF', 'AL', 'DE', 'AD', 'AO', 'AI', 'AQ', 'AG', 'SA', 'DZ', 'AR', 'AM', 'AW', 'AU', 'AT', 'AZ', 'BS', 'BD', 'BB', 'BH', 'BE', 'BZ', 'BJ', 'BM', 'BY', 'BO', 'BA', 'BW', 'BR', 'BN', 'BG', 'BF', 'BI', 'BT', 'CV', 'KH', 'CM', 'CA', 'QA', 'TD', 'CL', 'CN', 'CY', 'CO', 'KM', 'KP', 'KR', 'CR', 'CI', 'HR', 'CU', 'CW', 'DK', 'DM', 'EC', 'EG', 'SV', 'AE', 'ER', 'SK', 'SI', 'ES', 'US', 'EE', 'ET', 'PH', 'FI', 'FJ', 'FR', 'GA', 'GM', 'GE', 'GH', 'GI', 'GD', 'GR', 'GL', 'GP', 'GU', 'GT', 'GF', 'GG', 'GN', 'GQ', 'GW', 'GY', 'HT', 'HN', 'HK', 'HU', 'IN', 'ID', 'IQ', 'IR', 'IE', 'IS', 'IL', 'IT', 'JM', 'JP', 'JE', 'JO', 'KZ', 'KE', 'KG', 'KI', 'KW', 'LA', 'LS', 'LV', 'LB', 'LR', 'LY', 'LI', 'LT', 'LU', 'MO', 'MK', 'MG', 'MY', 'MW', 'MV', 'ML', 'MT', 'MA', 'MQ', 'MU', 'MR', 'MX', 'FM', 'MD', 'MC', 'MN', 'ME', 'MS', 'MZ', 'MM', 'NA', 'NR', 'NP', 'NI', 'NE', 'NG', 'NO', 'NC', 'NZ', 'OM', 'NL', 'PK', 'PW', 'PS', 'PA', 'PG', 'PY', 'PE', 'PF', 'PL', 'PT', 'PR', 'GB', 'CF', 'CZ', 'CG', 'CD', 'DO', 'RE', 'RW', 'RO', 'RU', 'EH', 'WS', 'AS', 'BL', 'KN', 'SM', 'MF', 'PM', 'VC', 'SH', 'LC', 'ST', 'SN', 'RS', 'SC', 'SL', 'SG', 'SX', 'SY', 'SO', 'LK', 'SZ', 'ZA', 'SD', 'SS', 'SE', 'CH', 'SR', 'TH', 'TW', 'TZ', 'TJ', 'IO', 'TF', 'TL', 'TG', 'TK', 'TO', 'TT', 'TN', 'TM', 'TR', 'TV', 'UA', 'UG', 'UY', 'UZ', 'VU', 'VA', 'VE', 'VN', 'WF', 'YE', 'DJ', 'ZM', 'ZW']
-
-    # Receptor - limpiar todos los campos
-    dir_receptor = limpiar_xml(direccion_receptor.get('address', '')) or 'Ciudad'
-    cp_receptor = direccion_receptor.get('zip', '01001') or '01001'
-    mun_receptor = limpiar_xml(direccion_receptor.get('city', '')) or 'Guatemala'
-    dep_receptor = limpiar_xml(direccion_receptor.get('state', '')) or 'Guatemala'
-    pais_receptor = direccion_receptor.get('country', 'GT') or 'GT'
-
-    # Convertir nombres de pais a codigo ISO
-    paises_nombre_a_codigo = {
-        'guatemala': 'GT', 'mexico': 'MX', 'estados unidos': 'US', 'usa': 'US', 'united states': 'US',
-        'el salvador': 'SV', 'honduras': 'HN', 'nicaragua': 'NI', 'costa rica': 'CR', 'panama': 'PA',
-        'colombia': 'CO', 'españa': 'ES', 'spain': 'ES', 'canada': 'CA', 'argentina': 'AR',
-        'chile': 'CL', 'peru': 'PE', 'brasil': 'BR', 'brazil': 'BR', 'ecuador': 'EC'
-    }
-
-    # Si es nombre de pais, convertir a codigo
-    if pais_receptor.lower() in paises_nombre_a_codigo:
-        pais_receptor = paises_nombre_a_codigo[pais_receptor.lower()]
-
-    # Si no es un codigo valido, usar GT por defecto
-    pais_receptor = pais_receptor.upper()
-    if pais_receptor not in codigos_pais_validos:
-        pais_receptor = 'GT'
-
-    # Limpiar nombre del receptor
-    nombre_receptor = limpiar_xml(nombre_receptor)
-    if not nombre_receptor:
-        nombre_receptor = 'Consumidor Final'
-
-    # Para exportaciones, el ID del receptor debe ser "CF" según normativa SAT
-    id_receptor = "CF" if es_exportacion else nit_receptor
-    xml_lines.append(f'        <dte:Receptor CorreoReceptor="{email_receptor}" IDReceptor="{id_receptor}" NombreReceptor="{nombre_receptor}">')
-    xml_lines.append(f'          <dte:DireccionReceptor>')
-    xml_lines.append(f'            <dte:Direccion>{dir_receptor}</dte:Direccion>')
-    xml_lines.append(f'            <dte:CodigoPostal>{cp_receptor}</dte:CodigoPostal>')
-    xml_lines.append(f'            <dte:Municipio>{mun_receptor}</dte:Municipio>')
-    xml_lines.append(f'            <dte:Departamento>{dep_receptor}</dte:Departamento>')
-    xml_lines.append(f'            <dte:Pais>{pais_receptor}</dte:Pais>')
-    xml_lines.append(f'          </dte:DireccionReceptor>')
-    xml_lines.append(f'        </dte:Receptor>')
-
-    # Frases
-    xml_lines.append('        <dte:Frases>')
-    if es_exportacion:
-        # Para exportaciones: Frase tipo 4 (Exento o no afecto al IVA) es obligatoria
-        xml_lines.append('          <dte:Frase CodigoEscenario="1" TipoFrase="4"/>')
-    else:
-        # Frases normales para ventas locales
-        for frase in frases:
-            xml_lines.append(f'          <dte:Frase CodigoEscenario="{frase["codigo_escenario"]}" TipoFrase="{frase["tipo_frase"]}"/>')
-    xml_lines.append('        </dte:Frases>')
-
-    # Items
-    xml_lines.append('        <dte:Items>')
-    line_items = factura.get('line_items', [])
+    moneda = factura.currency_code
+
+    bloque_emisor, bloque_frases = plantilla_emisor(config)
+
+    # Datos Generales - FACT para local y para exportacion de servicios (con atributo Exp)
+    yield ''.join((
+        _PLANTILLA_ENCABEZADO % (moneda, ' Exp="SI"' if es_exportacion else '', fecha_emision, "FACT"),
+        bloque_emisor,
+        _PLANTILLA_RECEPTOR % (
+            receptor['email'], receptor['id_receptor'], nombre_receptor, receptor['direccion_xml'],
+            receptor['codigo_postal'], receptor['municipio_xml'], receptor['departamento_xml'], receptor['codigo_pais']
+        ),
+        _FRASES_EXPORTACION if es_exportacion else bloque_frases,
+        '        <dte:Items>\n'
+    ))
+
+    # Los totales suman en millonesimas enteras los montos tal como quedan escritos en cada
+    # linea (6 decimales), asi TotalMontoImpuesto y GranTotal cuadran exacto con los Items
     total_iva_calculado = 0
     gran_total_calculado = 0
 
-    for i, item in enumerate(line_items, 1):
-        cantidad = float(item.get('quantity', 1))
+    plantilla_item = _PLANTILLA_ITEM
+    for i, item in enumerate(factura.line_items, 1):
+        cantidad = item.cantidad
         # rate en Zoho es el precio SIN IVA
-        precio_sin_iva = float(item.get('rate', 0))
-        descuento = float(item.get('discount_amount', 0) or 0)
-
-        # Combinar nombre del producto + descripcion
-        nombre_producto = item.get('name', '') or ''
-        descripcion_adicional = item.get('description', '') or ''
+        precio_sin_iva = item.precio
+        descuento = item.descuento
 
-        # Crear descripcion completa: "Nombre - Descripcion" o solo uno si el otro esta vacio
-        if nombre_producto and descripcion_adicional:
-            descripcion = f"{nombre_producto} - {descripcion_adicional}"
+        # Descripcion completa: "Nombre - Descripcion" o solo uno si el otro esta vacio
+        if item.nombre and item.descripcion:
+            descripcion = f"{item.nombre} - {item.descripcion}"
         else:
-            descripcion = nombre_producto or descripcion_adicional or 'Servicio'
-
-        descripcion = limpiar_xml(descripcion)
+            descripcion = item.nombre or item.descripcion or 'Servicio'
 
         # Calcular montos - diferente para exportacion vs local
+        monto_gravable = item.monto_gravable
+        texto_impuesto, texto_total = impuesto_y_total_linea(monto_gravable, es_exportacion)
         if es_exportacion:
-            # EXPORTACION: Sin IVA
+            # EXPORTACION: Sin IVA, 2 = Exento
             precio_unitario = precio_sin_iva
-            precio_total = cantidad * precio_unitario
-            monto_gravable = (cantidad * precio_sin_iva) - descuento
-            monto_impuesto = 0  # Sin IVA para exportaciones
-            total_linea = monto_gravable
-            codigo_unidad_gravable = "2"  # 2 = Exento
+            codigo_unidad_gravable = "2"
         else:
-            # LOCAL: Con IVA 12%
-            precio_unitario_con_iva = precio_sin_iva * 1.12
-            precio_total = cantidad * precio_unitario_con_iva
-            monto_gravable = (cantidad * precio_sin_iva) - descuento
-            monto_impuesto = monto_gravable * 0.12
-            total_linea = monto_gravable + monto_impuesto
-            precio_unitario = precio_unitario_con_iva
-            codigo_unidad_gravable = "1"  # 1 = Gravado
-
-        total_iva_calculado += monto_impuesto
-        gran_total_calculado += total_linea
-
-        xml_lines.append(f'          <dte:Item BienOServicio="S" NumeroLinea="{i}">')
-        xml_lines.append(f'            <dte:Cantidad>{cantidad:.2f}</dte:Cantidad>')
-        xml_lines.append(f'            <dte:UnidadMedida>UND</dte:UnidadMedida>')
-        xml_lines.append(f'            <dte:Descripcion>{descripcion}</dte:Descripcion>')
-        xml_lines.append(f'            <dte:PrecioUnitario>{precio_unitario:.6f}</dte:PrecioUnitario>')
-        xml_lines.append(f'            <dte:Precio>{precio_total:.6f}</dte:Precio>')
-        xml_lines.append(f'            <dte:Descuento>{descuento:.6f}</dte:Descuento>')
-        xml_lines.append('            <dte:Impuestos>')
-        xml_lines.append('              <dte:Impuesto>')
-        xml_lines.append(f'                <dte:NombreCorto>IVA</dte:NombreCorto>')
-        xml_lines.append(f'                <dte:CodigoUnidadGravable>{codigo_unidad_gravable}</dte:CodigoUnidadGravable>')
-        xml_lines.append(f'                <dte:MontoGravable>{monto_gravable:.6f}</dte:MontoGravable>')
-        xml_lines.append(f'                <dte:MontoImpuesto>{monto_impuesto:.6f}</dte:MontoImpuesto>')
-        xml_lines.append('              </dte:Impuesto>')
-        xml_lines.append('            </dte:Impuestos>')
-        xml_lines.append(f'            <dte:Total>{total_linea:.6f}</dte:Total>')
-        xml_lines.append('          </dte:Item>')
-    xml_lines.append('        </dte:Items>')
+            # LOCAL: Con IVA 12%, 1 = Gravado
+            precio_unitario = precio_sin_iva * 1.12
+            codigo_unidad_gravable = "1"
+            total_iva_calculado += int(texto_impuesto.replace('.', ''))
+        precio_total = cantidad * precio_unitario
+
+        gran_total_calculado += int(texto_total.replace('.', ''))
+
+        yield plantilla_item % (
+            i, cantidad, limpiar_xml(descripcion), precio_unitario, precio_total, descuento,
+            codigo_unidad_gravable, monto_gravable, texto_impuesto, texto_total
+        )
 
     # Totales - usar los valores calculados para consistencia
-    xml_lines.append('        <dte:Totales>')
-    xml_lines.append('          <dte:TotalImpuestos>')
-    xml_lines.append(f'            <dte:TotalImpuesto NombreCorto="IVA" TotalMontoImpuesto="{total_iva_calculado:.6f}"/>')
-    xml_lines.append('          </dte:TotalImpuestos>')
-    xml_lines.append(f'          <dte:GranTotal>{gran_total_calculado:.6f}</dte:GranTotal>')
-    xml_lines.append('        </dte:Totales>')
+    yield _PLANTILLA_TOTALES.format(total_iva=Decimal(total_iva_calculado).scaleb(-6),
+                                    gran_total=Decimal(gran_total_calculado).scaleb(-6))
 
     # Complemento de Exportación (obligatorio para exportaciones)
     if es_exportacion:
-        # Namespace del complemento de exportación
-        ns_exp = "http://www.sat.gob.gt/face2/ComplementoExportaciones/0.1.0"
-
-        # Datos del comprador/destinatario (usar datos del receptor)
-        nombre_comprador = limpiar_xml(nombre_receptor)
-        direccion_comprador = f"{dir_receptor}, {mun_receptor}, {dep_receptor}"
-        direccion_comprador = limpiar_xml(direccion_comprador)
-
-        xml_lines.append('        <dte:Complementos>')
-        xml_lines.append(f'          <dte:Complemento IDComplemento="ID_EXPORTACION" NombreComplemento="Exportacion" URIComplemento="{ns_exp}">')
-        xml_lines.append(f'            <cex:Exportacion xmlns:cex="{ns_exp}" Version="1">')
-        xml_lines.append(f'              <cex:NombreConsignatarioODestinatario>{nombre_comprador}</cex:NombreConsignatarioODestinatario>')
-        xml_lines.append(f'              <cex:DireccionConsignatario>{direccion_comprador}</cex:DireccionConsignatario>')
-        xml_lines.append(f'              <cex:NombreComprador>{nombre_comprador}</cex:NombreComprador>')
-        xml_lines.append(f'              <cex:DireccionComprador>{direccion_comprador}</cex:DireccionComprador>')
-        xml_lines.append(f'              <cex:CodigoComprador>CF</cex:CodigoComprador>')
-        xml_lines.append(f'              <cex:NombreExportador>{limpiar_xml(emisor["nombre"])}</cex:NombreExportador>')
-        xml_lines.append(f'              <cex:CodigoExportador>{emisor["nit"]}</cex:CodigoExportador>')
-        xml_lines.append('            </cex:Exportacion>')
-        xml_lines.append('          </dte:Complemento>')
-        xml_lines.append('        </dte:Complementos>')
-
-    xml_lines.append('      </dte:DatosEmision>')
-    xml_lines.append('    </dte:DTE>')
-    xml_lines.append('  </dte:SAT>')
-    xml_lines.append('</dte:GTDocumento>')
+        yield _PLANTILLA_COMPLEMENTO_EXPORTACION.format(
+            nombre=limpiar_xml(nombre_receptor),
+            direccion=limpiar_xml(f"{receptor['direccion_xml']}, {receptor['municipio_xml']}, {receptor['departamento_xml']}"),
+            nombre_exportador=limpiar_xml(emisor["nombre"]),
+            codigo_exportador=emisor["nit"]
+        )
 
-    return '\n'.join(xml_lines)
+    yield _PLANTILLA_CIERRE
 
+def url_documento_infile(config, uuid_fel):
+    """URL publica del documento certificado en el servidor de reportes de INFILE"""
+    base = config['infile'].get('url_reportes', 'https://report.feel.com.gt')
+    return f"{base}/ingfacereport/ingfacereport_documento?uuid={uuid_fel}"
+
+@medir('infile')
 def certificar_factura_infile(config, xml_content, identificador):
     """Envia el XML a INFILE para certificacion"""
     infile = config['infile']
@@ -369,28 +1412,29 @@ def certificar_factura_infile(config, xml_content, identificador):
         'identificador': identificador
     }
 
-    response = requests.post(
+    # xml_content es el XML del diario abierto en binario (se envia en streaming,
+    # con Content-Length tomado del tamano del archivo)
+    response = solicitud_http(
+        'infile',
+        'POST',
         infile['url_certificacion'],
         headers=headers,
-        data=xml_content.encode('utf-8')
+        data=xml_content
     )
 
     if response.status_code == 200:
         return response.json()
     else:
+        # error_http indica que INFILE no llego a responder sobre el documento
         return {
             'resultado': False,
-            'descripcion': f'Error HTTP {response.status_code}: {response.text}'
+            'descripcion': f'Error HTTP {response.status_code}: {response.text}',
+            'error_http': response.status_code
         }
 
+@medir('zoho_actualizar')
 def actualizar_factura_zoho(config, access_token, invoice_id, datos_certificacion, ya_enviada=False):
     """Actualiza la factura en Zoho con los datos de certificacion y cambia el numero de factura"""
-    org_id = config['zoho']['organization_id']
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
 
     # Crear nuevo numero de factura con Serie-Numero de INFILE
     serie = datos_certificacion.get('serie', '')
@@ -412,16 +1456,13 @@ def actualizar_factura_zoho(config, access_token, invoice_id, datos_certificacio
 
     # Primero marcar como enviada si no lo esta (requerido para poder actualizar algunos campos)
     if not ya_enviada:
-        url_status = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}/status/sent"
-        resp_status = requests.post(url_status, headers=headers, params=params)
+        resp_status = solicitud_zoho(config, access_token, 'POST', f"invoices/{invoice_id}/status/sent")
         if resp_status.status_code == 200:
             print("   Factura marcada como enviada para permitir actualizacion...")
         else:
             print(f"   [DEBUG] No se pudo marcar como enviada: {resp_status.status_code}")
 
     # Ahora actualizar la factura
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}"
-
     # IMPORTANTE: Zoho requiere "reason" para actualizar facturas enviadas
     uuid_fel = datos_certificacion.get('uuid', '')
     serie = datos_certificacion.get('serie', '')
@@ -464,7 +1505,7 @@ def actualizar_factura_zoho(config, access_token, invoice_id, datos_certificacio
     if fecha_zoho:
         data["date"] = fecha_zoho
 
-    response = requests.put(url, headers=headers, params=params, json=data)
+    response = solicitud_zoho(config, access_token, 'PUT', f"invoices/{invoice_id}", json=data)
 
     # Debug: mostrar resultado de la actualizacion
     if response.status_code != 200:
@@ -483,46 +1524,23 @@ def actualizar_factura_zoho(config, access_token, invoice_id, datos_certificacio
 
 def marcar_factura_enviada(config, access_token, invoice_id):
     """Marca la factura como enviada (cambia de borrador a abierta)"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}/status/sent"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
-
-    response = requests.post(url, headers=headers, params=params)
+    response = solicitud_zoho(config, access_token, 'POST', f"invoices/{invoice_id}/status/sent")
     return response.status_code == 200
 
-def enviar_factura_email(config, access_token, invoice_id, emails, datos_certificacion=None, contacto=None):
-    """Envia la factura por email a los contactos con datos de certificacion"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}/email"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
-
-    # Obtener nombres del cliente
-    nombre_visualizacion = ""
-    razon_social = ""
+def datos_cliente_email(contacto):
+    """Nombre de visualizacion (como aparece en Zoho) y razon social del cliente para el email"""
+    receptor = resolver_receptor(contacto)
+    return {'nombre_visualizacion': receptor['nombre_visualizacion'], 'razon_social': receptor['razon_social']}
 
-    if contacto:
-        # Nombre de visualizacion (como aparece en Zoho)
-        nombre_visualizacion = contacto.get('contact_name', '') or ''
+@medir('email')
+def enviar_factura_email(config, access_token, invoice_id, emails, datos_certificacion=None, cliente=None):
+    """Envia la factura por email a los contactos con datos de certificacion.
 
-        # Buscar razon social en campos personalizados
-        custom_fields = contacto.get('custom_fields', [])
-        for cf in custom_fields:
-            label = cf.get('label', '').upper()
-            if label in ['NOMBRE A FACTURAR', 'RAZON SOCIAL', 'NOMBRE FISCAL']:
-                razon_social = cf.get('value', '') or ''
-                break
-
-        # Si no hay razon social en campos personalizados, usar company_name
-        if not razon_social:
-            razon_social = contacto.get('company_name', '') or nombre_visualizacion
+    cliente es el dict de datos_cliente_email. Si el PDF del DTE esta en el
+    archivo local, va adjunto al correo.
+    """
+    nombre_visualizacion = (cliente or {}).get('nombre_visualizacion', '')
+    razon_social = (cliente or {}).get('razon_social', '')
 
     # Construir cuerpo del correo con datos de certificacion
     if datos_certificacion:
@@ -532,7 +1550,7 @@ def enviar_factura_email(config, access_token, invoice_id, emails, datos_certifi
         fecha_cert = datos_certificacion.get('fecha', '')
 
         # URL del PDF de INFILE
-        url_pdf_infile = f"https://report.feel.com.gt/ingfacereport/ingfacereport_documento?uuid={uuid_fel}"
+        url_pdf_infile = url_documento_infile(config, uuid_fel)
 
         body = f"""Estimado cliente,
 
@@ -565,31 +1583,50 @@ Proyectos de Tecnología y Comunicaciones, S.A."""
         "body": body
     }
 
-    response = requests.post(url, headers=headers, params=params, json=data)
+    archivado = abrir_pdf_archivado(config, datos_certificacion.get('uuid', '')) if datos_certificacion else None
+    if archivado is None:
+        response = solicitud_zoho(config, access_token, 'POST', f"invoices/{invoice_id}/email", json=data)
+        return response.status_code == 200
+
+    # Con adjuntos, Zoho recibe el correo como multipart con el JSON en JSONString
+    nombre_archivo = f"FEL_{datos_certificacion.get('serie', '')}_{datos_certificacion.get('numero', '')}.pdf"
+    with archivado:
+        response = solicitud_zoho(
+            config, access_token, 'POST', f"invoices/{invoice_id}/email",
+            data={'JSONString': json.dumps(data, ensure_ascii=False)},
+            files={'attachments': (nombre_archivo, archivado, 'application/pdf')}
+        )
     return response.status_code == 200
 
 def mostrar_menu_facturas(facturas):
-    """Muestra el menu de facturas para seleccionar"""
+    """Muestra el menu de facturas para seleccionar.
+
+    facturas puede ser un generador: cada fila se imprime en cuanto llega.
+    Devuelve la lista de facturas seleccionadas.
+    """
     print("\n" + "="*70)
     print("      ASISTENTE DE FACTURACION ADSTTER - CERTIFICACION FEL")
     print("="*70)
 
-    if not facturas:
-        print("\nNo hay facturas en borrador para procesar.")
-        return []
-
-    print(f"\nFacturas en borrador encontradas: {len(facturas)}\n")
-    print("-"*70)
-    print(f"{'#':<4} {'Numero':<15} {'Cliente':<30} {'Total':<15}")
-    print("-"*70)
-
+    listadas = []
     for i, factura in enumerate(facturas, 1):
+        if i == 1:
+            print("\n" + "-"*70)
+            print(f"{'#':<4} {'Numero':<15} {'Cliente':<30} {'Total':<15}")
+            print("-"*70)
         numero = factura.get('invoice_number', 'N/A')
         cliente = factura.get('customer_name', 'N/A')[:28]
         total = factura.get('total', 0)
         moneda = factura.get('currency_code', 'GTQ')
         print(f"{i:<4} {numero:<15} {cliente:<30} {moneda} {total:>10,.2f}")
+        listadas.append(factura)
+
+    if not listadas:
+        print("\nNo hay facturas en borrador para procesar.")
+        return []
 
+    print("-"*70)
+    print(f"Facturas en borrador encontradas: {len(listadas)}")
     print("-"*70)
     print("\nOpciones:")
     print("  - Ingrese numeros separados por coma (ej: 1,3,5)")
@@ -598,142 +1635,560 @@ def mostrar_menu_facturas(facturas):
     print("-"*70)
 
     seleccion = input("\nSeleccione las facturas a certificar: ").strip()
+    return seleccionar_facturas(listadas, seleccion)
 
+def seleccionar_facturas(facturas, seleccion):
+    """Interpreta la seleccion del menu ('1,3,5', 'T' o '0') y devuelve las facturas elegidas"""
     if seleccion == '0':
         return []
 
     if seleccion.upper() == 'T':
-        return list(range(len(facturas)))
+        return list(facturas)
 
     try:
         indices = [int(x.strip()) - 1 for x in seleccion.split(',')]
-        indices = [i for i in indices if 0 <= i < len(facturas)]
-        return indices
+        return [facturas[i] for i in indices if 0 <= i < len(facturas)]
     except:
         print("Seleccion invalida.")
         return []
 
-def descargar_y_adjuntar_pdf_fel(config, access_token, invoice_id, url_pdf, serie, numero):
-    """Descarga el PDF de INFILE y lo adjunta a la factura en Zoho Books"""
-    org_id = config['zoho']['organization_id']
+class CuerpoEnStreaming:
+    """Iterador de bloques con el largo total conocido: requests lo envia con Content-Length, sin chunked"""
+
+    def __init__(self, bloques, largo):
+        self.bloques = iter(bloques)
+        self.largo = largo
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.bloques)
+
+    def __len__(self):
+        return self.largo
+
+def multipart_en_streaming(campo, nombre_archivo, tipo, bloques, tamano):
+    """Genera un cuerpo multipart/form-data a partir de bloques de bytes, sin armarlo en memoria.
+
+    tamano es el total de bytes de los bloques; con el se calcula el Content-Length
+    del cuerpo. Devuelve (content_type, CuerpoEnStreaming).
+    """
+    frontera = uuid.uuid4().hex
+    encabezado = (
+        f'--{frontera}\r\n'
+        f'Content-Disposition: form-data; name="{campo}"; filename="{nombre_archivo}"\r\n'
+        f'Content-Type: {tipo}\r\n\r\n'
+    ).encode('utf-8')
+    cierre = f'\r\n--{frontera}--\r\n'.encode('ascii')
+
+    def cuerpo():
+        yield encabezado
+        yield from bloques
+        yield cierre
+
+    return f'multipart/form-data; boundary={frontera}', CuerpoEnStreaming(cuerpo(), len(encabezado) + tamano + len(cierre))
+
+def tamano_descarga(response):
+    """Bytes que entregara iter_content segun Content-Length, o None si no se sabe (sin el o comprimida)"""
+    if response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return None
+
+@medir('pdf')
+def descargar_y_adjuntar_pdf_fel(config, access_token, invoice_id, url_pdf, serie, numero, uuid_fel=''):
+    """Sube el PDF del DTE como adjunto a Zoho Books.
+
+    Si el PDF ya esta en el archivo local se sube desde ahi. Si no, se descarga
+    de INFILE en streaming: cuando INFILE informa el tamano, los bloques pasan
+    directo al cuerpo multipart del adjunto (con Content-Length); si no, se
+    descargan primero a un temporal y se sube desde ahi. El PDF nunca queda
+    completo en memoria, y en los dos casos queda guardado en el archivo.
+    """
+    nombre_archivo = f"FEL_{serie}_{numero}.pdf"
+    archivado = abrir_pdf_archivado(config, uuid_fel)
+    if archivado:
+        print(f"   PDF tomado del archivo local")
+        with archivado:
+            try:
+                response_attach = solicitud_zoho(
+                    config, access_token, 'POST', f"invoices/{invoice_id}/attachment",
+                    files={'attachment': (nombre_archivo, archivado, 'application/pdf')}
+                )
+            except Exception as e:
+                print(f"   [DEBUG] Error al subir PDF: {e}")
+                return False
+        return resultado_adjunto_pdf(response_attach, nombre_archivo)
 
     # Descargar PDF desde INFILE
     print(f"   Descargando PDF de INFILE...")
     try:
-        response_pdf = requests.get(url_pdf, timeout=30)
+        response_pdf = solicitud_http('reportes', 'GET', url_pdf, stream=True)
+    except Exception as e:
+        print(f"   [DEBUG] Error de conexion al descargar PDF: {e}")
+        return False
+
+    with response_pdf:
         if response_pdf.status_code != 200:
             print(f"   [DEBUG] Error al descargar PDF: HTTP {response_pdf.status_code}")
             return False
 
-        # Verificar que es un PDF
+        # Verificar que es un PDF con los primeros bytes de la descarga
+        try:
+            bloques = response_pdf.iter_content(chunk_size=TAMANO_BLOQUE_PDF)
+            inicio = b''
+            for bloque in bloques:
+                inicio += bloque
+                if len(inicio) >= 5:
+                    break
+        except Exception as e:
+            print(f"   [DEBUG] Error de conexion al descargar PDF: {e}")
+            return False
         content_type = response_pdf.headers.get('Content-Type', '')
-        if 'pdf' not in content_type.lower() and not response_pdf.content[:5] == b'%PDF-':
+        if 'pdf' not in content_type.lower() and not inicio[:5] == b'%PDF-':
             print(f"   [DEBUG] La respuesta no es un PDF (Content-Type: {content_type})")
             return False
-    except Exception as e:
-        print(f"   [DEBUG] Error de conexion al descargar PDF: {e}")
-        return False
 
-    # Guardar en archivo temporal y subir a Zoho
-    nombre_archivo = f"FEL_{serie}_{numero}.pdf"
-    temp_path = os.path.join(tempfile.gettempdir(), nombre_archivo)
-
-    try:
-        with open(temp_path, 'wb') as f:
-            f.write(response_pdf.content)
+        def bloques_pdf():
+            yield inicio
+            yield from bloques
 
-        # Subir a Zoho Books como adjunto
-        url_attach = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}/attachment"
-        headers = {
-            "Authorization": f"Zoho-oauthtoken {access_token}"
-        }
-        params = {"organization_id": org_id}
+        # Subir a Zoho Books como adjunto mientras se sigue descargando (y guardando en el archivo)
+        bloques_adjunto = bloques_pdf()
+        if uuid_fel and archivo_habilitado(config):
+            bloques_adjunto = copiar_a_archivo(bloques_adjunto, lambda huella: archivar_pdf(uuid_fel, huella))
+        tamano = tamano_descarga(response_pdf)
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=TAMANO_BLOQUE_PDF) as temporal:
+                if tamano is None:
+                    # Sin el tamano del PDF no hay Content-Length: se descarga a un temporal (en disco
+                    # pasados TAMANO_BLOQUE_PDF bytes) para medirlo y se sube desde ahi
+                    for bloque in bloques_adjunto:
+                        temporal.write(bloque)
+                    tamano = temporal.tell()
+                    temporal.seek(0)
+                    bloques_adjunto = iter(lambda: temporal.read(TAMANO_BLOQUE_PDF), b'')
+                tipo_multipart, cuerpo = multipart_en_streaming('attachment', nombre_archivo, 'application/pdf',
+                                                                bloques_adjunto, tamano)
+                response_attach = solicitud_zoho(
+                    config, access_token, 'POST', f"invoices/{invoice_id}/attachment",
+                    headers={'Content-Type': tipo_multipart}, data=cuerpo
+                )
+        except Exception as e:
+            print(f"   [DEBUG] Error al subir PDF: {e}")
+            return False
+    return resultado_adjunto_pdf(response_attach, nombre_archivo)
 
-        with open(temp_path, 'rb') as f:
-            files = {'attachment': (nombre_archivo, f, 'application/pdf')}
-            response_attach = requests.post(url_attach, headers=headers, params=params, files=files)
+def resultado_adjunto_pdf(response_attach, nombre_archivo):
+    """Muestra el resultado de subir el PDF a Zoho; devuelve True si se adjunto"""
+    if response_attach.status_code == 200:
+        print(f"   PDF adjuntado: {nombre_archivo}")
+        return True
+    else:
+        print(f"   [DEBUG] Error al adjuntar PDF: {response_attach.status_code}")
+        try:
+            print(f"   [DEBUG] Mensaje: {response_attach.json().get('message', '')}")
+        except:
+            print(f"   [DEBUG] Respuesta: {response_attach.text[:200]}")
+        return False
 
-        if response_attach.status_code == 200:
-            print(f"   PDF adjuntado: {nombre_archivo}")
-            return True
+def iterar_facturas_certificadas(config, access_token):
+    """Generador de facturas certificadas (sent) que tienen fel_uuid y fel_estado=Certificada.
+
+    Los campos fel_* se leen de los custom_fields del listado; el detalle solo se
+    pide para las filas que no los traen. Cada una tiene el formato del menu de
+    anulacion, con la Factura en '_factura' (sin line_items si vino del listado,
+    que la anulacion y el indice no usan).
+    """
+    for resumen in paginar_facturas(config, access_token, 'sent'):
+        if 'custom_fields' in resumen:
+            factura = Factura.desde_zoho(resumen)
         else:
-            print(f"   [DEBUG] Error al adjuntar PDF: {response_attach.status_code}")
+            factura = obtener_factura(config, access_token, resumen.get('invoice_id'))
+        if not factura:
+            continue
+        certificacion = factura.certificacion
+        if certificacion.uuid and certificacion.estado == 'Certificada':
+            yield {
+                'invoice_id': factura.invoice_id,
+                'invoice_number': factura.invoice_number,
+                'customer_id': factura.customer_id,
+                'customer_name': factura.customer_name,
+                '_fel_uuid': certificacion.uuid,
+                '_factura': factura
+            }
+
+def reconciliar_indice(config, access_token):
+    """Sincroniza el indice local con Zoho: agrega certificadas que falten y actualiza las que cambiaron"""
+    vistas = set()
+    for factura in iterar_facturas_certificadas(config, access_token):
+        vistas.add(factura['invoice_id'])
+        registrar_detalle_indice(factura['_factura'])
+
+    # Las que el indice tiene como Certificadas pero Zoho ya no lista como enviadas
+    for factura in listar_certificadas_indice():
+        if factura['invoice_id'] in vistas:
+            continue
+        detalle = obtener_factura(config, access_token, factura['invoice_id'])
+        if detalle:
+            registrar_detalle_indice(detalle)
+    return len(vistas)
+
+def iniciar_reconciliacion_indice(config, access_token):
+    """Lanza reconciliar_indice en un hilo de fondo (sin salida en consola)"""
+    def reconciliar():
+        with capturar_salida(io.StringIO()):
             try:
-                print(f"   [DEBUG] Mensaje: {response_attach.json().get('message', '')}")
-            except:
-                print(f"   [DEBUG] Respuesta: {response_attach.text[:200]}")
-            return False
-    finally:
-        # Limpiar archivo temporal
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-def obtener_facturas_certificadas(config, access_token):
-    """Obtiene facturas certificadas (sent) que tienen fel_uuid y fel_estado=Certificada"""
-    org_id = config['zoho']['organization_id']
-    url = f"{config['zoho']['api_domain']}/books/v3/invoices"
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {
-        "organization_id": org_id,
-        "status": "sent"
-    }
-    response = requests.get(url, headers=headers, params=params)
+                reconciliar_indice(config, access_token)
+            except Exception as e:
+                print(f"Error al reconciliar indice: {e}")
+
+    hilo = threading.Thread(target=reconciliar, name='reconciliar-indice', daemon=True)
+    hilo.start()
+    return hilo
+
+def sincronizar_recurso(config, access_token, recurso, completa=False):
+    """Copia a la tabla local los registros de Zoho modificados desde la ultima marca.
+
+    Pide el listado ordenado por last_modified_time y filtrado desde la marca
+    guardada (incluida, para no perder cambios del mismo segundo). Sin marca,
+    con completa=True o pasado completa_cada_horas descarga todo y borra de la
+    copia lo que Zoho ya no devuelve. Devuelve (registros nuevos o cambiados, si fue completa).
+    """
+    ruta, clave = RECURSOS_SINCRONIZACION[recurso][:2]
+    opciones = dict(OPCIONES_SINCRONIZACION)
+    opciones.update(config.get('sincronizacion', {}))
+    marca, ultima_completa = marca_sincronizacion(recurso)
+    vencida = time.time() - ultima_completa > float(opciones['completa_cada_horas']) * 3600
+    completa = completa or not marca or vencida
+
+    params = {'sort_column': 'last_modified_time', 'sort_order': 'A'}
+    if not completa:
+        params['last_modified_time'] = marca
+    registros = list(paginar_zoho(config, access_token, ruta, clave, params, estricto=True))
+    return guardar_sincronizacion(recurso, registros, completa), completa
+
+def depurar_borradores_copia(config, access_token):
+    """Quita de la copia local los borradores que Zoho ya no lista como draft.
+
+    Un borrador eliminado en Zoho no cambia su last_modified_time, asi que la
+    sincronizacion incremental no lo ve; basta comparar los invoice_id del
+    listado de borradores. Devuelve los invoice_id quitados.
+    """
+    en_zoho = {str(f.get('invoice_id'))
+               for f in paginar_zoho(config, access_token, 'invoices', 'invoices', {'status': 'draft'}, estricto=True)}
+    return quitar_borradores_ausentes(en_zoho)
+
+def sincronizar_zoho(config, access_token, completa=False):
+    """Actualiza la copia local de contactos y facturas con los cambios de Zoho.
+
+    Los contactos cambiados salen de la cache de contactos. De las facturas
+    enviadas o anuladas que cambiaron se consulta el detalle para tener los
+    campos fel_* en el indice de certificadas. Una sincronizacion incremental
+    ademas quita los borradores que ya no estan en Zoho. Devuelve
+    {'contactos': [...], 'facturas': [...], 'borradas': [...], 'completa': bool} con lo que cambio.
+    """
+    contactos, completa_contactos = sincronizar_recurso(config, access_token, 'contactos', completa)
+    for contacto in contactos:
+        _cache_contactos.descartar(str(contacto.get('contact_id')))
+    facturas, completa_facturas = sincronizar_recurso(config, access_token, 'facturas', completa)
+    # La completa ya borro lo que Zoho no devolvio
+    borradas = [] if completa_facturas else depurar_borradores_copia(config, access_token)
+
+    por_indexar = [f['invoice_id'] for f in facturas if f.get('status') in ('sent', 'void')]
+    hilos = int(config.get('concurrencia', {}).get('zoho', LIMITES_CONCURRENCIA['zoho']))
+    faltantes = 0
+    with ThreadPoolExecutor(max_workers=max(1, hilos)) as executor:
+        for factura in executor.map(lambda i: obtener_factura(config, access_token, i), por_indexar):
+            faltantes += factura is None
+            if factura and factura.certificacion.uuid:
+                registrar_detalle_indice(factura)
+    # Una sincronizacion completa sin detalles perdidos deja en el indice todas las certificadas
+    if completa_facturas and not faltantes:
+        marcar_indice_completo()
+    return {'contactos': contactos, 'facturas': facturas, 'borradas': borradas,
+            'completa': completa_contactos or completa_facturas}
+
+def sincronizar_para_menu(config, access_token):
+    """Sincroniza antes de mostrar un menu; devuelve False si no se pudo (el menu consulta Zoho completo)"""
+    print("Sincronizando cambios con Zoho...")
+    try:
+        cambios = sincronizar_zoho(config, access_token)
+    except requests.RequestException as e:
+        print(f"AVISO: No se pudo sincronizar ({e}); se consulta Zoho completo")
+        return False
+    tipo = 'completa' if cambios['completa'] else 'incremental'
+    print(f"Sincronizacion {tipo}: {len(cambios['facturas'])} factura(s) y {len(cambios['contactos'])} contacto(s) con cambios")
+    return True
+
+@medir('infile_consulta')
+def consultar_dte_infile(config, uuid_fel):
+    """Consulta en INFILE el estado de un DTE por UUID (campos segun la seccion "reconciliacion").
+
+    Devuelve {'uuid', 'estado_sat': 'Vigente' | 'Anulado' | 'NoExiste', 'serie', 'numero'};
+    si INFILE no responde o la respuesta no tiene la forma configurada, estado_sat
+    es None (desconocido) y 'error' trae el motivo.
+    """
+    infile = config['infile']
+    opciones = dict(OPCIONES_RECONCILIACION)
+    opciones.update(config.get('reconciliacion', {}))
+    headers = {'UsuarioApi': infile['usuario_api'], 'LlaveApi': infile['llave_api']}
+    try:
+        response = solicitud_http('infile', 'GET', infile['url_consulta'], headers=headers,
+                                  params={opciones['consulta_parametro_uuid']: uuid_fel})
+    except requests.RequestException as e:
+        return {'uuid': uuid_fel, 'estado_sat': None, 'error': str(e)}
     if response.status_code != 200:
-        print(f"Error al obtener facturas: {response.text}")
-        return []
+        return {'uuid': uuid_fel, 'estado_sat': None, 'error': f"Error HTTP {response.status_code}: {response.text[:200]}"}
+    try:
+        datos = response.json()
+    except ValueError:
+        datos = None
+    if not isinstance(datos, dict) or opciones['consulta_campo_resultado'] not in datos:
+        return {'uuid': uuid_fel, 'estado_sat': None, 'error': f"Respuesta no reconocida: {response.text[:200]}"}
+    if datos[opciones['consulta_campo_resultado']] is False:
+        return {'uuid': uuid_fel, 'estado_sat': 'NoExiste', 'error': datos.get('descripcion', '')}
+
+    estado = str(datos.get(opciones['consulta_campo_estado'], ''))
+    normalizado = unicodedata.normalize('NFKD', estado).encode('ascii', 'ignore').decode('ascii').strip().lower()
+    if normalizado in opciones['consulta_estados_anulado']:
+        estado_sat = 'Anulado'
+    elif normalizado in opciones['consulta_estados_vigente']:
+        estado_sat = 'Vigente'
+    else:
+        return {'uuid': uuid_fel, 'estado_sat': None, 'error': f"Estado no reconocido: {estado or '(vacio)'}"}
+    return {
+        'uuid': uuid_fel,
+        'estado_sat': estado_sat,
+        'serie': datos.get(opciones['consulta_campo_serie'], ''),
+        'numero': datos.get(opciones['consulta_campo_numero'], '')
+    }
 
-    facturas = response.json().get('invoices', [])
-    certificadas = []
+def estado_fel_zoho(config, access_token, facturas, hilos):
+    """Campos fel_* de cada factura de Zoho ({invoice_id: {...}}).
 
+    El detalle solo se descarga si la factura cambio (last_modified_time) desde
+    la ultima conciliacion; las descargas van en paralelo con 'hilos'.
+    """
+    guardadas = fel_zoho_guardados()
+    resultado, por_descargar = {}, []
     for factura in facturas:
-        invoice_id = factura.get('invoice_id')
-        detalle = obtener_detalle_factura(config, access_token, invoice_id)
+        guardada = guardadas.get(factura['invoice_id'])
+        if guardada and guardada['last_modified_time'] == factura.get('last_modified_time'):
+            resultado[factura['invoice_id']] = guardada
+        else:
+            por_descargar.append(factura)
+
+    def descargar(factura):
+        detalle = obtener_factura(config, access_token, factura['invoice_id'])
         if not detalle:
+            return None
+        certificacion = detalle.certificacion
+        return {
+            'invoice_id': factura['invoice_id'],
+            'last_modified_time': factura.get('last_modified_time', ''),
+            'invoice_number': detalle.invoice_number,
+            'status': detalle.status,
+            'fel_uuid': certificacion.uuid,
+            'fel_estado': certificacion.estado
+        }
+
+    with ThreadPoolExecutor(max_workers=max(1, hilos)) as executor:
+        descargadas = [fila for fila in executor.map(descargar, por_descargar) if fila]
+    guardar_fel_zoho(descargadas)
+    resultado.update((fila['invoice_id'], fila) for fila in descargadas)
+    return resultado
+
+def verificar_uuids(config, uuids, hilos, usar_cache=True, anulados=()):
+    """Estado en SAT de cada UUID ({uuid: {...}}), consultando a INFILE solo los que no estan verificados.
+
+    anulados son los UUID cuya anulacion acepto INFILE segun el archivo local;
+    como los verificados en cache, no se vuelven a consultar.
+    """
+    opciones = dict(OPCIONES_RECONCILIACION)
+    opciones.update(config.get('reconciliacion', {}))
+    vencimiento = time.time() - float(opciones['vigencia_verificacion_horas']) * 3600
+    resultado = {}
+    if usar_cache:
+        resultado.update((uuid_fel, {'uuid': uuid_fel, 'estado_sat': 'Anulado', 'en_archivo': True})
+                         for uuid_fel in anulados if uuid_fel in uuids)
+        for uuid_fel, fila in uuids_verificados().items():
+            if uuid_fel in uuids and uuid_fel not in resultado and (
+                    fila['estado_sat'] == 'Anulado' or fila['verificado'] > vencimiento):
+                resultado[uuid_fel] = dict(fila, en_cache=True)
+
+    por_consultar = [uuid_fel for uuid_fel in uuids if uuid_fel not in resultado]
+    with ThreadPoolExecutor(max_workers=max(1, hilos)) as executor:
+        consultados = list(executor.map(lambda uuid_fel: consultar_dte_infile(config, uuid_fel), por_consultar))
+    guardar_uuids_verificados(consultados)
+    resultado.update((consulta['uuid'], consulta) for consulta in consultados)
+    return resultado
+
+# Columnas del reporte de conciliacion (CSV y JSON)
+COLUMNAS_RECONCILIACION = ['invoice_id', 'invoice_number', 'uuid', 'status_zoho', 'fel_estado_zoho', 'estado_sat', 'problema']
+
+def reconciliar_fel(config, access_token, hilos=None, usar_cache=True):
+    """Compara el estado FEL de las facturas de Zoho con el registrado en INFILE/SAT.
+
+    Revisa las facturas enviadas o anuladas de la copia local (recien
+    sincronizada) y los DTE que el diario o el archivo local registran como
+    certificados, para encontrar tambien los que nunca se escribieron en Zoho.
+    Devuelve (discrepancias, resumen).
+    """
+    if not config['infile'].get('url_consulta'):
+        raise KeyError("Falta infile.url_consulta en config.json")
+    opciones = dict(OPCIONES_RECONCILIACION)
+    opciones.update(config.get('reconciliacion', {}))
+    hilos = int(hilos or opciones['hilos'])
+
+    sincronizar_zoho(config, access_token)
+    facturas = listar_copia_local('sent') + listar_copia_local('void')
+    zoho = estado_fel_zoho(config, access_token, facturas, hilos)
+    diario = dte_certificados_diario()
+    archivados, anulados = dte_certificados_archivo() if archivo_habilitado(config) else ({}, set())
+    # Si el diario y el archivo difieren, manda el diario (registra cada intento de certificacion)
+    diario = {**archivados, **diario}
+    uuids = {f['fel_uuid'] for f in zoho.values() if f['fel_uuid']} | {d['uuid'] for d in diario.values()}
+    sat = verificar_uuids(config, uuids, hilos, usar_cache, anulados)
+
+    discrepancias = []
+
+    def agregar(invoice_id, invoice_number, uuid_fel, factura, problema):
+        discrepancias.append({
+            'invoice_id': invoice_id,
+            'invoice_number': invoice_number,
+            'uuid': uuid_fel,
+            'status_zoho': factura['status'] if factura else '',
+            'fel_estado_zoho': factura['fel_estado'] if factura else '',
+            'estado_sat': sat.get(uuid_fel, {}).get('estado_sat') or 'Desconocido',
+            'problema': problema
+        })
+
+    for invoice_id, factura in zoho.items():
+        uuid_fel, fel_estado = factura['fel_uuid'], factura['fel_estado']
+        if not uuid_fel or fel_estado not in ('Certificada', 'Anulada'):
             continue
+        estado_sat = sat.get(uuid_fel, {}).get('estado_sat')
+        if estado_sat is None:
+            # Sin respuesta reconocida no se afirma ninguna diferencia: solo se informa
+            problema = f"Estado en SAT desconocido ({sat.get(uuid_fel, {}).get('error') or 'sin respuesta de INFILE'})"
+        elif estado_sat == 'NoExiste':
+            problema = 'UUID desconocido en SAT'
+        elif fel_estado == 'Certificada' and estado_sat == 'Anulado':
+            problema = 'Anulada en SAT pero Certificada en Zoho'
+        elif fel_estado == 'Anulada' and estado_sat == 'Vigente':
+            problema = 'Vigente en SAT pero Anulada en Zoho'
+        elif estado_sat == 'Anulado' and factura['status'] != 'void':
+            problema = 'Anulada en SAT pero la factura no esta anulada (void) en Zoho'
+        else:
+            continue
+        agregar(invoice_id, factura['invoice_number'], uuid_fel, factura, problema)
+
+    # DTE certificados que nunca se escribieron en Zoho (actualizar_factura_zoho fallo)
+    for invoice_id, certificado in diario.items():
+        factura = zoho.get(invoice_id)
+        if factura and factura['fel_uuid'] == certificado['uuid']:
+            continue
+        if sat.get(certificado['uuid'], {}).get('estado_sat') not in ('Vigente', 'Anulado'):
+            continue
+        if factura and factura['fel_uuid']:
+            problema = 'Certificada en SAT con otro UUID que el de Zoho'
+        else:
+            problema = 'Certificada en SAT pero sin datos FEL en Zoho'
+        agregar(invoice_id, certificado['invoice_number'], certificado['uuid'], factura, problema)
+
+    resumen = {
+        'facturas_zoho': len(zoho),
+        'dte_en_diario': len(diario),
+        'uuids': len(uuids),
+        'consultados_infile': sum(1 for v in sat.values() if not v.get('en_cache') and not v.get('en_archivo')),
+        'desde_cache': sum(1 for v in sat.values() if v.get('en_cache')),
+        'desde_archivo': sum(1 for v in sat.values() if v.get('en_archivo')),
+        'desconocidos': sum(1 for v in sat.values() if v.get('estado_sat') is None),
+        'discrepancias': len(discrepancias)
+    }
+    return discrepancias, resumen
 
-        custom_fields = detalle.get('custom_fields', [])
-        fel_uuid = ''
-        fel_estado = ''
-        for cf in custom_fields:
-            label = cf.get('label', '')
-            if label == 'fel_uuid':
-                fel_uuid = cf.get('value', '') or ''
-            elif label == 'fel_estado':
-                fel_estado = cf.get('value', '') or ''
+def escribir_reporte_reconciliacion(discrepancias, resumen, formato, salida):
+    """Escribe las discrepancias como CSV (una fila por factura) o JSON (con el resumen)"""
+    if formato == 'json':
+        json.dump({'resumen': resumen, 'discrepancias': discrepancias}, salida, ensure_ascii=False, indent=2)
+        salida.write('\n')
+        return
+    escritor = csv.DictWriter(salida, fieldnames=COLUMNAS_RECONCILIACION)
+    escritor.writeheader()
+    escritor.writerows(discrepancias)
+
+def ejecutar_tarea(config, access_token, tarea):
+    """Ejecuta una tarea de la bandeja; devuelve True si se completo"""
+    datos = json.loads(tarea['datos'])
+    if tarea['tipo'] == 'pdf':
+        return descargar_y_adjuntar_pdf_fel(config, access_token, tarea['invoice_id'],
+                                            datos['url_pdf'], datos['serie'], datos['numero'], datos['uuid'])
+    if tarea['tipo'] == 'email':
+        return enviar_factura_email(config, access_token, tarea['invoice_id'], datos['emails'],
+                                    datos['datos_certificacion'], datos['cliente'])
+    raise ValueError(f"Tipo de tarea desconocido: {tarea['tipo']}")
+
+def trabajadores_bandeja(config, access_token):
+    """TrabajadoresBandeja que ejecutan las tareas con ejecutar_tarea (sin iniciar)"""
+    return TrabajadoresBandeja(config, functools.partial(ejecutar_tarea, config, access_token))
+
+def listar_facturas_para_anulacion(config, access_token):
+    """Facturas candidatas a anulacion: desde el indice local, o desde Zoho hasta que el indice este completo.
+
+    Con la sincronizacion habilitada, el indice se pone al dia antes con los
+    cambios de Zoho. Sin ella, la primera vez se recorren todas las certificadas
+    de Zoho (tambien las de antes del indice) y cada una se guarda en el indice;
+    al terminar el recorrido queda la marca de indice completo.
+    """
+    if sincronizacion_habilitada(config) and sincronizar_para_menu(config, access_token):
+        yield from listar_certificadas_indice()
+        return
 
-        if fel_uuid and fel_estado == 'Certificada':
-            # Guardar el detalle cacheado para no volver a consultar
-            factura['_detalle'] = detalle
-            factura['_fel_uuid'] = fel_uuid
-            certificadas.append(factura)
+    if indice_completo():
+        if config.get('indice', {}).get('reconciliar_en_segundo_plano', False):
+            iniciar_reconciliacion_indice(config, access_token)
+        yield from listar_certificadas_indice()
+        return
 
-    return certificadas
+    for factura in iterar_facturas_certificadas(config, access_token):
+        registrar_detalle_indice(factura['_factura'])
+        yield factura
+    marcar_indice_completo()
 
 def mostrar_menu_anulacion(facturas):
-    """Muestra el menu de facturas certificadas para anular"""
+    """Muestra el menu de facturas certificadas para anular.
+
+    facturas puede ser un generador: cada fila se imprime en cuanto llega.
+    Devuelve la lista de facturas seleccionadas.
+    """
     print("\n" + "="*70)
     print("      ASISTENTE DE FACTURACION ADSTTER - ANULACION FEL")
     print("="*70)
 
-    if not facturas:
-        print("\nNo hay facturas certificadas para anular.")
-        return []
-
-    print(f"\nFacturas certificadas encontradas: {len(facturas)}\n")
-    print("-"*70)
-    print(f"{'#':<4} {'Numero':<25} {'Cliente':<25} {'UUID FEL':<16}")
-    print("-"*70)
-
+    listadas = []
     for i, factura in enumerate(facturas, 1):
+        if i == 1:
+            print("\n" + "-"*70)
+            print(f"{'#':<4} {'Numero':<25} {'Cliente':<25} {'UUID FEL':<16}")
+            print("-"*70)
         numero = factura.get('invoice_number', 'N/A')
         cliente = factura.get('customer_name', 'N/A')[:23]
         fel_uuid = factura.get('_fel_uuid', '')
         uuid_corto = fel_uuid[:12] + '...' if len(fel_uuid) > 12 else fel_uuid
         print(f"{i:<4} {numero:<25} {cliente:<25} {uuid_corto:<16}")
+        listadas.append(factura)
 
+    if not listadas:
+        print("\nNo hay facturas certificadas para anular.")
+        return []
+
+    print("-"*70)
+    print(f"Facturas certificadas encontradas: {len(listadas)}")
     print("-"*70)
     print("\nOpciones:")
     print("  - Ingrese numeros separados por coma (ej: 1,3,5)")
@@ -742,60 +2197,20 @@ def mostrar_menu_anulacion(facturas):
     print("-"*70)
 
     seleccion = input("\nSeleccione las facturas a anular: ").strip()
+    return seleccionar_facturas(listadas, seleccion)
 
-    if seleccion == '0':
-        return []
-
-    if seleccion.upper() == 'T':
-        return list(range(len(facturas)))
-
-    try:
-        indices = [int(x.strip()) - 1 for x in seleccion.split(',')]
-        indices = [i for i in indices if 0 <= i < len(facturas)]
-        return indices
-    except:
-        print("Seleccion invalida.")
-        return []
-
-def generar_xml_anulacion(config, factura_detalle, contacto):
-    """Genera el XML de anulacion FEL para INFILE"""
+@medir('xml_anulacion')
+def generar_xml_anulacion(config, factura, contacto):
+    """Genera el XML de anulacion FEL para INFILE (Factura certificada y su Contacto)"""
     emisor = config['emisor']
 
     # Obtener datos FEL de la factura certificada
-    custom_fields = factura_detalle.get('custom_fields', [])
-    fel_uuid = ''
-    fel_fecha_certificacion = ''
-    for cf in custom_fields:
-        label = cf.get('label', '')
-        if label == 'fel_uuid':
-            fel_uuid = cf.get('value', '') or ''
-        elif label == 'fel_fecha_certificacion':
-            fel_fecha_certificacion = cf.get('value', '') or ''
-
-    # Reconstruir IDReceptor con la misma logica que generar_xml_factura
-    nit_receptor = ''
-    custom_fields_contacto = contacto.get('custom_fields', [])
-    for cf in custom_fields_contacto:
-        label = cf.get('label', '').upper().strip()
-        if 'NIT' in label or 'ID DE EMPRESA' in label or label in ['TAX ID', 'TAX NUMBER', 'NUMERO FISCAL', 'ID FISCAL', 'RFC', 'RUC', 'RUT', 'ID EMPRESA']:
-            nit_receptor = cf.get('value', '') or ''
-            if nit_receptor and nit_receptor.upper() not in ['N/A', 'CF', '']:
-                break
-
-    if not nit_receptor or nit_receptor.upper() in ['N/A', 'CF', '']:
-        nit_receptor = contacto.get('tax_number', '') or ''
-
-    nit_receptor = ''.join(c for c in str(nit_receptor) if c.isalnum() or c == '-')
-    if not nit_receptor or nit_receptor.upper() in ['CF', 'C/F', 'CONSUMIDORFINAL', 'CONSUMIDOR FINAL', 'N/A']:
-        nit_receptor = 'CF'
-    nit_receptor = nit_receptor.upper()
-
-    # Para exportaciones, el ID del receptor es CF
-    direccion_receptor = contacto.get('billing_address', {}) or {}
-    pais_cliente = (direccion_receptor.get('country', '') or '').strip().lower()
-    paises_locales = ['guatemala', 'gt', 'gua', '']
-    es_exportacion = pais_cliente not in paises_locales
-    id_receptor = "CF" if es_exportacion else nit_receptor
+    certificacion = factura.certificacion
+    fel_uuid = certificacion.uuid
+    fel_fecha_certificacion = certificacion.fecha
+
+    # Mismo IDReceptor que en el XML de certificacion (CF para exportaciones)
+    id_receptor = resolver_receptor(contacto)['id_receptor']
 
     # Fecha y hora actual para la anulacion
     fecha_anulacion = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-06:00')
@@ -815,18 +2230,11 @@ def generar_xml_anulacion(config, factura_detalle, contacto):
 
     return '\n'.join(xml_lines)
 
+@medir('zoho_anulacion')
 def actualizar_factura_zoho_anulacion(config, access_token, invoice_id):
     """Actualiza la factura en Zoho despues de anulacion exitosa en SAT"""
-    org_id = config['zoho']['organization_id']
-    headers = {
-        "Authorization": f"Zoho-oauthtoken {access_token}",
-        "Content-Type": "application/json"
-    }
-    params = {"organization_id": org_id}
-
     # 1. Marcar factura como void en Zoho (debe hacerse ANTES de actualizar campos)
-    url_void = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}/status/void"
-    response_void = requests.post(url_void, headers=headers, params=params)
+    response_void = solicitud_zoho(config, access_token, 'POST', f"invoices/{invoice_id}/status/void")
     if response_void.status_code != 200:
         print(f"   [DEBUG] Error al marcar como void: {response_void.status_code}")
         try:
@@ -838,16 +2246,16 @@ def actualizar_factura_zoho_anulacion(config, access_token, invoice_id):
         return False
 
     print("   Factura marcada como void en Zoho")
+    marcar_anulada_indice(invoice_id)
 
     # 2. Actualizar custom field fel_estado a "Anulada"
-    url_update = f"{config['zoho']['api_domain']}/books/v3/invoices/{invoice_id}"
     data = {
         "reason": "Anulacion FEL en SAT",
         "custom_fields": [
             {"label": "fel_estado", "value": "Anulada"}
         ]
     }
-    response = requests.put(url_update, headers=headers, params=params, json=data)
+    response = solicitud_zoho(config, access_token, 'PUT', f"invoices/{invoice_id}", json=data)
     if response.status_code != 200:
         print(f"   [DEBUG] Error al actualizar fel_estado: {response.status_code}")
         try:
@@ -860,104 +2268,276 @@ def actualizar_factura_zoho_anulacion(config, access_token, invoice_id):
     print("   fel_estado actualizado a: Anulada")
     return True
 
+def procesar_anulacion_factura(config, access_token, factura):
+    """Anula una factura certificada: detalle, contacto, XML de anulacion, INFILE y Zoho.
+
+    Igual que la certificacion, cada etapa queda en el diario y una anulacion
+    interrumpida se retoma con el mismo XML e identificador.
+    Devuelve ('exitosas' | 'fallidas', registro) para el resumen de resultados.
+    """
+    invoice_id = factura.get('invoice_id')
+    invoice_number = factura.get('invoice_number', 'N/A')
+    diario = estado_diario('anulacion', invoice_id)
+    etapa = diario.get('etapa')
+    fel_uuid = factura.get('_fel_uuid', '') or diario.get('uuid', '')
+
+    print(f"\n>> Anulando factura: {invoice_number}")
+    print(f"   UUID: {fel_uuid}")
+    print("-"*50)
+
+    if etapa == 'completado':
+        print("   Ya anulada segun el diario, se omite")
+        return 'exitosas', {'numero': invoice_number, 'uuid': fel_uuid}
+    reanudar = etapa is not None and etapa not in ETAPAS_FINALES_DIARIO
+
+    # Obtener detalle (ya cacheado)
+    detalle = factura.get('_factura')
+    if not detalle:
+        detalle = obtener_factura(config, access_token, invoice_id)
+    if not detalle:
+        print("   ERROR: No se pudo obtener el detalle de la factura")
+        return 'fallidas', {'numero': invoice_number, 'error': 'No se pudo obtener detalle'}
+
+    # Obtener datos del contacto
+    print("   Obteniendo datos del cliente...")
+    contacto = obtener_contacto(config, access_token, detalle.customer_id) or CONTACTO_VACIO
+
+    if reanudar:
+        print(f"   Reanudando desde el diario (ultima etapa: {etapa})")
+        huella_xml, identificador = bytes.fromhex(diario['xml_objeto']), diario['identificador']
+    else:
+        # Generar XML de anulacion (queda en el diario; huella_xml es su SHA-256)
+        print("   Generando XML de anulacion...")
+        huella_xml = guardar_xml_diario([generar_xml_anulacion(config, detalle, contacto).encode('utf-8')])
+        identificador = identificador_estable('ANULA', invoice_id, huella_xml)
+        registrar_etapa('anulacion', invoice_id, invoice_number, 'xml_generado',
+                        identificador=identificador, xml_objeto=huella_xml.hex(), uuid=fel_uuid)
+
+    if etapa in ('anulado', 'zoho_actualizado'):
+        resultado = diario['resultado']
+    else:
+        # Enviar a INFILE (mismo endpoint de certificacion)
+        registrar_etapa('anulacion', invoice_id, invoice_number, 'enviado_infile')
+        print("   Enviando a INFILE para anulacion...")
+        with open(ruta_xml_diario(huella_xml), 'rb') as archivo_xml:
+            resultado = certificar_factura_infile(config, archivo_xml, identificador)
+        if resultado.get('resultado') == True:
+            registrar_etapa('anulacion', invoice_id, invoice_number, 'anulado', resultado=resultado)
+        elif not resultado.get('error_http'):
+            registrar_etapa('anulacion', invoice_id, invoice_number, 'rechazado', error=resultado.get('descripcion', ''))
+            descartar_xml_diario(huella_xml)
+
+    if resultado.get('resultado') == True:
+        print(f"   ANULADA EXITOSAMENTE EN SAT!")
+        archivar_anulacion(config, fel_uuid, huella_xml, resultado)
+
+        # Actualizar Zoho
+        if etapa == 'zoho_actualizado' and diario.get('exito_zoho'):
+            exito = True
+        else:
+            print("   Actualizando factura en Zoho...")
+            exito = actualizar_factura_zoho_anulacion(config, access_token, invoice_id)
+            registrar_etapa('anulacion', invoice_id, invoice_number, 'zoho_actualizado', exito_zoho=exito)
+        if not exito:
+            print("   AVISO: No se pudo actualizar Zoho, pero la factura SI fue anulada en SAT")
+        registrar_etapa('anulacion', invoice_id, invoice_number, 'completado')
+        descartar_xml_diario(huella_xml)
+
+        return 'exitosas', {
+            'numero': invoice_number,
+            'uuid': fel_uuid
+        }
+    else:
+        error = resultado.get('descripcion', 'Error desconocido')
+        errores_detalle = resultado.get('descripcion_errores', [])
+
+        print(f"   ERROR EN ANULACION:")
+        print(f"   {error}")
+        if errores_detalle:
+            for err in errores_detalle[:5]:
+                if isinstance(err, dict):
+                    msg = err.get('mensaje_error', '')
+                    cat = err.get('categoria', '')
+                    print(f"   - [{cat}] {msg}")
+                else:
+                    print(f"   - {err}")
+
+        return 'fallidas', {
+            'numero': invoice_number,
+            'error': error
+        }
+
+
+def _registro_fallido(factura, error):
+    return 'fallidas', {'numero': factura.get('invoice_number', 'N/A'), 'error': str(error)}
+
+class Precargador:
+    """Carga en segundo plano la Factura ('_factura') y el contacto (cache de contactos) de las facturas del lote.
+
+    Un hilo recorre las facturas en orden y se mantiene hasta 'profundidad'
+    facturas por delante de las que ya tomo el procesamiento, asi la espera
+    de Zoho de la siguiente factura se solapa con la de INFILE de la actual.
+    Si la precarga falla, la factura se carga como siempre al procesarla.
+    """
+
+    def __init__(self, config, access_token, facturas, profundidad=None):
+        opciones = dict(OPCIONES_PRECARGA)
+        opciones.update(config.get('precarga', {}))
+        self.config = config
+        self.access_token = access_token
+        self.profundidad = int(opciones['profundidad'] if profundidad is None else profundidad)
+        self.facturas = list(facturas) if self.profundidad > 0 else []
+        self.espacio = threading.Semaphore(self.profundidad)
+        self.cargas = {}
+        self.lock = threading.Lock()
+        self.detenido = threading.Event()
+        self.hilo = threading.Thread(target=self.ejecutar, name='precarga', daemon=True)
+
+    def iniciar(self):
+        if len(self.facturas) > 1:
+            self.hilo.start()
+        return self
+
+    def ejecutar(self):
+        with capturar_salida(io.StringIO()):
+            for factura in self.facturas:
+                self.espacio.acquire()
+                if self.detenido.is_set():
+                    return
+                with self.lock:
+                    if id(factura) in self.cargas:
+                        continue
+                    lista = self.cargas[id(factura)] = threading.Event()
+                try:
+                    self.cargar(factura)
+                except Exception:
+                    pass
+                finally:
+                    lista.set()
+
+    def cargar(self, factura):
+        detalle = factura.get('_factura')
+        if not detalle:
+            detalle = obtener_factura(self.config, self.access_token, factura['invoice_id'])
+            if not detalle:
+                return
+            factura['_factura'] = detalle
+        if detalle.customer_id:
+            obtener_contacto(self.config, self.access_token, detalle.customer_id)
+
+    def tomar(self, factura):
+        """Llamar al empezar a procesar la factura: espera su precarga si esta en curso y libera un lugar"""
+        with self.lock:
+            lista = self.cargas.get(id(factura))
+            if lista is None:
+                self.cargas[id(factura)] = None
+        self.espacio.release()
+        if lista is not None:
+            lista.wait()
+
+    def detener(self):
+        self.detenido.set()
+        self.espacio.release()
+
+def certificar_lote(config, access_token, facturas, al_completar=None):
+    """Certifica las facturas (con la concurrencia del config) y devuelve [(factura, clave, registro)] en orden.
+
+    El detalle y el contacto de las siguientes facturas se precargan mientras
+    se certifica la actual (ver Precargador).
+    """
+    limites = configurar_concurrencia(config)
+    precarga = Precargador(config, access_token, facturas).iniciar()
+
+    def certificar(factura):
+        precarga.tomar(factura)
+        with tramo('certificacion', factura=factura.get('invoice_number', 'N/A')):
+            return procesar_factura_certificacion(config, access_token, factura)
+
+    try:
+        resultados = ejecutar_lote(certificar, facturas, int(limites['facturas']), _registro_fallido, al_completar)
+    finally:
+        precarga.detener()
+    return [(factura, clave, registro) for factura, (clave, registro) in zip(facturas, resultados)]
+
+def anular_lote(config, access_token, facturas, al_completar=None):
+    """Anula las facturas (con la concurrencia del config) y devuelve [(factura, clave, registro)] en orden.
+
+    Hasta 'anulaciones' facturas avanzan a la vez; las llamadas a INFILE y
+    Zoho siguen limitadas por servicio y por el limitador de Zoho. Como al
+    certificar, el detalle y el contacto de las siguientes se precargan.
+    Una anulacion en SAT no se puede deshacer: si la misma factura viene dos
+    veces en la seleccion, la segunda espera a la primera y la ve completada
+    en el diario.
+    """
+    limites = configurar_concurrencia(config)
+    precarga = Precargador(config, access_token, facturas).iniciar()
+    candados = {factura.get('invoice_id'): threading.Lock() for factura in facturas}
+
+    def anular(factura):
+        precarga.tomar(factura)
+        with candados[factura.get('invoice_id')], tramo('anulacion', factura=factura.get('invoice_number', 'N/A')):
+            return procesar_anulacion_factura(config, access_token, factura)
+
+    try:
+        resultados = ejecutar_lote(anular, facturas, int(limites['anulaciones']), _registro_fallido, al_completar)
+    finally:
+        precarga.detener()
+    return [(factura, clave, registro) for factura, (clave, registro) in zip(facturas, resultados)]
+
+def ofrecer_reanudacion(operacion):
+    """Si el diario tiene facturas a medias de la operacion, pregunta si se retoman; devuelve la lista o None"""
+    pendientes = pendientes_diario(operacion)
+    if not pendientes:
+        return None
+    print(f"\n*** {len(pendientes)} factura(s) quedaron a medias en una ejecucion anterior ({operacion}) ***")
+    for factura in pendientes:
+        print(f"  {factura['invoice_number']:<30} ultima etapa: {factura['_etapa']}")
+    if input("Reanudarlas ahora? (S/n): ").strip().lower() in ('', 's', 'si'):
+        return pendientes
+    return None
+
 def flujo_anulacion(config, access_token):
     """Flujo completo de anulacion de facturas certificadas"""
-    print("\nObteniendo facturas certificadas...")
-    facturas = obtener_facturas_certificadas(config, access_token)
-    indices_seleccionados = mostrar_menu_anulacion(facturas)
+    seleccionadas = ofrecer_reanudacion('anulacion')
+    if seleccionadas is None:
+        print("\nObteniendo facturas certificadas...")
+        seleccionadas = mostrar_menu_anulacion(listar_facturas_para_anulacion(config, access_token))
 
-    if not indices_seleccionados:
+    if not seleccionadas:
         return
 
     # Confirmar anulacion
-    print(f"\n*** ATENCION: Se anularan {len(indices_seleccionados)} factura(s) en SAT ***")
+    print(f"\n*** ATENCION: Se anularan {len(seleccionadas)} factura(s) en SAT ***")
     confirmar = input("Escriba 'SI' para confirmar: ").strip()
     if confirmar != 'SI':
         print("Anulacion cancelada.")
         return
 
     print(f"\n{'='*70}")
-    print(f"Anulando {len(indices_seleccionados)} factura(s)...")
+    print(f"Anulando {len(seleccionadas)} factura(s)...")
     print(f"{'='*70}\n")
 
+    estadisticas_cache = _cache_contactos.estadisticas()
+    cuota_zoho = estadisticas_cuota_zoho()
+
     resultados = {
         'exitosas': [],
         'fallidas': []
     }
 
-    for idx in indices_seleccionados:
-        factura = facturas[idx]
-        invoice_id = factura.get('invoice_id')
-        invoice_number = factura.get('invoice_number', 'N/A')
-        fel_uuid = factura.get('_fel_uuid', '')
-
-        print(f"\n>> Anulando factura: {invoice_number}")
-        print(f"   UUID: {fel_uuid}")
-        print("-"*50)
-
-        # Obtener detalle (ya cacheado)
-        detalle = factura.get('_detalle')
-        if not detalle:
-            detalle = obtener_detalle_factura(config, access_token, invoice_id)
-        if not detalle:
-            print("   ERROR: No se pudo obtener el detalle de la factura")
-            resultados['fallidas'].append({'numero': invoice_number, 'error': 'No se pudo obtener detalle'})
-            continue
-
-        # Obtener datos del contacto
-        contact_id = detalle.get('customer_id')
-        print("   Obteniendo datos del cliente...")
-        contacto = obtener_contacto(config, access_token, contact_id) or {}
-
-        # Generar XML de anulacion
-        print("   Generando XML de anulacion...")
-        xml_content = generar_xml_anulacion(config, detalle, contacto)
-
-        # Enviar a INFILE (mismo endpoint de certificacion)
-        identificador = f"ANULA_{invoice_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        print("   Enviando a INFILE para anulacion...")
-        resultado = certificar_factura_infile(config, xml_content, identificador)
-
-        if resultado.get('resultado') == True:
-            print(f"   ANULADA EXITOSAMENTE EN SAT!")
-
-            # Actualizar Zoho
-            print("   Actualizando factura en Zoho...")
-            exito = actualizar_factura_zoho_anulacion(config, access_token, invoice_id)
-            if not exito:
-                print("   AVISO: No se pudo actualizar Zoho, pero la factura SI fue anulada en SAT")
-
-            resultados['exitosas'].append({
-                'numero': invoice_number,
-                'uuid': fel_uuid
-            })
-        else:
-            error = resultado.get('descripcion', 'Error desconocido')
-            errores_detalle = resultado.get('descripcion_errores', [])
-
-            print(f"   ERROR EN ANULACION:")
-            print(f"   {error}")
-            if errores_detalle:
-                for err in errores_detalle[:5]:
-                    if isinstance(err, dict):
-                        msg = err.get('mensaje_error', '')
-                        cat = err.get('categoria', '')
-                        print(f"   - [{cat}] {msg}")
-                    else:
-                        print(f"   - {err}")
-
-            resultados['fallidas'].append({
-                'numero': invoice_number,
-                'error': error
-            })
+    for _, clave, registro in anular_lote(config, access_token, seleccionadas):
+        resultados[clave].append(registro)
 
     # Resumen
     print("\n" + "="*70)
     print("                    RESUMEN ANULACION")
     print("="*70)
-    print(f"\nFacturas procesadas: {len(indices_seleccionados)}")
+    print(f"\nFacturas procesadas: {len(seleccionadas)}")
     print(f"Anuladas: {len(resultados['exitosas'])}")
     print(f"Fallidas: {len(resultados['fallidas'])}")
+    imprimir_estadisticas_cache(estadisticas_cache)
+    imprimir_cuota_zoho(cuota_zoho)
+    imprimir_resumen_tramos()
 
     if resultados['exitosas']:
         print("\n--- Facturas Anuladas ---")
@@ -971,179 +2551,285 @@ def flujo_anulacion(config, access_token):
 
     print("\n" + "="*70)
 
-def flujo_certificacion(config, access_token):
-    """Flujo completo de certificacion de facturas borrador"""
-    print("Obteniendo facturas en borrador...")
-
-    facturas = obtener_facturas_borrador(config, access_token)
-    indices_seleccionados = mostrar_menu_facturas(facturas)
-
-    if not indices_seleccionados:
-        return
-
-    print(f"\n{'='*70}")
-    print(f"Procesando {len(indices_seleccionados)} factura(s)...")
-    print(f"{'='*70}\n")
-
-    resultados = {
-        'exitosas': [],
-        'fallidas': []
-    }
-
-    for idx in indices_seleccionados:
-        factura = facturas[idx]
-        invoice_id = factura.get('invoice_id')
-        invoice_number = factura.get('invoice_number', 'N/A')
-
-        print(f"\n>> Procesando factura: {invoice_number}")
-        print("-"*50)
+def procesar_factura_certificacion(config, access_token, factura):
+    """Certifica una factura borrador: detalle, contacto, XML, INFILE, Zoho, PDF y email.
+
+    Cada etapa queda en el diario; si una ejecucion anterior se corto, se
+    continua desde la ultima etapa registrada reenviando el mismo XML (mismo
+    identificador), asi INFILE nunca emite un segundo DTE para la factura.
+    Devuelve ('exitosas' | 'fallidas', registro) para el resumen de resultados.
+    """
+    invoice_id = factura.get('invoice_id')
+    invoice_number = factura.get('invoice_number', 'N/A')
+
+    print(f"\n>> Procesando factura: {invoice_number}")
+    print("-"*50)
+
+    diario = estado_diario('certificacion', invoice_id)
+    etapa = diario.get('etapa')
+    if etapa == 'completado':
+        resultado = diario.get('resultado', {})
+        print(f"   Ya certificada segun el diario (UUID: {resultado.get('uuid', '')}), se omite")
+        return 'exitosas', {
+            'numero': invoice_number,
+            'uuid': resultado.get('uuid', ''),
+            'serie': resultado.get('serie', ''),
+            'numero_fel': resultado.get('numero', '')
+        }
+    reanudar = etapa is not None and etapa not in ETAPAS_FINALES_DIARIO
 
-        # Obtener detalle completo
+    # Obtener detalle completo (puede venir ya cargado en '_factura')
+    detalle = factura.get('_factura')
+    if not detalle:
         print("   Obteniendo detalle de factura...")
-        detalle = obtener_detalle_factura(config, access_token, invoice_id)
-        if not detalle:
-            print("   ERROR: No se pudo obtener el detalle de la factura")
-            resultados['fallidas'].append({'numero': invoice_number, 'error': 'No se pudo obtener detalle'})
-            continue
-
-        # Obtener datos del contacto
-        contact_id = detalle.get('customer_id')
-        print("   Obteniendo datos del cliente...")
-        contacto = obtener_contacto(config, access_token, contact_id) or {}
+        detalle = obtener_factura(config, access_token, invoice_id)
+    if not detalle:
+        print("   ERROR: No se pudo obtener el detalle de la factura")
+        return 'fallidas', {'numero': invoice_number, 'error': 'No se pudo obtener detalle'}
 
-        # Detectar si es exportación (para no aplicar limite CF)
-        # Si el país está vacío, asumir que es LOCAL (Guatemala)
-        direccion_cliente = contacto.get('billing_address', {}) or {}
-        pais_cliente = (direccion_cliente.get('country', '') or '').strip().lower()
-        # Lista de valores que indican Guatemala o local
-        paises_locales = ['guatemala', 'gt', 'gua', '']
-        es_exportacion = pais_cliente not in paises_locales
+    # Obtener datos del contacto
+    contact_id = detalle.customer_id
+    print("   Obteniendo datos del cliente...")
+    contacto = obtener_contacto(config, access_token, contact_id) or CONTACTO_VACIO
 
-        if es_exportacion:
-            print(f"   [INFO] Factura de EXPORTACION detectada (pais: {pais_cliente})")
-
-        # Validar NIT para montos altos (solo aplica a ventas locales)
-        # SIEMPRE buscar primero en campos personalizados (tienen prioridad)
-        nit_cliente = ''
-        custom_fields_contacto = contacto.get('custom_fields', [])
-        for cf in custom_fields_contacto:
-            label = cf.get('label', '').upper().strip()
-            # Buscar cualquier campo que contenga "NIT" o sea identificador fiscal
-            # Incluye "ID DE EMPRESA" que es donde Zoho guarda el NIT
-            if 'NIT' in label or 'ID DE EMPRESA' in label or label in ['TAX ID', 'TAX NUMBER', 'NUMERO FISCAL', 'ID FISCAL', 'RFC', 'RUC', 'RUT', 'ID EMPRESA']:
-                nit_cliente = cf.get('value', '') or ''
-                if nit_cliente and nit_cliente.upper() not in ['N/A', 'CF', '']:
-                    break
+    # Detectar si es exportación (para no aplicar limite CF) y si el cliente es consumidor final
+    receptor = resolver_receptor(contacto)
+    es_exportacion = receptor['es_exportacion']
 
-        # Si no hay NIT en campos personalizados, usar tax_number como fallback
-        if not nit_cliente or nit_cliente.upper() in ['N/A', 'CF', '']:
-            nit_cliente = contacto.get('tax_number', '') or ''
-
-        total_factura = float(detalle.get('total', 0))
-        moneda_factura = detalle.get('currency_code', 'GTQ')
-
-        # Limite para CF en Guatemala es Q2,500 (no aplica a exportaciones)
-        LIMITE_CF_GTQ = 2500.00
-
-        es_consumidor_final = not nit_cliente or nit_cliente.upper() in ['CF', 'C/F', 'N/A', '']
-
-        # La validación de límite CF solo aplica a ventas LOCALES, no a exportaciones
-        if es_consumidor_final and moneda_factura == 'GTQ' and total_factura > LIMITE_CF_GTQ and not es_exportacion:
-            print(f"   ERROR: Factura a Consumidor Final excede limite de Q{LIMITE_CF_GTQ:,.2f}")
-            print(f"   Total: Q{total_factura:,.2f} - Se requiere NIT del cliente")
-            print(f"   >> Configura el NIT del cliente '{detalle.get('customer_name', 'N/A')}' en Zoho Books")
-            resultados['fallidas'].append({
-                'numero': invoice_number,
-                'error': f'CF excede limite Q{LIMITE_CF_GTQ}. Configura NIT en Zoho.'
-            })
-            continue
+    if es_exportacion:
+        print(f"   [INFO] Factura de EXPORTACION detectada (pais: {receptor['pais']})")
+
+    total_factura = detalle.total
+    moneda_factura = detalle.currency_code
+
+    es_consumidor_final = receptor['es_consumidor_final']
+
+    # La validación de límite CF solo aplica a ventas LOCALES, no a exportaciones
+    # (al reanudar, el XML ya paso esta validacion)
+    if es_consumidor_final and moneda_factura == 'GTQ' and total_factura > LIMITE_CF_GTQ and not es_exportacion and not reanudar:
+        print(f"   ERROR: Factura a Consumidor Final excede limite de Q{LIMITE_CF_GTQ:,.2f}")
+        print(f"   Total: Q{total_factura:,.2f} - Se requiere NIT del cliente")
+        print(f"   >> Configura el NIT del cliente '{detalle.customer_name or 'N/A'}' en Zoho Books")
+        return 'fallidas', {
+            'numero': invoice_number,
+            'error': f'CF excede limite Q{LIMITE_CF_GTQ}. Configura NIT en Zoho.'
+        }
 
-        # Generar XML
+    # NIT y nombre legal del cliente segun SAT (consulta en cache por vigencia_horas)
+    nombre_receptor = None
+    if not reanudar and requiere_verificacion_nit(config, receptor):
+        verificacion = verificar_nit(config, receptor['nit'])
+        if verificacion and not verificacion['encontrado']:
+            print(f"   ERROR: El NIT {receptor['nit']} no esta registrado en SAT")
+            print(f"   >> Corrija el NIT del cliente '{detalle.customer_name or 'N/A'}' en Zoho Books")
+            return 'fallidas', {'numero': invoice_number, 'error': f"NIT {receptor['nit']} no registrado en SAT. Corrija el NIT en Zoho."}
+        if verificacion:
+            nombre_receptor = verificacion['nombre']
+            print(f"   NIT verificado en SAT: {nombre_receptor}")
+
+    if reanudar:
+        # Mismo XML y mismo identificador que el intento interrumpido
+        print(f"   Reanudando desde el diario (ultima etapa: {etapa})")
+        huella_xml, identificador = bytes.fromhex(diario['xml_objeto']), diario['identificador']
+    else:
+        # Generar XML (queda en el diario; huella_xml es su SHA-256)
         print("   Generando XML FEL...")
-        xml_content = generar_xml_factura(config, detalle, contacto)
-
-        # Generar identificador unico
-        identificador = f"ADSTTER_{invoice_number}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        huella_xml = guardar_xml_factura(config, detalle, contacto, nombre_receptor=nombre_receptor)
+        identificador = identificador_estable('ADSTTER', invoice_id, huella_xml)
+        registrar_etapa('certificacion', invoice_id, invoice_number, 'xml_generado',
+                        identificador=identificador, xml_objeto=huella_xml.hex())
 
+    if etapa in ('certificado', 'zoho_actualizado'):
+        resultado_cert = diario['resultado']
+    else:
         # Certificar con INFILE
+        registrar_etapa('certificacion', invoice_id, invoice_number, 'enviado_infile')
         print("   Enviando a INFILE para certificacion...")
-        resultado_cert = certificar_factura_infile(config, xml_content, identificador)
-
+        with open(ruta_xml_diario(huella_xml), 'rb') as archivo_xml:
+            resultado_cert = certificar_factura_infile(config, archivo_xml, identificador)
         if resultado_cert.get('resultado') == True:
-            uuid_fel = resultado_cert.get('uuid', '')
-            serie = resultado_cert.get('serie', '')
-            numero = resultado_cert.get('numero', '')
-            # Construir URL del PDF de INFILE usando el UUID
-            url_pdf = f"https://report.feel.com.gt/ingfacereport/ingfacereport_documento?uuid={uuid_fel}"
-            url_xml = f"https://report.feel.com.gt/ingfacereport/ingfacereport_documento?uuid={uuid_fel}"
-
-            print(f"   CERTIFICADA EXITOSAMENTE!")
-            print(f"   UUID: {uuid_fel}")
-            print(f"   Serie: {serie} | Numero: {numero}")
-            print(f"   Ver PDF: {url_pdf}")
-
-            # Guardar URLs en resultado para usar en actualizacion
-            resultado_cert['url_pdf_infile'] = url_pdf
-            resultado_cert['url_xml_infile'] = url_xml
-
-            # DEBUG: Mostrar todos los campos de la respuesta de INFILE
-            print(f"   [DEBUG] Campos INFILE: {list(resultado_cert.keys())}")
-
-            # Actualizar factura en Zoho (esto tambien marca como enviada)
+            registrar_etapa('certificacion', invoice_id, invoice_number, 'certificado', resultado=resultado_cert)
+        elif not resultado_cert.get('error_http'):
+            registrar_etapa('certificacion', invoice_id, invoice_number, 'rechazado',
+                            error=resultado_cert.get('descripcion', ''))
+            descartar_xml_diario(huella_xml)
+
+    if resultado_cert.get('resultado') == True:
+        uuid_fel = resultado_cert.get('uuid', '')
+        serie = resultado_cert.get('serie', '')
+        numero = resultado_cert.get('numero', '')
+        # Construir URL del PDF de INFILE usando el UUID
+        url_pdf = url_documento_infile(config, uuid_fel)
+        url_xml = url_documento_infile(config, uuid_fel)
+
+        print(f"   CERTIFICADA EXITOSAMENTE!")
+        print(f"   UUID: {uuid_fel}")
+        print(f"   Serie: {serie} | Numero: {numero}")
+        print(f"   Ver PDF: {url_pdf}")
+        archivar_certificacion(config, detalle, receptor, huella_xml, resultado_cert)
+
+        # Guardar URLs en resultado para usar en actualizacion
+        resultado_cert['url_pdf_infile'] = url_pdf
+        resultado_cert['url_xml_infile'] = url_xml
+
+        # DEBUG: Mostrar todos los campos de la respuesta de INFILE
+        print(f"   [DEBUG] Campos INFILE: {list(resultado_cert.keys())}")
+
+        # Actualizar factura en Zoho (esto tambien marca como enviada)
+        if etapa == 'zoho_actualizado' and diario.get('exito_zoho'):
+            exito_actualizacion = True
+        else:
             print("   Actualizando factura en Zoho...")
             exito_actualizacion = actualizar_factura_zoho(config, access_token, invoice_id, resultado_cert)
+            registrar_etapa('certificacion', invoice_id, invoice_number, 'zoho_actualizado', exito_zoho=exito_actualizacion)
 
-            if not exito_actualizacion:
-                print("   AVISO: No se pudo actualizar numero/fecha en Zoho, pero la factura SI fue certificada en SAT")
+        if not exito_actualizacion:
+            print("   AVISO: No se pudo actualizar numero/fecha en Zoho, pero la factura SI fue certificada en SAT")
 
-            # Descargar PDF de INFILE y adjuntar a la factura en Zoho
-            descargar_y_adjuntar_pdf_fel(config, access_token, invoice_id, url_pdf, serie, numero)
+        # Registrar en el indice local para que el menu de anulacion no tenga que consultar Zoho
+        numero_zoho = f"Serie: {serie} Numero de DTE: {numero}" if exito_actualizacion and serie and numero else invoice_number
+        certificacion = DatosCertificacion.desde_infile(resultado_cert)
+        registrar_factura_indice(invoice_id, numero_zoho, contact_id, detalle.customer_name, certificacion)
 
-            # Enviar por email con datos de certificacion
-            emails = contacto.get('email', '')
-            if emails:
-                print(f"   Enviando por email a: {emails}")
-                enviar_factura_email(config, access_token, invoice_id, emails, resultado_cert, contacto)
-            else:
-                print("   AVISO: El cliente no tiene email configurado")
+        # El PDF y el email quedan en la bandeja de salida; los envian los trabajadores de fondo
+        emails = contacto.email
+        encolar_pdf_y_email(invoice_id, numero_zoho, url_pdf, certificacion, emails, datos_cliente_email(contacto))
+        if emails:
+            print(f"   PDF y email a {emails} en la bandeja de salida")
+        else:
+            print("   PDF en la bandeja de salida")
+            print("   AVISO: El cliente no tiene email configurado")
+        registrar_etapa('certificacion', invoice_id, invoice_number, 'completado')
+        descartar_xml_diario(huella_xml)
+
+        return 'exitosas', {
+            'numero': invoice_number,
+            'uuid': uuid_fel,
+            'serie': serie,
+            'numero_fel': numero
+        }
+    else:
+        error = resultado_cert.get('descripcion', 'Error desconocido')
+        errores_detalle = resultado_cert.get('descripcion_errores', [])
+
+        print(f"   ERROR EN CERTIFICACION:")
+        print(f"   {error}")
+        if errores_detalle:
+            for err in errores_detalle[:5]:  # Mostrar max 5 errores
+                if isinstance(err, dict):
+                    msg = err.get('mensaje_error', '')
+                    cat = err.get('categoria', '')
+                    print(f"   - [{cat}] {msg}")
+                else:
+                    print(f"   - {err}")
+
+        # Mostrar info del cliente para depuracion
+        print(f"   [DEBUG] Cliente: {contacto.contact_name or 'N/A'}")
+        print(f"   [DEBUG] NIT: {contacto.tax_number or 'N/A'}")
+
+        return 'fallidas', {
+            'numero': invoice_number,
+            'error': error
+        }
 
-            resultados['exitosas'].append({
-                'numero': invoice_number,
-                'uuid': uuid_fel,
-                'serie': serie,
-                'numero_fel': numero
-            })
+
+def prevalidar_facturas(config, access_token, facturas):
+    """Revision de toda la seleccion antes de certificar en INFILE.
+
+    Descarga en paralelo el detalle y el contacto de cada factura (la Factura
+    queda en '_factura' para no pedirla otra vez al certificar), aplica
+    validar_factura_local y verifica en SAT el NIT de las que no tienen errores.
+    Devuelve (errores_emisor, [{'factura', 'errores', 'avisos'}]).
+    """
+    hilos = int(config.get('concurrencia', {}).get('zoho', LIMITES_CONCURRENCIA['zoho']))
+
+    def revisar(factura):
+        try:
+            detalle = factura.get('_factura') or obtener_factura(config, access_token, factura['invoice_id'])
+            if not detalle:
+                return {'factura': factura, 'errores': ["No se pudo obtener el detalle de la factura"], 'avisos': []}
+            factura['_factura'] = detalle
+            contacto = obtener_contacto(config, access_token, detalle.customer_id)
+        except requests.RequestException as e:
+            return {'factura': factura, 'errores': [f"Error de conexion: {e}"], 'avisos': []}
+        errores, avisos = validar_factura_local(detalle, contacto)
+        if contacto and not errores:
+            errores_nit, avisos_nit = validar_nit_sat(config, contacto)
+            errores += errores_nit
+            avisos += avisos_nit
+        return {'factura': factura, 'errores': errores, 'avisos': avisos}
+
+    with ThreadPoolExecutor(max_workers=max(1, hilos)) as executor:
+        revisiones = list(executor.map(revisar, facturas))
+    return validar_emisor(config), revisiones
+
+def imprimir_prevalidacion(errores_emisor, revisiones):
+    """Reporte consolidado de la prevalidacion; devuelve las facturas sin errores"""
+    validas = [r['factura'] for r in revisiones if not r['errores']]
+    print(f"\n--- Prevalidacion: {len(validas)} de {len(revisiones)} factura(s) sin errores ---")
+    for error in errores_emisor:
+        print(f"  [EMISOR] {error}")
+    for revision in revisiones:
+        if not revision['errores'] and not revision['avisos']:
+            continue
+        numero = revision['factura'].get('invoice_number', 'N/A')
+        for error in revision['errores']:
+            print(f"  {numero:<20} ERROR: {error}")
+        for aviso in revision['avisos']:
+            print(f"  {numero:<20} aviso: {aviso}")
+    return validas
+
+def flujo_certificacion(config, access_token):
+    """Flujo completo de certificacion de facturas borrador"""
+    seleccionadas = ofrecer_reanudacion('certificacion')
+    if seleccionadas is None:
+        if sincronizacion_habilitada(config) and sincronizar_para_menu(config, access_token):
+            borradores = listar_copia_local('draft')
         else:
-            error = resultado_cert.get('descripcion', 'Error desconocido')
-            errores_detalle = resultado_cert.get('descripcion_errores', [])
-
-            print(f"   ERROR EN CERTIFICACION:")
-            print(f"   {error}")
-            if errores_detalle:
-                for err in errores_detalle[:5]:  # Mostrar max 5 errores
-                    if isinstance(err, dict):
-                        msg = err.get('mensaje_error', '')
-                        cat = err.get('categoria', '')
-                        print(f"   - [{cat}] {msg}")
-                    else:
-                        print(f"   - {err}")
-
-            # Mostrar info del cliente para depuracion
-            print(f"   [DEBUG] Cliente: {contacto.get('contact_name', 'N/A')}")
-            print(f"   [DEBUG] NIT: {contacto.get('tax_number', 'N/A')}")
-
-            resultados['fallidas'].append({
-                'numero': invoice_number,
-                'error': error
-            })
+            print("Obteniendo facturas en borrador...")
+            borradores = paginar_facturas(config, access_token, 'draft')
+        seleccionadas = mostrar_menu_facturas(borradores)
+        if seleccionadas:
+            print(f"\nRevisando {len(seleccionadas)} factura(s) antes de enviar a INFILE...")
+            errores_emisor, revisiones = prevalidar_facturas(config, access_token, seleccionadas)
+            validas = imprimir_prevalidacion(errores_emisor, revisiones)
+            if errores_emisor:
+                print("Corrija la configuracion del emisor antes de certificar.")
+                return
+            if len(validas) < len(seleccionadas):
+                if not validas or input(f"Certificar solo las {len(validas)} factura(s) sin errores? (S/n): ").strip().lower() not in ('', 's', 'si'):
+                    print("Certificacion cancelada.")
+                    return
+            seleccionadas = validas
+
+    if not seleccionadas:
+        return
+
+    print(f"\n{'='*70}")
+    print(f"Procesando {len(seleccionadas)} factura(s)...")
+    print(f"{'='*70}\n")
+
+    resultados = {
+        'exitosas': [],
+        'fallidas': []
+    }
+
+    estadisticas_cache = _cache_contactos.estadisticas()
+    cuota_zoho = estadisticas_cuota_zoho()
+    for _, clave, registro in certificar_lote(config, access_token, seleccionadas):
+        resultados[clave].append(registro)
 
     # Resumen final
     print("\n" + "="*70)
     print("                         RESUMEN")
     print("="*70)
-    print(f"\nFacturas procesadas: {len(indices_seleccionados)}")
+    print(f"\nFacturas procesadas: {len(seleccionadas)}")
     print(f"Exitosas: {len(resultados['exitosas'])}")
     print(f"Fallidas: {len(resultados['fallidas'])}")
+    imprimir_estadisticas_cache(estadisticas_cache)
+    imprimir_cuota_zoho(cuota_zoho)
+    imprimir_resumen_bandeja()
+    imprimir_resumen_tramos()
 
     if resultados['exitosas']:
         print("\n--- Facturas Certificadas ---")
@@ -1157,6 +2843,45 @@ def flujo_certificacion(config, access_token):
 
     print("\n" + "="*70)
 
+def certificar_desde_webhook(config, access_token, invoice_id, factura=None):
+    """Certifica una factura recibida por webhook; devuelve (clave, registro) como procesar_factura_certificacion.
+
+    Si llego solo el invoice_id se carga el detalle y se omiten las que ya no estan en borrador.
+    """
+    try:
+        if factura is None:
+            detalle = obtener_factura(config, access_token, invoice_id)
+            if detalle is None:
+                return 'fallidas', {'numero': invoice_id, 'error': 'No se pudo obtener detalle'}
+            if detalle.status != 'draft':
+                # Los webhooks de edicion tambien llegan para facturas ya certificadas
+                return 'omitidas', {'numero': detalle.invoice_number,
+                                    'error': f"No esta en borrador (status: {detalle.status})"}
+            factura = {
+                'invoice_id': invoice_id,
+                'invoice_number': detalle.invoice_number,
+                'customer_name': detalle.customer_name,
+                '_factura': detalle
+            }
+        with tramo('certificacion', factura=factura['invoice_number']):
+            return procesar_factura_certificacion(config, access_token, factura)
+    except Exception as e:
+        return _registro_fallido(factura or {'invoice_number': invoice_id}, e)
+
+def servicio_webhook(config, access_token, al_completar=None, **opciones):
+    """ServicioWebhook que certifica con certificar_desde_webhook (sin iniciar)"""
+    return ServicioWebhook(config, functools.partial(certificar_desde_webhook, config, access_token),
+                           al_completar, **opciones)
+
+def inicializar(config, archivo_traza=None):
+    """Aplica las secciones de rendimiento del config (http, concurrencia, limite de Zoho, cache de contactos, traza)"""
+    instalar_salida_por_hilo()
+    configurar_http(config)
+    configurar_concurrencia(config)
+    configurar_limite_zoho(config)
+    configurar_cache_contactos(config)
+    configurar_traza(config, archivo_traza)
+
 def main():
     """Funcion principal del asistente"""
     print("\nCargando configuracion...")
@@ -1168,20 +2893,29 @@ def main():
         input("\nPresione Enter para salir...")
         return
 
+    inicializar(config)
+
     ambiente = config['infile'].get('ambiente', 'PRUEBAS')
     print(f"\n*** AMBIENTE: {ambiente} ***")
     if ambiente == 'PRUEBAS':
         print("*** Las facturas NO tendran validez fiscal ***\n")
 
     print("Conectando con Zoho Books...")
-    access_token = obtener_access_token(config)
+    access_token = GestorToken(config)
 
-    if not access_token:
+    if not access_token.obtener():
         print("No se pudo conectar con Zoho Books.")
         input("\nPresione Enter para salir...")
         return
 
     print("Conexion exitosa!\n")
+    access_token.iniciar_renovacion_automatica()
+    bandeja = trabajadores_bandeja(config, access_token).iniciar()
+
+    for operacion, opcion in (('certificacion', 1), ('anulacion', 2)):
+        pendientes = pendientes_diario(operacion)
+        if pendientes:
+            print(f"AVISO: {len(pendientes)} factura(s) con {operacion} a medias; la opcion {opcion} permite reanudarlas.\n")
 
     while True:
         print("="*70)
@@ -1189,6 +2923,7 @@ def main():
         print("="*70)
         print("\n  1) Certificar facturas (borrador -> FEL)")
         print("  2) Anular facturas (certificadas -> anulacion SAT)")
+        print("  3) Ver bandeja de salida (PDF / email pendientes)")
         print("  0) Salir")
         print("-"*70)
 
@@ -1198,15 +2933,418 @@ def main():
             flujo_certificacion(config, access_token)
         elif opcion == '2':
             flujo_anulacion(config, access_token)
+        elif opcion == '3':
+            tareas = mostrar_bandeja()
+            if any(tarea['estado'] == 'fallida' for tarea in tareas):
+                if input("\nReintentar las tareas fallidas? (s/N): ").strip().lower() == 's':
+                    print(f"{reintentar_fallidas_bandeja()} tarea(s) de nuevo en cola.")
+            print()
         elif opcion == '0':
             print("\nSaliendo...")
+            bandeja.detener()
+            pendientes = resumen_bandeja().get('pendiente', 0)
+            if pendientes:
+                print(f"{pendientes} tarea(s) de PDF/email quedan en la bandeja; se enviaran al abrir de nuevo el asistente.")
             break
         else:
             print("\nOpcion invalida. Intente de nuevo.")
 
     input("\nPresione Enter para salir...")
 
+# Codigos de salida del modo sin consola
+SALIDA_OK = 0
+SALIDA_CON_FALLIDAS = 1
+SALIDA_ERROR = 2
+
+def crear_parser_cli():
+    """Argumentos del modo sin consola (certify / void / outbox / serve / sync / reconcile / archive)"""
+    parser = argparse.ArgumentParser(
+        prog='asistente_facturacion.py',
+        description='Asistente de Facturacion ADSTTER - modo sin consola. Sin argumentos abre el menu interactivo.'
+    )
+    parser.add_argument('--config', metavar='RUTA', help='Archivo de configuracion (por defecto config.json junto al script)')
+    parser.add_argument('--formato', choices=['jsonl', 'json'], default='jsonl',
+                        help='jsonl: una linea por factura al terminarla (por defecto); json: un documento al final')
+    parser.add_argument('--traza', metavar='RUTA',
+                        help='Escribe los tiempos de cada etapa en RUTA (JSONL) y muestra el resumen en stderr')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    certify = subparsers.add_parser('certify', help='Certificar facturas borrador')
+    seleccion = certify.add_mutually_exclusive_group(required=True)
+    seleccion.add_argument('--all-drafts', action='store_true', help='Todas las facturas en borrador')
+    seleccion.add_argument('--ids', nargs='+', metavar='INVOICE_ID', help='invoice_id de Zoho a certificar')
+    seleccion.add_argument('--resume', action='store_true', help='Retomar las facturas que quedaron a medias segun el diario')
+    certify.add_argument('--sin-prevalidacion', action='store_true',
+                         help='No revisar la seleccion (NIT en SAT, limite CF, pais, totales) antes de certificar')
+
+    void = subparsers.add_parser('void', help='Anular facturas certificadas')
+    seleccion_void = void.add_mutually_exclusive_group(required=True)
+    seleccion_void.add_argument('--uuids', nargs='+', metavar='UUID', help='UUID FEL de las facturas a anular')
+    seleccion_void.add_argument('--resume', action='store_true', help='Retomar las anulaciones que quedaron a medias segun el diario')
+    void.add_argument('--yes', action='store_true', help='Confirma la anulacion en SAT (obligatorio)')
+
+    outbox = subparsers.add_parser('outbox', help='Tareas pendientes y fallidas de la bandeja de salida (PDF / email)')
+    outbox.add_argument('--reintentar-fallidas', action='store_true', help='Vuelve a poner en cola las tareas fallidas')
+    outbox.add_argument('--procesar', action='store_true', help='Ejecuta ahora las tareas listas antes de listar')
+
+    serve = subparsers.add_parser('serve', help='Servicio que certifica los borradores al recibir los webhooks de Zoho')
+    serve.add_argument('--host', help=f"Interfaz donde escuchar (por defecto {OPCIONES_WEBHOOK['host']})")
+    serve.add_argument('--puerto', type=int, help=f"Puerto (por defecto {OPCIONES_WEBHOOK['puerto']})")
+    serve.add_argument('--trabajadores', type=int, help='Facturas que se certifican a la vez')
+    serve.add_argument('--barrer-borradores', action='store_true',
+                       help='Al iniciar, encola tambien los borradores existentes (webhooks perdidos)')
+    serve.add_argument('--sondeo', type=float, metavar='SEGUNDOS',
+                       help='Ademas de los webhooks, consulta los cambios de Zoho cada SEGUNDOS y encola los borradores '
+                            'nuevos o modificados (sin copia local, la primera consulta encola todos)')
+
+    sync = subparsers.add_parser('sync', help='Actualiza la copia local de facturas y contactos con los cambios de Zoho')
+    sync.add_argument('--completa', action='store_true', help='Descarga todo en vez de solo lo modificado')
+    sync.add_argument('--cada', type=float, metavar='SEGUNDOS', help='Repite la sincronizacion cada SEGUNDOS hasta Ctrl+C')
+
+    reconcile = subparsers.add_parser('reconcile', help='Compara el estado FEL de Zoho con INFILE/SAT y reporta las diferencias')
+    reconcile.add_argument('--reporte', choices=['csv', 'json'], default='csv', help='Formato del reporte (por defecto csv)')
+    reconcile.add_argument('--salida', metavar='RUTA', help='Archivo del reporte (por defecto stdout)')
+    reconcile.add_argument('--hilos', type=int, help='Consultas en paralelo (tambien limitadas por servicio)')
+    reconcile.add_argument('--sin-cache', action='store_true', help='Vuelve a consultar en INFILE todos los UUID')
+
+    archive = subparsers.add_parser('archive', help='Busca DTE en el archivo local (XML, respuesta de INFILE y PDF)')
+    archive.add_argument('--uuid', help='UUID FEL del documento')
+    archive.add_argument('--serie', help='Serie del DTE')
+    archive.add_argument('--numero', help='Numero del DTE')
+    archive.add_argument('--cliente', metavar='ID_O_NOMBRE', help='customer_id de Zoho o parte del nombre del cliente')
+    archive.add_argument('--desde', metavar='AAAA-MM-DD', help='Fecha de certificacion desde (incluida)')
+    archive.add_argument('--hasta', metavar='AAAA-MM-DD', help='Fecha de certificacion hasta (incluida)')
+    archive.add_argument('--extraer', metavar='CARPETA', help='Copia a CARPETA los archivos de cada DTE encontrado')
+    archive.add_argument('--verificar', action='store_true',
+                        help='Comprueba que los archivos de cada DTE existan y coincidan con su huella')
+    return parser
+
+def facturas_borrador_por_id(config, access_token, invoice_ids):
+    """Carga el detalle de cada invoice_id; devuelve (borradores, errores) sin certificar nada"""
+    facturas, errores = [], []
+    for invoice_id in invoice_ids:
+        try:
+            detalle = obtener_factura(config, access_token, invoice_id)
+        except requests.RequestException as e:
+            print(f"Error al obtener detalle de factura {invoice_id}: {e}")
+            detalle = None
+        if not detalle:
+            errores.append({'invoice_id': invoice_id, 'estado': 'fallida', 'error': 'No se pudo obtener detalle'})
+        elif detalle.status != 'draft':
+            errores.append({
+                'invoice_id': invoice_id, 'numero': detalle.invoice_number or 'N/A',
+                'estado': 'fallida', 'error': f"La factura no esta en borrador (status: {detalle.status})"
+            })
+        else:
+            facturas.append({
+                'invoice_id': invoice_id,
+                'invoice_number': detalle.invoice_number or 'N/A',
+                'customer_name': detalle.customer_name,
+                '_factura': detalle
+            })
+    return facturas, errores
+
+def facturas_certificadas_por_uuid(config, access_token, uuids):
+    """Busca las facturas certificadas de cada UUID (indice local y, si faltan, Zoho)"""
+    pendientes = set(uuids)
+    encontradas = {}
+    for factura in listar_certificadas_indice():
+        if factura['_fel_uuid'] in pendientes:
+            encontradas[factura['_fel_uuid']] = factura
+            pendientes.discard(factura['_fel_uuid'])
+    if pendientes:
+        for factura in iterar_facturas_certificadas(config, access_token):
+            registrar_detalle_indice(factura['_factura'])
+            if factura['_fel_uuid'] in pendientes:
+                encontradas[factura['_fel_uuid']] = factura
+                pendientes.discard(factura['_fel_uuid'])
+                if not pendientes:
+                    break
+    facturas = [encontradas[u] for u in uuids if u in encontradas]
+    errores = [{'uuid': u, 'estado': 'fallida', 'error': 'No se encontro factura certificada con ese UUID'}
+               for u in uuids if u not in encontradas]
+    return facturas, errores
+
+def salida_bandeja(formato, salida_json):
+    """Escribe las tareas pendientes y fallidas de la bandeja; codigo 1 si hay fallidas"""
+    tareas = listar_tareas_bandeja()
+    for tarea in tareas:
+        if tarea['proximo_intento']:
+            tarea['proximo_intento'] = datetime.fromtimestamp(tarea['proximo_intento']).isoformat(timespec='seconds')
+    if formato == 'json':
+        json.dump({'comando': 'outbox', 'tareas': tareas}, salida_json, ensure_ascii=False, indent=2)
+        salida_json.write('\n')
+    else:
+        for tarea in tareas:
+            salida_json.write(json.dumps(tarea, ensure_ascii=False) + '\n')
+    salida_json.flush()
+    return SALIDA_CON_FALLIDAS if any(tarea['estado'] == 'fallida' for tarea in tareas) else SALIDA_OK
+
+def servir_webhooks(config, access_token, args, bandeja, emitir):
+    """Comando serve: certifica lo que llega por webhook hasta Ctrl+C; cada factura se emite como JSON"""
+    lock_emitir = threading.Lock()
+
+    def al_completar(invoice_id, clave, registro):
+        with lock_emitir:
+            emitir(dict(registro, invoice_id=invoice_id,
+                        estado={'exitosas': 'exitosa', 'fallidas': 'fallida'}.get(clave, 'omitida')))
+
+    try:
+        servicio = servicio_webhook(config, access_token, al_completar, host=args.host,
+                                   puerto=args.puerto, trabajadores=args.trabajadores).iniciar()
+    except OSError as e:
+        print(f"No se pudo abrir el puerto del webhook: {e}")
+        bandeja.detener()
+        return SALIDA_ERROR
+    except ValueError as e:
+        print(f"No se puede iniciar el webhook: {e}")
+        bandeja.detener()
+        return SALIDA_ERROR
+
+    # Lo que quedo a medias en el diario se retoma antes que los webhooks nuevos
+    for factura in pendientes_diario('certificacion'):
+        servicio.cola.agregar(factura['invoice_id'], factura)
+    if args.barrer_borradores:
+        for factura in paginar_facturas(config, access_token, 'draft'):
+            servicio.cola.agregar(factura['invoice_id'])
+    print(f"Escuchando webhooks de Zoho en {servicio.url} ({len(servicio.cola)} factura(s) en cola). Ctrl+C para detener")
+
+    try:
+        proximo_sondeo = time.monotonic()
+        while True:
+            if args.sondeo and time.monotonic() >= proximo_sondeo:
+                proximo_sondeo = time.monotonic() + args.sondeo
+                try:
+                    cambios = sincronizar_zoho(config, access_token)
+                except requests.RequestException as e:
+                    print(f"Error al consultar cambios en Zoho: {e}")
+                    cambios = {'facturas': []}
+                for factura in cambios['facturas']:
+                    if factura.get('status') == 'draft':
+                        servicio.cola.agregar(factura['invoice_id'])
+            time.sleep(min(1, args.sondeo or 1))
+    except KeyboardInterrupt:
+        print("\nDeteniendo el servicio...")
+    servicio.detener()
+    bandeja.terminar()
+    estado = servicio.estado()
+    print(f"Webhooks recibidos: {estado['recibidos']} | Certificadas: {estado['exitosas']} | "
+          f"Fallidas: {estado['fallidas']} | Omitidas: {estado['omitidas']} | Sin procesar: {estado['en_cola']}")
+    if estado['exitosas']:
+        print(f"Demora webhook -> DTE certificado: p50 {estado['demora_p50']:.1f}s, p95 {estado['demora_p95']:.1f}s")
+    imprimir_resumen_bandeja()
+    imprimir_cuota_zoho({})
+    imprimir_resumen_tramos()
+    return SALIDA_CON_FALLIDAS if estado['fallidas'] else SALIDA_OK
+
+def sincronizar_cli(config, access_token, args, emitir, salida_json):
+    """Comando sync: una sincronizacion, o una cada --cada segundos hasta Ctrl+C; cada una se emite como JSON"""
+    completa = args.completa
+    try:
+        while True:
+            try:
+                cambios = sincronizar_zoho(config, access_token, completa)
+            except requests.RequestException as e:
+                print(f"Error al sincronizar: {e}")
+                if not args.cada:
+                    return SALIDA_ERROR
+            else:
+                registro = {
+                    'fecha': datetime.now().isoformat(timespec='seconds'),
+                    'completa': cambios['completa'],
+                    'facturas_cambiadas': len(cambios['facturas']),
+                    'contactos_cambiados': len(cambios['contactos']),
+                    'facturas_borradas': len(cambios['borradas']),
+                    'borradores': len(listar_copia_local('draft')),
+                    'certificadas': len(listar_certificadas_indice())
+                }
+                print(f"Sincronizacion {'completa' if registro['completa'] else 'incremental'}: "
+                      f"{registro['facturas_cambiadas']} factura(s) y {registro['contactos_cambiados']} contacto(s) con cambios")
+                if args.formato == 'json':
+                    json.dump(dict(registro, comando='sync'), salida_json, ensure_ascii=False, indent=2)
+                    salida_json.write('\n')
+                    salida_json.flush()
+                emitir(registro)
+            if not args.cada:
+                return SALIDA_OK
+            completa = False
+            time.sleep(args.cada)
+    except KeyboardInterrupt:
+        return SALIDA_OK
+
+def reconciliar_cli(config, access_token, args, salida_json):
+    """Comando reconcile: escribe el reporte de discrepancias; codigo 1 si hay alguna"""
+    inicio = time.perf_counter()
+    try:
+        discrepancias, resumen = reconciliar_fel(config, access_token, args.hilos, not args.sin_cache)
+    except (requests.RequestException, KeyError) as e:
+        print(f"Error en la conciliacion: {e}")
+        return SALIDA_ERROR
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8', newline='') as f:
+            escribir_reporte_reconciliacion(discrepancias, resumen, args.reporte, f)
+    else:
+        escribir_reporte_reconciliacion(discrepancias, resumen, args.reporte, salida_json)
+    print(f"Conciliacion: {resumen['facturas_zoho']} factura(s) de Zoho y {resumen['dte_en_diario']} DTE del diario y el archivo, "
+          f"{resumen['uuids']} UUID ({resumen['consultados_infile']} consultados en INFILE, {resumen['desde_cache']} en cache, "
+          f"{resumen['desde_archivo']} anulados segun el archivo) "
+          f"en {time.perf_counter() - inicio:.1f}s -> {resumen['discrepancias']} discrepancia(s)"
+          f" ({resumen['desconocidos']} UUID con estado desconocido)")
+    if args.salida:
+        print(f"Reporte: {args.salida}")
+    imprimir_cuota_zoho({})
+    imprimir_resumen_tramos()
+    return SALIDA_CON_FALLIDAS if discrepancias else SALIDA_OK
+
+def archivo_cli(args, salida_json):
+    """Comando archive: escribe los DTE del archivo local que cumplen los filtros; codigo 1 si --verificar encuentra danos"""
+    documentos = buscar_archivo(args.uuid, args.serie, args.numero, args.cliente, args.desde, args.hasta)
+    danados = 0
+    for documento in documentos:
+        if args.verificar:
+            documento['problemas'] = verificar_documento_archivo(documento)
+            danados += bool(documento['problemas'])
+        if args.extraer:
+            documento['extraidos'] = extraer_documento_archivo(documento, args.extraer)
+        for objeto in OBJETOS_ARCHIVO:
+            documento[objeto] = documento[objeto].hex() if documento[objeto] else None
+    if args.formato == 'json':
+        json.dump({'comando': 'archive', 'documentos': documentos}, salida_json, ensure_ascii=False, indent=2)
+        salida_json.write('\n')
+    else:
+        for documento in documentos:
+            salida_json.write(json.dumps(documento, ensure_ascii=False) + '\n')
+    salida_json.flush()
+    print(f"{len(documentos)} DTE en el archivo" + (f", {danados} con archivos danados o faltantes" if args.verificar else ''))
+    return SALIDA_CON_FALLIDAS if danados else SALIDA_OK
+
+def main_cli(argv):
+    """Modo sin consola: procesa facturas y escribe resultados JSON en stdout.
+
+    Los mensajes de avance van a stderr. Devuelve el codigo de salida:
+    0 todo correcto, 1 alguna factura fallo, 2 error de uso, configuracion o conexion.
+    """
+    args = crear_parser_cli().parse_args(argv)
+    salida_json = sys.stdout
+
+    def emitir(registro):
+        if args.formato == 'jsonl':
+            salida_json.write(json.dumps(registro, ensure_ascii=False) + '\n')
+            salida_json.flush()
+
+    if args.comando == 'void' and not args.yes:
+        print("La anulacion en SAT requiere --yes", file=sys.stderr)
+        return SALIDA_ERROR
+
+    with redirect_stdout(sys.stderr):
+        try:
+            config = cargar_config(args.config)
+        except Exception as e:
+            print(f"Error al cargar configuracion: {e}")
+            return SALIDA_ERROR
+        inicializar(config, args.traza)
+
+        if args.comando == 'outbox' and args.reintentar_fallidas:
+            print(f"{reintentar_fallidas_bandeja()} tarea(s) fallida(s) de nuevo en cola")
+        if args.comando == 'outbox' and not args.procesar:
+            return salida_bandeja(args.formato, salida_json)
+        if args.comando == 'archive':
+            return archivo_cli(args, salida_json)
+
+        access_token = GestorToken(config)
+        try:
+            conectado = access_token.obtener()
+        except requests.RequestException as e:
+            print(f"Error de conexion: {e}")
+            conectado = None
+        if not conectado:
+            print("No se pudo conectar con Zoho Books.")
+            return SALIDA_ERROR
+        access_token.iniciar_renovacion_automatica()
+
+        if args.comando == 'outbox':
+            recuperar_tareas_interrumpidas()
+            trabajadores_bandeja(config, access_token).vaciar()
+            return salida_bandeja(args.formato, salida_json)
+        if args.comando == 'sync':
+            return sincronizar_cli(config, access_token, args, emitir, salida_json)
+        if args.comando == 'reconcile':
+            return reconciliar_cli(config, access_token, args, salida_json)
+        bandeja = trabajadores_bandeja(config, access_token).iniciar()
+
+        if args.comando == 'serve':
+            return servir_webhooks(config, access_token, args, bandeja, emitir)
+
+        try:
+            if args.comando == 'certify':
+                if args.resume:
+                    facturas, errores = pendientes_diario('certificacion'), []
+                elif args.all_drafts:
+                    facturas, errores = list(paginar_facturas(config, access_token, 'draft')), []
+                else:
+                    facturas, errores = facturas_borrador_por_id(config, access_token, args.ids)
+                if facturas and not args.resume and not args.sin_prevalidacion:
+                    errores_emisor, revisiones = prevalidar_facturas(config, access_token, facturas)
+                    facturas = imprimir_prevalidacion(errores_emisor, revisiones)
+                    if errores_emisor:
+                        return SALIDA_ERROR
+                    errores += [{
+                        'invoice_id': r['factura'].get('invoice_id'), 'numero': r['factura'].get('invoice_number', 'N/A'),
+                        'estado': 'fallida', 'error': 'Prevalidacion: ' + '; '.join(r['errores'])
+                    } for r in revisiones if r['errores']]
+                procesar_lote = certificar_lote
+            else:
+                if args.resume:
+                    facturas, errores = pendientes_diario('anulacion'), []
+                else:
+                    facturas, errores = facturas_certificadas_por_uuid(config, access_token, args.uuids)
+                procesar_lote = anular_lote
+            if not args.resume:
+                pendientes = pendientes_diario('certificacion' if args.comando == 'certify' else 'anulacion')
+                if pendientes:
+                    print(f"AVISO: {len(pendientes)} factura(s) quedaron a medias; use {args.comando} --resume para retomarlas")
+        except requests.RequestException as e:
+            print(f"Error de conexion al obtener las facturas: {e}")
+            return SALIDA_ERROR
+
+        registros = list(errores)
+        for registro in errores:
+            emitir(registro)
+
+        def al_completar(factura, resultado):
+            clave, datos = resultado
+            registro = {
+                'invoice_id': factura.get('invoice_id'),
+                'estado': 'exitosa' if clave == 'exitosas' else 'fallida'
+            }
+            registro.update(datos)
+            registros.append(registro)
+            emitir(registro)
+
+        procesar_lote(config, access_token, facturas, al_completar)
+
+        # Terminar en este proceso los PDF/email listos; los reprogramados quedan para la proxima ejecucion
+        bandeja.terminar()
+        imprimir_resumen_bandeja()
+        imprimir_cuota_zoho({})
+        imprimir_resumen_tramos()
+
+    fallidas = sum(1 for registro in registros if registro['estado'] == 'fallida')
+    if args.formato == 'json':
+        json.dump({
+            'comando': args.comando,
+            'procesadas': len(registros),
+            'exitosas': len(registros) - fallidas,
+            'fallidas': fallidas,
+            'cuota_zoho': estadisticas_cuota_zoho(),
+            'resultados': registros
+        }, salida_json, ensure_ascii=False, indent=2)
+        salida_json.write('\n')
+    return SALIDA_CON_FALLIDAS if fallidas else SALIDA_OK
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main_cli(sys.argv[1:]))
     try:
         main()
     except Exception as e:
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Bandeja de salida del PDF y el email: tareas en SQLite que vacian hilos de fondo con reintentos
+"""
+
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from consola import capturar_salida
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BANDEJA_FILE = os.path.join(SCRIPT_DIR, 'bandeja_salida.db')
+
+# Bandeja de salida del PDF y el email (seccion "bandeja" de config.json)
+# Reintentos con espera exponencial: espera_inicial, x2, x4... hasta espera_maxima (segundos)
+# Cada proceso (menu, CLI, serve) toma una tarea por plazo_tarea segundos; si no la termina en ese
+# plazo (se cerro a medias), otro proceso la puede retomar
+OPCIONES_BANDEJA = {
+    'trabajadores': 2,
+    'max_intentos': 6,
+    'espera_inicial': 10,
+    'espera_maxima': 900,
+    'plazo_tarea': 600
+}
+
+# Identifica a este proceso como dueno de las tareas que toma de la bandeja
+DUENO_BANDEJA = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_bandeja_lock = threading.Lock()
+_aviso_bandeja = threading.Event()
+
+def conectar_bandeja():
+    """Abre la bandeja de salida (SQLite), creando la tabla si no existe"""
+    conexion = sqlite3.connect(BANDEJA_FILE, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    conexion.execute("""
+        CREATE TABLE IF NOT EXISTS tareas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT,
+            invoice_id TEXT,
+            invoice_number TEXT,
+            datos TEXT,
+            depende_de INTEGER,
+            estado TEXT,
+            intentos INTEGER DEFAULT 0,
+            proximo_intento REAL,
+            ultimo_error TEXT,
+            creado TEXT,
+            actualizado TEXT,
+            dueno TEXT,
+            vence REAL
+        )
+    """)
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_tareas_estado ON tareas (estado, proximo_intento)")
+    return conexion
+
+def encolar_tarea(tipo, invoice_id, invoice_number, datos, depende_de=None):
+    """Guarda una tarea ('pdf' o 'email') pendiente en la bandeja y devuelve su id"""
+    ahora = datetime.now().isoformat(timespec='seconds')
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            with conexion:
+                cursor = conexion.execute(
+                    "INSERT INTO tareas (tipo, invoice_id, invoice_number, datos, depende_de, estado, intentos, proximo_intento, creado, actualizado) "
+                    "VALUES (?, ?, ?, ?, ?, 'pendiente', 0, ?, ?, ?)",
+                    (tipo, invoice_id, invoice_number, json.dumps(datos, ensure_ascii=False), depende_de, time.time(), ahora, ahora)
+                )
+        finally:
+            conexion.close()
+    _aviso_bandeja.set()
+    return cursor.lastrowid
+
+def encolar_pdf_y_email(invoice_id, invoice_number, url_pdf, datos_certificacion, emails, cliente):
+    """Encola el adjunto del PDF y, despues de el, el email a emails (si hay) con los datos del cliente.
+
+    Si la factura ya tiene tareas en la bandeja (reanudacion), no encola otras.
+    """
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            existentes = dict(conexion.execute(
+                "SELECT tipo, id FROM tareas WHERE invoice_id = ? AND tipo IN ('pdf', 'email')", (invoice_id,)
+            ).fetchall())
+        finally:
+            conexion.close()
+    if 'pdf' in existentes:
+        return existentes['pdf'], existentes.get('email')
+    id_pdf = encolar_tarea('pdf', invoice_id, invoice_number, {
+        'url_pdf': url_pdf,
+        'uuid': datos_certificacion.uuid,
+        'serie': datos_certificacion.serie,
+        'numero': datos_certificacion.numero
+    })
+    if not emails:
+        return id_pdf, None
+    id_email = encolar_tarea('email', invoice_id, invoice_number, {
+        'emails': emails,
+        'datos_certificacion': {
+            'uuid': datos_certificacion.uuid, 'serie': datos_certificacion.serie,
+            'numero': datos_certificacion.numero, 'fecha': datos_certificacion.fecha
+        },
+        'cliente': cliente
+    }, depende_de=id_pdf)
+    return id_pdf, id_email
+
+def tomar_tarea(opciones=None):
+    """Marca como 'en_proceso' (de este proceso) la siguiente tarea lista y la devuelve (o None).
+
+    Tambien se retoman las tareas 'en_proceso' cuyo plazo vencio. Un email
+    espera a que su PDF termine (bien o mal), para conservar el orden original.
+    La bandeja se comparte entre procesos: la toma va en una transaccion
+    BEGIN IMMEDIATE y el UPDATE solo cambia la tarea si sigue libre.
+    """
+    opciones = opciones or OPCIONES_BANDEJA
+    ahora = time.time()
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            with conexion:
+                conexion.execute("BEGIN IMMEDIATE")
+                fila = conexion.execute("""
+                    SELECT * FROM tareas t
+                    WHERE ((estado = 'pendiente' AND proximo_intento <= ?) OR (estado = 'en_proceso' AND vence < ?))
+                      AND (depende_de IS NULL OR NOT EXISTS (
+                          SELECT 1 FROM tareas d WHERE d.id = t.depende_de AND d.estado IN ('pendiente', 'en_proceso')))
+                    ORDER BY proximo_intento, id LIMIT 1
+                """, (ahora, ahora)).fetchone()
+                if fila is None:
+                    return None
+                tomada = conexion.execute(
+                    "UPDATE tareas SET estado = 'en_proceso', dueno = ?, vence = ?, actualizado = ? "
+                    "WHERE id = ? AND (estado = 'pendiente' OR (estado = 'en_proceso' AND vence < ?))",
+                    (DUENO_BANDEJA, ahora + float(opciones['plazo_tarea']),
+                     datetime.now().isoformat(timespec='seconds'), fila['id'], ahora)
+                ).rowcount
+            # Sin filas cambiadas, otro proceso la tomo primero
+            return dict(fila) if tomada else None
+        finally:
+            conexion.close()
+
+def terminar_tarea(tarea, exito, error=None, opciones=None):
+    """Marca la tarea como hecha, o la reprograma con espera exponencial hasta agotar los intentos"""
+    opciones = opciones or OPCIONES_BANDEJA
+    intentos = tarea['intentos'] + 1
+    if exito:
+        estado, proximo = 'hecha', None
+    elif intentos >= int(opciones['max_intentos']):
+        estado, proximo = 'fallida', None
+    else:
+        espera = min(float(opciones['espera_maxima']), float(opciones['espera_inicial']) * 2 ** (intentos - 1))
+        estado, proximo = 'pendiente', time.time() + espera
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            with conexion:
+                # Si el plazo vencio y otro proceso retomo la tarea, el resultado es suyo
+                conexion.execute(
+                    "UPDATE tareas SET estado = ?, intentos = ?, proximo_intento = COALESCE(?, proximo_intento), "
+                    "ultimo_error = ?, actualizado = ?, dueno = NULL, vence = NULL "
+                    "WHERE id = ? AND estado = 'en_proceso' AND dueno = ?",
+                    (estado, intentos, proximo, None if exito else (error or '')[-500:],
+                     datetime.now().isoformat(timespec='seconds'), tarea['id'], DUENO_BANDEJA)
+                )
+        finally:
+            conexion.close()
+    return estado
+
+def recuperar_tareas_interrumpidas():
+    """Vuelve a 'pendiente' las tareas 'en_proceso' con el plazo vencido (el programa se cerro a medias).
+
+    Las que otro proceso sigue ejecutando (plazo vigente) no se tocan.
+    """
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            with conexion:
+                return conexion.execute(
+                    "UPDATE tareas SET estado = 'pendiente', dueno = NULL, vence = NULL "
+                    "WHERE estado = 'en_proceso' AND (vence IS NULL OR vence < ?)", (time.time(),)
+                ).rowcount
+        finally:
+            conexion.close()
+
+def listar_tareas_bandeja(estados=('pendiente', 'en_proceso', 'fallida')):
+    """Tareas de la bandeja en los estados indicados, de la mas antigua a la mas nueva"""
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            marcas = ', '.join('?' for _ in estados)
+            filas = conexion.execute(
+                f"SELECT id, tipo, invoice_id, invoice_number, estado, intentos, proximo_intento, ultimo_error, creado, actualizado "
+                f"FROM tareas WHERE estado IN ({marcas}) ORDER BY id", tuple(estados)
+            ).fetchall()
+        finally:
+            conexion.close()
+    return [dict(fila) for fila in filas]
+
+def reintentar_fallidas_bandeja():
+    """Vuelve a poner en cola las tareas fallidas, con los intentos en cero"""
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            with conexion:
+                return conexion.execute(
+                    "UPDATE tareas SET estado = 'pendiente', intentos = 0, proximo_intento = ? WHERE estado = 'fallida'",
+                    (time.time(),)
+                ).rowcount
+        finally:
+            conexion.close()
+
+class TrabajadoresBandeja:
+    """Hilos de fondo que vacian la bandeja de salida con reintentos.
+
+    ejecutar(tarea) hace el trabajo y devuelve True si se completo. La salida
+    de cada tarea no se muestra en consola; si falla, sus ultimas lineas quedan
+    en ultimo_error.
+    """
+
+    def __init__(self, config, ejecutar):
+        self.ejecutar = ejecutar
+        self.opciones = dict(OPCIONES_BANDEJA)
+        self.opciones.update(config.get('bandeja', {}))
+        self.detenido = threading.Event()
+        self.hilos = []
+
+    def procesar_una(self):
+        """Toma y ejecuta una tarea lista; devuelve False si no habia ninguna"""
+        tarea = tomar_tarea(self.opciones)
+        if tarea is None:
+            return False
+        with capturar_salida(io.StringIO()) as buffer:
+            try:
+                exito, error = self.ejecutar(tarea), None
+            except Exception as e:
+                exito, error = False, f"{type(e).__name__}: {e}"
+        if not exito:
+            error = error or buffer.getvalue().strip() or 'Sin detalle'
+        terminar_tarea(tarea, exito, error, self.opciones)
+        return True
+
+    def vaciar(self):
+        """Procesa en el hilo actual todas las tareas listas (no espera las reprogramadas)"""
+        while not self.detenido.is_set() and self.procesar_una():
+            pass
+
+    def iniciar(self):
+        recuperar_tareas_interrumpidas()
+
+        def trabajar():
+            while not self.detenido.is_set():
+                try:
+                    hubo_tarea = self.procesar_una()
+                except Exception:
+                    hubo_tarea = False
+                if not hubo_tarea:
+                    # Despierta antes si se encola algo nuevo
+                    _aviso_bandeja.wait(1)
+                    _aviso_bandeja.clear()
+
+        for i in range(max(1, int(self.opciones['trabajadores']))):
+            hilo = threading.Thread(target=trabajar, name=f'bandeja-{i + 1}', daemon=True)
+            hilo.start()
+            self.hilos.append(hilo)
+        return self
+
+    def terminar(self):
+        """Detiene los hilos y procesa en el hilo actual las tareas que ya esten listas"""
+        self.detener()
+        self.detenido.clear()
+        self.vaciar()
+
+    def detener(self, esperar=True):
+        """Detiene los hilos; las tareas que queden pendientes siguen en la bandeja para la proxima vez"""
+        self.detenido.set()
+        _aviso_bandeja.set()
+        if esperar:
+            for hilo in self.hilos:
+                hilo.join()
+        self.hilos = []
+
+def resumen_bandeja():
+    """Cantidad de tareas por estado"""
+    with _bandeja_lock:
+        conexion = conectar_bandeja()
+        try:
+            filas = conexion.execute("SELECT estado, COUNT(*) FROM tareas GROUP BY estado").fetchall()
+        finally:
+            conexion.close()
+    return {estado: cantidad for estado, cantidad in filas}
+
+def imprimir_resumen_bandeja():
+    """Una linea con las tareas de PDF/email que siguen en la bandeja"""
+    resumen = resumen_bandeja()
+    pendientes = resumen.get('pendiente', 0) + resumen.get('en_proceso', 0)
+    print(f"Bandeja de salida (PDF/email): {pendientes} pendiente(s), {resumen.get('fallida', 0)} fallida(s)")
+
+def mostrar_bandeja():
+    """Muestra las tareas pendientes y fallidas de la bandeja de salida"""
+    tareas = listar_tareas_bandeja()
+    print("\n" + "="*70)
+    print("                    BANDEJA DE SALIDA (PDF / email)")
+    print("="*70)
+    if not tareas:
+        print("\nNo hay tareas pendientes ni fallidas.")
+        return tareas
+    print(f"\n{'ID':<6}{'Tipo':<7}{'Factura':<28}{'Estado':<12}{'Int.':<6}{'Proximo intento / error'}")
+    print("-"*70)
+    for tarea in tareas:
+        if tarea['estado'] == 'fallida':
+            detalle = (tarea['ultimo_error'] or '').splitlines()[-1:] or ['']
+            detalle = detalle[0][:40]
+        else:
+            detalle = datetime.fromtimestamp(tarea['proximo_intento']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{tarea['id']:<6}{tarea['tipo']:<7}{(tarea['invoice_number'] or '')[:27]:<28}{tarea['estado']:<12}{tarea['intentos']:<6}{detalle}")
+    return tareas
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de carga de certificacion y anulacion contra servidores simulados
+
+Levanta los servidores de servidores_simulados.py, crea N facturas borrador,
+las certifica con certificar_lote (el PDF y el email salen por la bandeja de
+salida) y luego las anula con anular_lote. Reporta
+facturas por minuto y latencia p50/p95 de cada etapa, tomada de la traza
+del asistente.
+
+Uso:
+    python benchmark_carga.py [--tamanos 10,100,1000] [--hilos 4] [--latencia 0.05]
+                              [--errores 0.0] [--tasa-429 0.0] [--cuota-zoho 0]
+                              [--limite-zoho 0] [--precarga 2] [--traza PREFIJO]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import archivo_dte
+import asistente_facturacion as asistente
+import bandeja
+import diario
+import indice_fel
+from servidores_simulados import Comportamiento, EstadoSimulado, ServidoresSimulados
+
+# Orden de las etapas en la tabla; las que no aparecen aqui se listan al final
+ETAPAS = [
+    'detalle', 'contacto', 'xml', 'infile', 'zoho_actualizar', 'indice', 'pdf', 'email',
+    'xml_anulacion', 'zoho_anulacion', 'http_zoho', 'http_infile', 'http_reportes',
+    'certificacion', 'anulacion',
+]
+
+
+def imprimir_etapas(estadisticas):
+    print(f"   {'Etapa':<18}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for etapa in ETAPAS + sorted(set(estadisticas) - set(ETAPAS)):
+        datos = estadisticas.get(etapa)
+        if not datos:
+            continue
+        print(f"   {etapa:<18}{datos['cantidad']:>6}{datos['p50'] * 1000:>10.1f}"
+              f"{datos['p95'] * 1000:>10.1f}{datos['max'] * 1000:>10.1f}")
+
+
+def ejecutar_corrida(cantidad, args, directorio):
+    """Certifica y anula `cantidad` facturas; devuelve (estadisticas por etapa, resumen)"""
+    comportamiento = lambda cuota=0: Comportamiento(latencia=args.latencia, variacion=args.variacion,
+                                                    tasa_error=args.errores, tasa_429=args.tasa_429,
+                                                    cuota_por_minuto=cuota)
+    servidores = ServidoresSimulados(
+        EstadoSimulado(facturas=cantidad, contactos=max(5, cantidad // 10), lineas=args.lineas),
+        zoho=comportamiento(args.cuota_zoho), infile=comportamiento(), reportes=comportamiento()
+    ).iniciar()
+    # Sin --limite-zoho el limitador usa la cuota simulada, o no limita si tampoco hay cuota
+    limite_zoho = args.limite_zoho or args.cuota_zoho or 1000000
+    config = servidores.config(concurrencia={
+        'facturas': args.hilos, 'anulaciones': args.hilos, 'zoho': args.hilos, 'infile': args.hilos,
+        'reportes': args.hilos
+    }, bandeja={'trabajadores': args.hilos, 'espera_inicial': 0.5, 'espera_maxima': 2},
+       limite_zoho={'por_minuto': limite_zoho}, precarga={'profundidad': args.precarga})
+
+    indice_fel.INDICE_FEL_FILE = os.path.join(directorio, f'indice_{cantidad}.db')
+    asistente.TOKEN_FILE = os.path.join(directorio, f'token_{cantidad}.json')
+    bandeja.BANDEJA_FILE = os.path.join(directorio, f'bandeja_{cantidad}.db')
+    diario.DIARIO_FILE = os.path.join(directorio, f'diario_{cantidad}.db')
+    archivo_dte.ARCHIVO_FEL_DIR = os.path.join(directorio, f'archivo_{cantidad}')
+    diario.DIARIO_XML_DIR = os.path.join(directorio, f'diario_xml_{cantidad}')
+    archivo_traza = f"{args.traza}.{cantidad}.jsonl" if args.traza else None
+    asistente.inicializar(config)
+    trazador = asistente.configurar_traza({'traza': {'habilitada': True, 'archivo': archivo_traza}})
+
+    cuota_inicio = asistente.estadisticas_cuota_zoho()
+    try:
+        gestor = asistente.GestorToken(config)
+        gestor.obtener()
+        with redirect_stdout(io.StringIO()):
+            facturas = list(asistente.paginar_facturas(config, gestor, 'draft'))
+
+            trabajadores = asistente.trabajadores_bandeja(config, gestor).iniciar()
+            inicio = time.perf_counter()
+            certificadas = asistente.certificar_lote(config, gestor, facturas)
+            tiempo_certificacion = time.perf_counter() - inicio
+            # PDF y email salen por la bandeja; se espera a que quede vacia (o solo con fallidas)
+            while any(t['estado'] != 'fallida' for t in asistente.listar_tareas_bandeja()):
+                time.sleep(0.05)
+            tiempo_bandeja = time.perf_counter() - inicio
+            trabajadores.detener()
+
+            por_anular = asistente.listar_certificadas_indice()
+            inicio = time.perf_counter()
+            anuladas = asistente.anular_lote(config, gestor, por_anular)
+            tiempo_anulacion = time.perf_counter() - inicio
+    finally:
+        estadisticas = trazador.estadisticas()
+        salida_cuota = io.StringIO()
+        with redirect_stdout(salida_cuota):
+            asistente.imprimir_cuota_zoho(cuota_inicio)
+        asistente.configurar_traza({})
+        servidores.detener()
+
+    resumen = {
+        'certificadas': sum(1 for _, clave, _ in certificadas if clave == 'exitosas'),
+        'anuladas': sum(1 for _, clave, _ in anuladas if clave == 'exitosas'),
+        'por_anular': len(por_anular),
+        'tiempo_certificacion': tiempo_certificacion,
+        'tiempo_anulacion': tiempo_anulacion,
+        'tiempo_bandeja': tiempo_bandeja,
+        'adjuntos': len(servidores.estado.adjuntos),
+        'correos': len(servidores.estado.correos),
+        'cuota_zoho': salida_cuota.getvalue().strip(),
+        'excedidas_zoho': servidores.comportamientos['zoho'].excedidas,
+    }
+    return estadisticas, resumen
+
+
+def por_minuto(cantidad, segundos):
+    return cantidad / segundos * 60 if segundos > 0 else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de carga contra servidores simulados')
+    parser.add_argument('--tamanos', default='10,100,1000', help='Cantidades de borradores separadas por coma')
+    parser.add_argument('--hilos', type=int, default=4, help='Facturas en paralelo y limite por servicio')
+    parser.add_argument('--latencia', type=float, default=0.05, help='Segundos por peticion en cada servicio')
+    parser.add_argument('--variacion', type=float, default=0.02, help='Variacion aleatoria de la latencia')
+    parser.add_argument('--errores', type=float, default=0.0, help='Fraccion de respuestas 503')
+    parser.add_argument('--tasa-429', type=float, default=0.0, help='Fraccion de respuestas 429')
+    parser.add_argument('--cuota-zoho', type=int, default=0, help='Peticiones por minuto que acepta Zoho simulado (0 = sin cuota)')
+    parser.add_argument('--limite-zoho', type=int, default=0, help='Peticiones por minuto del limitador del asistente')
+    parser.add_argument('--precarga', type=int, default=2, help='Facturas que se precargan por delante (0 = sin precarga)')
+    parser.add_argument('--lineas', type=int, default=3, help='Lineas por factura')
+    parser.add_argument('--traza', metavar='PREFIJO', help='Guarda la traza JSONL de cada corrida en PREFIJO.<cantidad>.jsonl')
+    args = parser.parse_args(argv)
+
+    print("=" * 70)
+    print("   BENCHMARK DE CARGA (servidores simulados)")
+    print(f"   hilos={args.hilos} latencia={args.latencia}s errores={args.errores} 429={args.tasa_429} "
+          f"precarga={args.precarga}")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as directorio:
+        for cantidad in [int(t) for t in args.tamanos.split(',') if t.strip()]:
+            estadisticas, resumen = ejecutar_corrida(cantidad, args, directorio)
+            print(f"\n>> {cantidad} borradores")
+            print(f"   Certificadas: {resumen['certificadas']}/{cantidad} en {resumen['tiempo_certificacion']:.2f}s "
+                  f"({por_minuto(resumen['certificadas'], resumen['tiempo_certificacion']):.0f} facturas/min)")
+            print(f"   Anuladas:     {resumen['anuladas']}/{resumen['por_anular']} en {resumen['tiempo_anulacion']:.2f}s "
+                  f"({por_minuto(resumen['anuladas'], resumen['tiempo_anulacion']):.0f} facturas/min)")
+            print(f"   PDFs adjuntos: {resumen['adjuntos']} | Correos: {resumen['correos']} "
+                  f"(bandeja vacia a los {resumen['tiempo_bandeja']:.2f}s)")
+            if resumen['cuota_zoho']:
+                print(f"   {resumen['cuota_zoho']} | excedidas en el servidor: {resumen['excedidas_zoho']}")
+            imprimir_etapas(estadisticas)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
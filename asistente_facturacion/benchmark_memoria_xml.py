@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de memoria del XML FEL para facturas con miles de lineas
+
+Compara el pico de memoria de generar el XML completo (generar_xml_factura
++ encode, como se enviaba antes) contra recorrer los bloques de
+escribir_xml_factura, que es como se envia en streaming. La factura de
+entrada se crea antes de medir, asi solo cuenta la memoria del XML.
+
+Uso:
+    python benchmark_memoria_xml.py [lineas ...]      (por defecto 10000 100000)
+"""
+
+import hashlib
+import io
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import asistente_facturacion as asistente
+from benchmark_xml import CONFIG, FECHA_EMISION
+
+CONTACTO = asistente.Contacto.desde_zoho({
+    'contact_id': 'uso-1',
+    'contact_name': 'Cliente por Consumo',
+    'email': 'facturas@example.com',
+    'custom_fields': [{'label': 'ID DE EMPRESA', 'value': '1234567-8'}],
+    'billing_address': {'address': 'Zona 10', 'city': 'Guatemala', 'state': 'Guatemala', 'country': 'Guatemala'}
+})
+
+
+def factura_por_consumo(lineas):
+    return asistente.Factura.desde_zoho({
+        'invoice_id': f'uso-{lineas}',
+        'currency_code': 'GTQ',
+        'line_items': [{
+            'name': f'Consumo API dia {i % 31 + 1}',
+            'description': f'Lote {i}',
+            'quantity': 1 + i % 7,
+            'rate': 0.0125 * (1 + i % 13),
+            'discount_amount': 0
+        } for i in range(lineas)]
+    })
+
+
+def medir_pico(funcion):
+    """Ejecuta funcion() y devuelve (resultado, pico de memoria en MB, segundos)"""
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = funcion()
+    segundos = time.perf_counter() - inicio
+    pico = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return resultado, pico, segundos
+
+
+def xml_completo(factura):
+    cuerpo = asistente.generar_xml_factura(CONFIG, factura, CONTACTO, FECHA_EMISION).encode('utf-8')
+    return hashlib.sha256(cuerpo).hexdigest(), len(cuerpo)
+
+
+def xml_en_bloques(factura):
+    resumen, total = hashlib.sha256(), 0
+    for bloque in asistente.escribir_xml_factura(CONFIG, factura, CONTACTO, FECHA_EMISION):
+        resumen.update(bloque)
+        total += len(bloque)
+    return resumen.hexdigest(), total
+
+
+def main():
+    cantidades = [int(n) for n in sys.argv[1:]] or [10000, 100000]
+    print(f"{'Lineas':>8} {'XML (MB)':>10} {'Completo: pico MB':>18} {'seg':>6} {'Bloques: pico MB':>17} {'seg':>6}")
+    distintos = 0
+    for lineas in cantidades:
+        factura = factura_por_consumo(lineas)
+        with redirect_stdout(io.StringIO()):
+            (hash_completo, tamano), pico_completo, t_completo = medir_pico(lambda: xml_completo(factura))
+            (hash_bloques, _), pico_bloques, t_bloques = medir_pico(lambda: xml_en_bloques(factura))
+        distintos += hash_completo != hash_bloques
+        print(f"{lineas:>8} {tamano / 1024 / 1024:>10.1f} {pico_completo:>18.2f} {t_completo:>6.2f} "
+              f"{pico_bloques:>17.2f} {t_bloques:>6.2f}")
+
+    if distintos:
+        print("ERROR: el XML en bloques no coincide con el XML completo")
+        sys.exit(1)
+    print("El XML en bloques es identico al completo")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del servicio de webhooks (comando serve) contra servidores simulados
+
+Levanta los servidores de servidores_simulados.py y el ServicioWebhook del
+asistente en un puerto local. Luego crea borradores en el Zoho simulado a un
+ritmo fijo y por cada uno envia el webhook que mandaria Zoho Books. Reporta la
+demora desde el webhook hasta el DTE certificado.
+
+Uso:
+    python benchmark_webhook.py [--facturas 50] [--intervalo 0.1] [--trabajadores 2]
+                                [--latencia 0.05] [--formulario]
+
+Para probar a mano contra `asistente_facturacion.py serve`:
+    python benchmark_webhook.py --enviar http://127.0.0.1:8765/zoho/webhook --ids 980000000001
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from urllib.parse import urlencode
+
+import requests
+
+import archivo_dte
+import asistente_facturacion as asistente
+import bandeja
+import diario
+import indice_fel
+from servidores_simulados import Comportamiento, EstadoSimulado, ServidoresSimulados, resumen_factura
+
+
+def enviar_webhook(url, factura, token='', formulario=False):
+    """Envia el webhook de factura creada como lo hace Zoho Books; devuelve la respuesta"""
+    datos = {'invoice': factura}
+    headers = {'X-Webhook-Token': token} if token else {}
+    if formulario:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return requests.post(url, data=urlencode({'JSONString': json.dumps(datos)}), headers=headers, timeout=10)
+    return requests.post(url, json=datos, headers=headers, timeout=10)
+
+
+def ejecutar(args, directorio):
+    comportamiento = lambda: Comportamiento(latencia=args.latencia, variacion=args.latencia / 2)
+    servidores = ServidoresSimulados(
+        EstadoSimulado(facturas=0, contactos=10, lineas=3),
+        zoho=comportamiento(), infile=comportamiento(), reportes=comportamiento()
+    ).iniciar()
+    config = servidores.config(
+        bandeja={'espera_inicial': 0.5, 'espera_maxima': 2},
+        limite_zoho={'por_minuto': 1000000},
+        webhook={'puerto': 0, 'token': 'prueba', 'trabajadores': args.trabajadores}
+    )
+    indice_fel.INDICE_FEL_FILE = os.path.join(directorio, 'indice.db')
+    asistente.TOKEN_FILE = os.path.join(directorio, 'token.json')
+    bandeja.BANDEJA_FILE = os.path.join(directorio, 'bandeja.db')
+    diario.DIARIO_FILE = os.path.join(directorio, 'diario.db')
+    archivo_dte.ARCHIVO_FEL_DIR = os.path.join(directorio, 'archivo')
+    diario.DIARIO_XML_DIR = os.path.join(directorio, 'diario_xml')
+    asistente.inicializar(config)
+
+    gestor = asistente.GestorToken(config)
+    gestor.obtener()
+    with redirect_stdout(io.StringIO()):
+        trabajadores = asistente.trabajadores_bandeja(config, gestor).iniciar()
+        servicio = asistente.servicio_webhook(config, gestor).iniciar()
+        try:
+            for i in range(args.facturas):
+                factura = servidores.estado.agregar_factura()
+                respuesta = enviar_webhook(servicio.url, resumen_factura(factura), 'prueba', args.formulario)
+                respuesta.raise_for_status()
+                if i % 5 == 0:
+                    # Zoho envia otro webhook cuando se edita el borrador: no debe certificarse dos veces
+                    enviar_webhook(servicio.url, resumen_factura(factura), 'prueba', args.formulario)
+                time.sleep(args.intervalo)
+            rechazado = enviar_webhook(servicio.url, {'invoice_id': '1'}, 'otro').status_code
+            while len(servicio.cola):
+                time.sleep(0.05)
+        finally:
+            servicio.detener()
+            trabajadores.detener()
+            servidores.detener()
+    return servicio.estado(), rechazado, len(servidores.estado.certificados)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark del servicio de webhooks contra servidores simulados')
+    parser.add_argument('--facturas', type=int, default=50, help='Borradores que se crean (un webhook por cada uno)')
+    parser.add_argument('--intervalo', type=float, default=0.1, help='Segundos entre borradores')
+    parser.add_argument('--trabajadores', type=int, default=2, help='Trabajadores del servicio')
+    parser.add_argument('--latencia', type=float, default=0.05, help='Segundos por peticion en cada servicio')
+    parser.add_argument('--formulario', action='store_true', help='Enviar como formulario con JSONString')
+    parser.add_argument('--enviar', metavar='URL', help='Solo enviar webhooks a un serve ya iniciado')
+    parser.add_argument('--ids', nargs='+', default=[], metavar='INVOICE_ID', help='invoice_id para --enviar')
+    parser.add_argument('--token', default='', help='Token del webhook para --enviar')
+    args = parser.parse_args(argv)
+
+    if args.enviar:
+        for invoice_id in args.ids:
+            respuesta = enviar_webhook(args.enviar, {'invoice_id': invoice_id}, args.token, args.formulario)
+            print(f"{invoice_id}: {respuesta.status_code} {respuesta.text}")
+        return 0
+
+    with tempfile.TemporaryDirectory() as directorio:
+        estado, rechazado, certificados = ejecutar(args, directorio)
+
+    print(f"Webhooks recibidos: {estado['recibidos']} | Certificadas: {estado['exitosas']} | "
+          f"Fallidas: {estado['fallidas']} | Omitidas: {estado['omitidas']}")
+    print(f"DTE emitidos en INFILE simulado: {certificados} (de {args.facturas} borradores)")
+    print(f"Demora webhook -> DTE certificado: p50 {estado['demora_p50'] * 1000:.0f} ms, "
+          f"p95 {estado['demora_p95'] * 1000:.0f} ms")
+    print(f"Webhook con token incorrecto: HTTP {rechazado}")
+    return 0 if certificados == estado['exitosas'] == args.facturas and rechazado == 401 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark y prueba de equivalencia de generar_xml_factura
+
+Genera miles de facturas y contactos sinteticos, compara el XML del
+generador con plantillas contra el generador original (copiado abajo como
+referencia) y mide el tiempo de ambos.
+
+Uso:
+    python benchmark_xml.py [cantidad_facturas] [semilla]
+"""
+
+import io
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+import asistente_facturacion as asistente
+
+CONFIG = {
+    'emisor': {
+        'nit': '12345678',
+        'nombre': 'PROYECTOS DE TECNOLOGIA Y COMUNICACIONES, S.A.',
+        'nombre_comercial': 'ADSTTER',
+        'afiliacion_iva': 'GEN',
+        'codigo_establecimiento': '1',
+        'direccion': 'Ciudad de Guatemala',
+        'codigo_postal': '01001',
+        'municipio': 'Guatemala',
+        'departamento': 'Guatemala',
+        'pais': 'GT'
+    },
+    'frases': [
+        {'tipo_frase': '1', 'codigo_escenario': '1'},
+        {'tipo_frase': '2', 'codigo_escenario': '1'}
+    ]
+}
+
+FECHA_EMISION = '2026-01-15T10:30:00-06:00'
+
+PAISES = ['', 'Guatemala', 'GT', 'gua', 'Mexico', 'USA', 'United States', 'España', 'CO', 'sv', 'Narnia', 'ZZ']
+TEXTOS = ['Servicio', 'Consultoria & Soporte', 'Licencia <anual>', 'Plan "Pro"', "Hosting O'Neil", '  Mantenimiento  ', '', 'Diseño gráfico']
+NITS = ['1234567-8', '  98765-4 ', 'CF', 'C/F', 'N/A', '', 'Consumidor Final', '4455667k']
+
+
+def contacto_sintetico(rnd, i):
+    """Contacto con variaciones de NIT, nombre fiscal y pais"""
+    campos = []
+    if rnd.random() < 0.7:
+        campos.append({'label': rnd.choice(['ID DE EMPRESA', 'NIT', 'Tax ID', 'RFC']), 'value': rnd.choice(NITS)})
+    if rnd.random() < 0.5:
+        campos.append({'label': rnd.choice(['NOMBRE A FACTURAR', 'Razon Social']), 'value': rnd.choice(TEXTOS)})
+    return {
+        'contact_id': f'c{i}',
+        'contact_name': rnd.choice(['Cliente & Hijos', 'Empresa <S.A.>', None, 'Juan Perez']),
+        'email': rnd.choice(['', 'cliente@example.com']),
+        'tax_number': rnd.choice(NITS),
+        'custom_fields': campos,
+        'billing_address': {
+            'address': rnd.choice(TEXTOS),
+            'zip': rnd.choice(['', '01010', None]),
+            'city': rnd.choice(TEXTOS),
+            'state': rnd.choice(TEXTOS),
+            'country': rnd.choice(PAISES)
+        }
+    }
+
+
+def factura_sintetica(rnd, i):
+    """Factura con entre 0 y 40 lineas, con y sin descuentos"""
+    return {
+        'invoice_id': f'i{i}',
+        'currency_code': rnd.choice(['GTQ', 'USD']),
+        'line_items': [{
+            'name': rnd.choice(TEXTOS),
+            'description': rnd.choice(TEXTOS),
+            'quantity': rnd.choice([1, 2, 3.5, '4', 12]),
+            'rate': round(rnd.uniform(0, 5000), 2),
+            'discount_amount': rnd.choice([0, None, 10, 33.33])
+        } for _ in range(rnd.randint(0, 40))]
+    }
+
+
+def generar_xml_factura_referencia(config, factura, contacto, fecha_emision):
+    """Generador original (f-strings linea por linea), usado como referencia de salida"""
+    emisor = config['emisor']
+    frases = config['frases']
+
+    # Datos del receptor (cliente)
+    # SIEMPRE buscar primero en campos personalizados (tienen prioridad)
+    nit_receptor = ''
+    custom_fields = contacto.get('custom_fields', [])
+    # Debug: mostrar campos personalizados disponibles
+    if custom_fields:
+        print(f"   [DEBUG] Campos personalizados: {[cf.get('label', '') for cf in custom_fields]}")
+    for cf in custom_fields:
+        label = cf.get('label', '').upper().strip()
+        # Buscar cualquier campo que contenga "NIT" o sea identificador fiscal
+        # Incluye "ID DE EMPRESA" que es donde Zoho guarda el NIT
+        if 'NIT' in label or 'ID DE EMPRESA' in label or label in ['TAX ID', 'TAX NUMBER', 'NUMERO FISCAL', 'ID FISCAL', 'RFC', 'RUC', 'RUT', 'ID EMPRESA']:
+            nit_receptor = cf.get('value', '') or ''
+            if nit_receptor and nit_receptor.upper() not in ['N/A', 'CF', '']:
+                print(f"   [DEBUG] NIT encontrado en campo '{cf.get('label')}': {nit_receptor}")
+                break
+
+    # Si no hay NIT en campos personalizados, usar tax_number como fallback
+    if not nit_receptor or nit_receptor.upper() in ['N/A', 'CF', '']:
+        nit_receptor = contacto.get('tax_number', '') or ''
+
+    # Limpiar NIT - solo numeros, letras y guion
+    nit_receptor = ''.join(c for c in str(nit_receptor) if c.isalnum() or c == '-')
+    # Si esta vacio o es consumidor final
+    if not nit_receptor or nit_receptor.upper() in ['CF', 'C/F', 'CONSUMIDORFINAL', 'CONSUMIDOR FINAL', 'N/A']:
+        nit_receptor = 'CF'
+    # Convertir a mayusculas
+    nit_receptor = nit_receptor.upper()
+
+    # Buscar nombre a facturar en campos personalizados, si no usar contact_name
+    nombre_receptor = ''
+    custom_fields = contacto.get('custom_fields', [])
+    for cf in custom_fields:
+        label = cf.get('label', '').upper()
+        if label in ['NOMBRE A FACTURAR', 'RAZON SOCIAL', 'NOMBRE FISCAL']:
+            nombre_receptor = cf.get('value', '') or ''
+            break
+
+    if not nombre_receptor:
+        nombre_receptor = contacto.get('contact_name') or 'Consumidor Final'
+    email_receptor = contacto.get('email', '') or ''
+    direccion_receptor = contacto.get('billing_address', {}) or {}
+
+    # Moneda
+    moneda = factura.get('currency_code', 'GTQ')
+
+    # Crear XML
+    ns = "http://www.sat.gob.gt/dte/fel/0.2.0"
+    ns_map = {
+        'dte': ns,
+        'xsi': "http://www.w3.org/2001/XMLSchema-instance"
+    }
+
+    # Detectar si es exportacion (pais diferente de Guatemala)
+    # Si el país está vacío o no definido, asumir que es LOCAL (Guatemala)
+    pais_cliente = direccion_receptor.get('country', '') or ''
+    pais_cliente = pais_cliente.strip().lower()
+
+    # Lista de valores que indican Guatemala o local
+    paises_locales = ['guatemala', 'gt', 'gua', '']
+    es_exportacion = pais_cliente not in paises_locales
+
+    # Construir XML como string para mayor control
+    xml_lines = []
+    xml_lines.append('<?xml version="1.0" encoding="UTF-8"?>')
+    xml_lines.append(f'<dte:GTDocumento xmlns:dte="{ns}" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="0.1">')
+    xml_lines.append('  <dte:SAT ClaseDocumento="dte">')
+    xml_lines.append('    <dte:DTE ID="DatosCertificados">')
+    xml_lines.append(f'      <dte:DatosEmision ID="DatosEmision">')
+
+    # Datos Generales - FACT para local, FACT para exportacion de servicios
+    tipo_doc = "FACT"
+    # Para exportacion se agrega atributo Exp
+    if es_exportacion:
+        xml_lines.append(f'        <dte:DatosGenerales CodigoMoneda="{moneda}" Exp="SI" FechaHoraEmision="{fecha_emision}" Tipo="{tipo_doc}"/>')
+    else:
+        xml_lines.append(f'        <dte:DatosGenerales CodigoMoneda="{moneda}" FechaHoraEmision="{fecha_emision}" Tipo="{tipo_doc}"/>')
+
+    # Emisor
+    xml_lines.append(f'        <dte:Emisor AfiliacionIVA="{emisor["afiliacion_iva"]}" CodigoEstablecimiento="{emisor["codigo_establecimiento"]}" CorreoEmisor="" NITEmisor="{emisor["nit"]}" NombreComercial="{emisor["nombre_comercial"]}" NombreEmisor="{emisor["nombre"]}">')
+    xml_lines.append(f'          <dte:DireccionEmisor>')
+    xml_lines.append(f'            <dte:Direccion>{emisor["direccion"]}</dte:Direccion>')
+    xml_lines.append(f'            <dte:CodigoPostal>{emisor["codigo_postal"]}</dte:CodigoPostal>')
+    xml_lines.append(f'            <dte:Municipio>{emisor["municipio"]}</dte:Municipio>')
+    xml_lines.append(f'            <dte:Departamento>{emisor["departamento"]}</dte:Departamento>')
+    xml_lines.append(f'            <dte:Pais>{emisor["pais"]}</dte:Pais>')
+    xml_lines.append(f'          </dte:DireccionEmisor>')
+    xml_lines.append(f'        </dte:Emisor>')
+
+    # Funcion para limpiar texto XML
+    def limpiar_xml(texto):
+        if not texto:
+            return ''
+        texto = str(texto)
+        texto = texto.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;')
+        return texto.strip()
+
+    # Codigos de pais ISO validos
+    codigos_pais_validos = ['AF', 'AL', 'DE', 'AD', 'AO', 'AI', 'AQ', 'AG', 'SA', 'DZ', 'AR', 'AM', 'AW', 'AU', 'AT', 'AZ', 'BS', 'BD', 'BB', 'BH', 'BE', 'BZ', 'BJ', 'BM', 'BY', 'BO', 'BA', 'BW', 'BR', 'BN', 'BG', 'BF', 'BI', 'BT', 'CV', 'KH', 'CM', 'CA', 'QA', 'TD', 'CL', 'CN', 'CY', 'CO', 'KM', 'KP', 'KR', 'CR', 'CI', 'HR', 'CU', 'CW', 'DK', 'DM', 'EC', 'EG', 'SV', 'AE', 'ER', 'SK', 'SI', 'ES', 'US', 'EE', 'ET', 'PH', 'FI', 'FJ', 'FR', 'GA', 'GM', 'GE', 'GH', 'GI', 'GD', 'GR', 'GL', 'GP', 'GU', 'GT', 'GF', 'GG', 'GN', 'GQ', 'GW', 'GY', 'HT', 'HN', 'HK', 'HU', 'IN', 'ID', 'IQ', 'IR', 'IE', 'IS', 'IL', 'IT', 'JM', 'JP', 'JE', 'JO', 'KZ', 'KE', 'KG', 'KI', 'KW', 'LA', 'LS', 'LV', 'LB', 'LR', 'LY', 'LI', 'LT', 'LU', 'MO', 'MK', 'MG', 'MY', 'MW', 'MV', 'ML', 'MT', 'MA', 'MQ', 'MU', 'MR', 'MX', 'FM', 'MD', 'MC', 'MN', 'ME', 'MS', 'MZ', 'MM', 'NA', 'NR', 'NP', 'NI', 'NE', 'NG', 'NO', 'NC', 'NZ', 'OM', 'NL', 'PK', 'PW', 'PS', 'PA', 'PG', 'PY', 'PE', 'PF', 'PL', 'PT', 'PR', 'GB', 'CF', 'CZ', 'CG', 'CD', 'DO', 'RE', 'RW', 'RO', 'RU', 'EH', 'WS', 'AS', 'BL', 'KN', 'SM', 'MF', 'PM', 'VC', 'SH', 'LC', 'ST', 'SN', 'RS', 'SC', 'SL', 'SG', 'SX', 'SY', 'SO', 'LK', 'SZ', 'ZA', 'SD', 'SS', 'SE', 'CH', 'SR', 'TH', 'TW', 'TZ', 'TJ', 'IO', 'TF', 'TL', 'TG', 'TK', 'TO', 'TT', 'TN', 'TM', 'TR', 'TV', 'UA', 'UG', 'UY', 'UZ', 'VU', 'VA', 'VE', 'VN', 'WF', 'YE', 'DJ', 'ZM', 'ZW']
+
+    # Receptor - limpiar todos los campos
+    dir_receptor = limpiar_xml(direccion_receptor.get('address', '')) or 'Ciudad'
+    cp_receptor = direccion_receptor.get('zip', '01001') or '01001'
+    mun_receptor = limpiar_xml(direccion_receptor.get('city', '')) or 'Guatemala'
+    dep_receptor = limpiar_xml(direccion_receptor.get('state', '')) or 'Guatemala'
+    pais_receptor = direccion_receptor.get('country', 'GT') or 'GT'
+
+    # Convertir nombres de pais a codigo ISO
+    paises_nombre_a_codigo = {
+        'guatemala': 'GT', 'mexico': 'MX', 'estados unidos': 'US', 'usa': 'US', 'united states': 'US',
+        'el salvador': 'SV', 'honduras': 'HN', 'nicaragua': 'NI', 'costa rica': 'CR', 'panama': 'PA',
+        'colombia': 'CO', 'españa': 'ES', 'spain': 'ES', 'canada': 'CA', 'argentina': 'AR',
+        'chile': 'CL', 'peru': 'PE', 'brasil': 'BR', 'brazil': 'BR', 'ecuador': 'EC'
+    }
+
+    # Si es nombre de pais, convertir a codigo
+    if pais_receptor.lower() in paises_nombre_a_codigo:
+        pais_receptor = paises_nombre_a_codigo[pais_receptor.lower()]
+
+    # Si no es un codigo valido, usar GT por defecto
+    pais_receptor = pais_receptor.upper()
+    if pais_receptor not in codigos_pais_validos:
+        pais_receptor = 'GT'
+
+    # Limpiar nombre del receptor
+    nombre_receptor = limpiar_xml(nombre_receptor)
+    if not nombre_receptor:
+        nombre_receptor = 'Consumidor Final'
+
+    # Para exportaciones, el ID del receptor debe ser "CF" según normativa SAT
+    id_receptor = "CF" if es_exportacion else nit_receptor
+    xml_lines.append(f'        <dte:Receptor CorreoReceptor="{email_receptor}" IDReceptor="{id_receptor}" NombreReceptor="{nombre_receptor}">')
+    xml_lines.append(f'          <dte:DireccionReceptor>')
+    xml_lines.append(f'            <dte:Direccion>{dir_receptor}</dte:Direccion>')
+    xml_lines.append(f'            <dte:CodigoPostal>{cp_receptor}</dte:CodigoPostal>')
+    xml_lines.append(f'            <dte:Municipio>{mun_receptor}</dte:Municipio>')
+    xml_lines.append(f'            <dte:Departamento>{dep_receptor}</dte:Departamento>')
+    xml_lines.append(f'            <dte:Pais>{pais_receptor}</dte:Pais>')
+    xml_lines.append(f'          </dte:DireccionReceptor>')
+    xml_lines.append(f'        </dte:Receptor>')
+
+    # Frases
+    xml_lines.append('        <dte:Frases>')
+    if es_exportacion:
+        # Para exportaciones: Frase tipo 4 (Exento o no afecto al IVA) es obligatoria
+        xml_lines.append('          <dte:Frase CodigoEscenario="1" TipoFrase="4"/>')
+    else:
+        # Frases normales para ventas locales
+        for frase in frases:
+            xml_lines.append(f'          <dte:Frase CodigoEscenario="{frase["codigo_escenario"]}" TipoFrase="{frase["tipo_frase"]}"/>')
+    xml_lines.append('        </dte:Frases>')
+
+    # Items
+    xml_lines.append('        <dte:Items>')
+    line_items = factura.get('line_items', [])
+    total_iva_calculado = 0
+    gran_total_calculado = 0
+
+    for i, item in enumerate(line_items, 1):
+        cantidad = float(item.get('quantity', 1))
+        # rate en Zoho es el precio SIN IVA
+        precio_sin_iva = float(item.get('rate', 0))
+        descuento = float(item.get('discount_amount', 0) or 0)
+
+        # Combinar nombre del producto + descripcion
+        nombre_producto = item.get('name', '') or ''
+        descripcion_adicional = item.get('description', '') or ''
+
+        # Crear descripcion completa: "Nombre - Descripcion" o solo uno si el otro esta vacio
+        if nombre_producto and descripcion_adicional:
+            descripcion = f"{nombre_producto} - {descripcion_adicional}"
+        else:
+            descripcion = nombre_producto or descripcion_adicional or 'Servicio'
+
+        descripcion = limpiar_xml(descripcion)
+
+        # Calcular montos - diferente para exportacion vs local
+        if es_exportacion:
+            # EXPORTACION: Sin IVA
+            precio_unitario = precio_sin_iva
+            precio_total = cantidad * precio_unitario
+            monto_gravable = (cantidad * precio_sin_iva) - descuento
+            monto_impuesto = 0  # Sin IVA para exportaciones
+            total_linea = monto_gravable
+            codigo_unidad_gravable = "2"  # 2 = Exento
+        else:
+            # LOCAL: Con IVA 12%
+            precio_unitario_con_iva = precio_sin_iva * 1.12
+            precio_total = cantidad * precio_unitario_con_iva
+            monto_gravable = (cantidad * precio_sin_iva) - descuento
+            monto_impuesto = monto_gravable * 0.12
+            total_linea = monto_gravable + monto_impuesto
+            precio_unitario = precio_unitario_con_iva
+            codigo_unidad_gravable = "1"  # 1 = Gravado
+
+        total_iva_calculado += monto_impuesto
+        gran_total_calculado += total_linea
+
+        xml_lines.append(f'          <dte:Item BienOServicio="S" NumeroLinea="{i}">')
+        xml_lines.append(f'            <dte:Cantidad>{cantidad:.2f}</dte:Cantidad>')
+        xml_lines.append(f'            <dte:UnidadMedida>UND</dte:UnidadMedida>')
+        xml_lines.append(f'            <dte:Descripcion>{descripcion}</dte:Descripcion>')
+        xml_lines.append(f'            <dte:PrecioUnitario>{precio_unitario:.6f}</dte:PrecioUnitario>')
+        xml_lines.append(f'            <dte:Precio>{precio_total:.6f}</dte:Precio>')
+        xml_lines.append(f'            <dte:Descuento>{descuento:.6f}</dte:Descuento>')
+        xml_lines.append('            <dte:Impuestos>')
+        xml_lines.append('              <dte:Impuesto>')
+        xml_lines.append(f'                <dte:NombreCorto>IVA</dte:NombreCorto>')
+        xml_lines.append(f'                <dte:CodigoUnidadGravable>{codigo_unidad_gravable}</dte:CodigoUnidadGravable>')
+        xml_lines.append(f'                <dte:MontoGravable>{monto_gravable:.6f}</dte:MontoGravable>')
+        xml_lines.append(f'                <dte:MontoImpuesto>{monto_impuesto:.6f}</dte:MontoImpuesto>')
+        xml_lines.append('              </dte:Impuesto>')
+        xml_lines.append('            </dte:Impuestos>')
+        xml_lines.append(f'            <dte:Total>{total_linea:.6f}</dte:Total>')
+        xml_lines.append('          </dte:Item>')
+    xml_lines.append('        </dte:Items>')
+
+    # Totales - usar los valores calculados para consistencia
+    xml_lines.append('        <dte:Totales>')
+    xml_lines.append('          <dte:TotalImpuestos>')
+    xml_lines.append(f'            <dte:TotalImpuesto NombreCorto="IVA" TotalMontoImpuesto="{total_iva_calculado:.6f}"/>')
+    xml_lines.append('          </dte:TotalImpuestos>')
+    xml_lines.append(f'          <dte:GranTotal>{gran_total_calculado:.6f}</dte:GranTotal>')
+    xml_lines.append('        </dte:Totales>')
+
+    # Complemento de Exportación (obligatorio para exportaciones)
+    if es_exportacion:
+        # Namespace del complemento de exportación
+        ns_exp = "http://www.sat.gob.gt/face2/ComplementoExportaciones/0.1.0"
+
+        # Datos del comprador/destinatario (usar datos del receptor)
+        nombre_comprador = limpiar_xml(nombre_receptor)
+        direccion_comprador = f"{dir_receptor}, {mun_receptor}, {dep_receptor}"
+        direccion_comprador = limpiar_xml(direccion_comprador)
+
+        xml_lines.append('        <dte:Complementos>')
+        xml_lines.append(f'          <dte:Complemento IDComplemento="ID_EXPORTACION" NombreComplemento="Exportacion" URIComplemento="{ns_exp}">')
+        xml_lines.append(f'            <cex:Exportacion xmlns:cex="{ns_exp}" Version="1">')
+        xml_lines.append(f'              <cex:NombreConsignatarioODestinatario>{nombre_comprador}</cex:NombreConsignatarioODestinatario>')
+        xml_lines.append(f'              <cex:DireccionConsignatario>{direccion_comprador}</cex:DireccionConsignatario>')
+        xml_lines.append(f'              <cex:NombreComprador>{nombre_comprador}</cex:NombreComprador>')
+        xml_lines.append(f'              <cex:DireccionComprador>{direccion_comprador}</cex:DireccionComprador>')
+        xml_lines.append(f'              <cex:CodigoComprador>CF</cex:CodigoComprador>')
+        xml_lines.append(f'              <cex:NombreExportador>{limpiar_xml(emisor["nombre"])}</cex:NombreExportador>')
+        xml_lines.append(f'              <cex:CodigoExportador>{emisor["nit"]}</cex:CodigoExportador>')
+        xml_lines.append('            </cex:Exportacion>')
+        xml_lines.append('          </dte:Complemento>')
+        xml_lines.append('        </dte:Complementos>')
+
+    xml_lines.append('      </dte:DatosEmision>')
+    xml_lines.append('    </dte:DTE>')
+    xml_lines.append('  </dte:SAT>')
+    xml_lines.append('</dte:GTDocumento>')
+
+    return '\n'.join(xml_lines)
+
+
+def medir(funcion, casos):
+    """Segundos que tarda funcion en generar el XML de todos los casos"""
+    inicio = time.perf_counter()
+    for factura, contacto in casos:
+        funcion(CONFIG, factura, contacto, FECHA_EMISION)
+    return time.perf_counter() - inicio
+
+
+def main():
+    cantidad = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    semilla = int(sys.argv[2]) if len(sys.argv) > 2 else 2026
+    rnd = random.Random(semilla)
+    casos = [(factura_sintetica(rnd, i), contacto_sintetico(rnd, i)) for i in range(cantidad)]
+    # El asistente recibe la Factura y el Contacto ya leidos de Zoho
+    modelos = [(asistente.Factura.desde_zoho(factura), asistente.Contacto.desde_zoho(contacto))
+               for factura, contacto in casos]
+
+    with redirect_stdout(io.StringIO()):
+        diferencias = [
+            i for i, ((factura, contacto), (modelo, cliente)) in enumerate(zip(casos, modelos))
+            if asistente.generar_xml_factura(CONFIG, modelo, cliente, FECHA_EMISION)
+            != generar_xml_factura_referencia(CONFIG, factura, contacto, FECHA_EMISION)
+        ]
+        t_referencia = medir(generar_xml_factura_referencia, casos)
+        t_plantillas = medir(asistente.generar_xml_factura, modelos)
+
+    lineas = sum(len(factura['line_items']) for factura, _ in casos)
+    print(f"Facturas: {cantidad} ({lineas} lineas)")
+    print(f"Equivalencia: {cantidad - len(diferencias)}/{cantidad} identicas")
+    print(f"Referencia: {t_referencia:.3f} s ({cantidad / t_referencia:,.0f} facturas/s)")
+    print(f"Plantillas: {t_plantillas:.3f} s ({cantidad / t_plantillas:,.0f} facturas/s)")
+    print(f"Mejora: {t_referencia / t_plantillas:.2f}x")
+
+    if diferencias:
+        print(f"Primeras facturas distintas: {diferencias[:10]}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
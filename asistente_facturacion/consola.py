@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Salida de consola por hilo del Asistente de Facturacion.
+
+Los print() de cada hilo se pueden capturar en un buffer para mostrar el
+resultado de cada factura de una sola vez, en orden estable.
+"""
+
+import sys
+import threading
+from contextlib import contextmanager
+
+_salida_lock = threading.Lock()
+
+class _SalidaPorHilo:
+    """Redirige print() al buffer del hilo actual para imprimir resultados en orden estable"""
+
+    def __init__(self, original):
+        self.original = original
+        self.local = threading.local()
+
+    def write(self, texto):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            return buffer.write(texto)
+        return self.original.write(texto)
+
+    def flush(self):
+        self.original.flush()
+
+    def __getattr__(self, nombre):
+        return getattr(self.original, nombre)
+
+def instalar_salida_por_hilo():
+    """Envuelve sys.stdout una sola vez (con lock) para que capturar_salida separe la salida de cada hilo"""
+    with _salida_lock:
+        if not isinstance(sys.stdout, _SalidaPorHilo):
+            sys.stdout = _SalidaPorHilo(sys.stdout)
+        return sys.stdout
+
+@contextmanager
+def capturar_salida(buffer):
+    """Envia los print() del hilo actual a buffer mientras dure el bloque"""
+    salida = sys.stdout
+    if not isinstance(salida, _SalidaPorHilo):
+        salida = instalar_salida_por_hilo()
+    anterior = getattr(salida.local, 'buffer', None)
+    salida.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        salida.local.buffer = anterior
+
+def escribir_consola(texto):
+    """Escribe directo en la consola, aunque el hilo actual tenga la salida capturada"""
+    salida = sys.stdout
+    if isinstance(salida, _SalidaPorHilo):
+        salida = salida.original
+    salida.write(texto)
+    salida.flush()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Diario de etapas de certificacion y anulacion (SQLite en modo WAL).
+
+Cada transicion queda en disco antes de pasar a la siguiente etapa; al
+reanudar, el diario dice en que etapa quedo cada factura. El XML que se
+envia a INFILE queda en DIARIO_XML_DIR hasta que la factura llega a una etapa final.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DIARIO_FILE = os.path.join(SCRIPT_DIR, 'diario_fel.db')
+DIARIO_XML_DIR = os.path.join(SCRIPT_DIR, 'diario_xml')
+
+# Etapas del diario en que la operacion de una factura ya no tiene nada pendiente
+ETAPAS_FINALES_DIARIO = ('completado', 'rechazado')
+
+_diario_lock = threading.Lock()
+
+def conectar_diario():
+    """Abre el diario de etapas (SQLite en modo WAL), creando la tabla si no existe"""
+    conexion = sqlite3.connect(DIARIO_FILE, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    conexion.execute("PRAGMA journal_mode=WAL")
+    conexion.execute("PRAGMA synchronous=FULL")
+    conexion.execute("""
+        CREATE TABLE IF NOT EXISTS transiciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operacion TEXT,
+            invoice_id TEXT,
+            invoice_number TEXT,
+            etapa TEXT,
+            datos TEXT,
+            momento TEXT
+        )
+    """)
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_transiciones_factura ON transiciones (operacion, invoice_id, id)")
+    return conexion
+
+def identificador_estable(prefijo, invoice_id, huella):
+    """Identificador para INFILE que solo depende de la factura y de la huella (SHA-256) del XML enviado.
+
+    Reenviar el mismo XML (por ejemplo al reanudar) repite el identificador, y
+    INFILE responde con el documento ya certificado en vez de emitir otro.
+    """
+    resumen = huella.hex()[:16]
+    return f"{prefijo}_{invoice_id}_{resumen}"
+
+def ruta_xml_diario(huella):
+    return os.path.join(DIARIO_XML_DIR, f"{huella.hex()}.xml")
+
+def guardar_xml_diario(bloques):
+    """Guarda en DIARIO_XML_DIR el XML (bloques de bytes) que se va a enviar a INFILE y devuelve su huella.
+
+    La huella (SHA-256) se calcula mientras se escribe; el diario guarda solo
+    la huella y el XML queda en disco hasta que la factura llega a una etapa final.
+    """
+    os.makedirs(DIARIO_XML_DIR, exist_ok=True)
+    temporal = os.path.join(DIARIO_XML_DIR, f"{uuid.uuid4().hex}.tmp")
+    resumen = hashlib.sha256()
+    try:
+        with open(temporal, 'wb') as f:
+            for bloque in bloques:
+                resumen.update(bloque)
+                f.write(bloque)
+        huella = resumen.digest()
+        os.replace(temporal, ruta_xml_diario(huella))
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return huella
+
+def descartar_xml_diario(huella):
+    """Borra el XML del diario de una factura que ya llego a una etapa final"""
+    try:
+        os.remove(ruta_xml_diario(huella))
+    except FileNotFoundError:
+        pass
+
+def registrar_etapa(operacion, invoice_id, invoice_number, etapa, **datos):
+    """Agrega una transicion al diario; queda en disco antes de pasar a la siguiente etapa"""
+    fila = (operacion, invoice_id, invoice_number, etapa, json.dumps(datos, ensure_ascii=False),
+            datetime.now().isoformat(timespec='seconds'))
+    with _diario_lock:
+        conexion = conectar_diario()
+        try:
+            with conexion:
+                conexion.execute(
+                    "INSERT INTO transiciones (operacion, invoice_id, invoice_number, etapa, datos, momento) VALUES (?, ?, ?, ?, ?, ?)",
+                    fila
+                )
+        finally:
+            conexion.close()
+
+def estado_diario(operacion, invoice_id):
+    """Ultima etapa de la factura y los datos acumulados de todas sus transiciones ({} si no hay)"""
+    with _diario_lock:
+        conexion = conectar_diario()
+        try:
+            filas = conexion.execute(
+                "SELECT etapa, datos FROM transiciones WHERE operacion = ? AND invoice_id = ? ORDER BY id",
+                (operacion, invoice_id)
+            ).fetchall()
+        finally:
+            conexion.close()
+    estado = {}
+    for fila in filas:
+        # Cada 'xml_generado' abre un intento nuevo (por ejemplo despues de un rechazo)
+        if fila['etapa'] == 'xml_generado':
+            estado = {}
+        estado.update(json.loads(fila['datos']))
+        estado['etapa'] = fila['etapa']
+    return estado
+
+def pendientes_diario(operacion):
+    """Facturas cuya ultima etapa no es final (el programa se cerro a medias), como dicts de factura"""
+    with _diario_lock:
+        conexion = conectar_diario()
+        try:
+            filas = conexion.execute("""
+                SELECT t.invoice_id, t.invoice_number, t.etapa, t.datos FROM transiciones t
+                JOIN (SELECT invoice_id, MAX(id) AS ultimo FROM transiciones WHERE operacion = ? GROUP BY invoice_id) u
+                  ON t.id = u.ultimo
+                ORDER BY t.id
+            """, (operacion,)).fetchall()
+        finally:
+            conexion.close()
+    pendientes = []
+    for fila in filas:
+        if fila['etapa'] in ETAPAS_FINALES_DIARIO:
+            continue
+        factura = {'invoice_id': fila['invoice_id'], 'invoice_number': fila['invoice_number'], '_etapa': fila['etapa']}
+        if operacion == 'anulacion':
+            factura['_fel_uuid'] = estado_diario(operacion, fila['invoice_id']).get('uuid', '')
+        pendientes.append(factura)
+    return pendientes
+
+def dte_certificados_diario():
+    """UUID que INFILE certifico segun el diario, por factura: {invoice_id: {'invoice_number', 'uuid'}}"""
+    with _diario_lock:
+        conexion = conectar_diario()
+        try:
+            filas = conexion.execute(
+                "SELECT invoice_id, invoice_number, datos FROM transiciones "
+                "WHERE operacion = 'certificacion' AND etapa = 'certificado' ORDER BY id"
+            ).fetchall()
+        finally:
+            conexion.close()
+    certificados = {}
+    for fila in filas:
+        uuid_fel = json.loads(fila['datos']).get('resultado', {}).get('uuid')
+        if uuid_fel:
+            certificados[fila['invoice_id']] = {'invoice_number': fila['invoice_number'], 'uuid': uuid_fel}
+    return certificados
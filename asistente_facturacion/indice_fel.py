@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Indice local (SQLite): facturas certificadas, copia de los listados de Zoho y verificaciones en SAT.
+
+Aqui solo se guarda y se consulta; lo que pide datos a Zoho o a INFILE esta en asistente_facturacion.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from traza import medir
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+INDICE_FEL_FILE = os.path.join(SCRIPT_DIR, 'indice_fel.db')
+
+# Copia local de facturas y contactos de Zoho (seccion "sincronizacion" de config.json)
+# Cada sincronizacion pide solo lo modificado desde la ultima marca de last_modified_time;
+# los borradores eliminados en Zoho se quitan en cada pasada comparando solo los invoice_id del listado
+# de borradores; cada completa_cada_horas se descarga todo para quitar el resto de lo que se borro en Zoho
+OPCIONES_SINCRONIZACION = {
+    'habilitada': True,
+    'completa_cada_horas': 24
+}
+
+# Listados de Zoho que se copian: ruta, clave del listado, clave primaria, campo de nombre y tabla local
+RECURSOS_SINCRONIZACION = {
+    'contactos': ('contacts', 'contacts', 'contact_id', 'contact_name', 'contactos_zoho'),
+    'facturas': ('invoices', 'invoices', 'invoice_id', 'invoice_number', 'facturas_zoho')
+}
+
+_indice_lock = threading.Lock()
+
+def conectar_indice():
+    """Abre el indice local de facturas certificadas (SQLite), creando la tabla si no existe"""
+    conexion = sqlite3.connect(INDICE_FEL_FILE, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    conexion.execute("""
+        CREATE TABLE IF NOT EXISTS facturas_fel (
+            invoice_id TEXT PRIMARY KEY,
+            invoice_number TEXT,
+            customer_id TEXT,
+            customer_name TEXT,
+            uuid TEXT,
+            serie TEXT,
+            numero TEXT,
+            fecha_certificacion TEXT,
+            estado TEXT,
+            actualizado TEXT
+        )
+    """)
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_facturas_fel_estado ON facturas_fel (estado, fecha_certificacion)")
+    conexion.execute("CREATE INDEX IF NOT EXISTS idx_facturas_fel_uuid ON facturas_fel (uuid)")
+    conexion.execute("CREATE TABLE IF NOT EXISTS marcas_indice (clave TEXT PRIMARY KEY, valor TEXT)")
+    return conexion
+
+def indice_completo():
+    """True si el indice ya se lleno una vez con todas las facturas certificadas de Zoho"""
+    with _indice_lock:
+        conexion = conectar_indice()
+        try:
+            return conexion.execute("SELECT 1 FROM marcas_indice WHERE clave = 'carga_completa'").fetchone() is not None
+        finally:
+            conexion.close()
+
+def marcar_indice_completo():
+    """Registra que el indice ya tiene todas las certificadas de Zoho (las anteriores a el incluidas)"""
+    with _indice_lock:
+        conexion = conectar_indice()
+        try:
+            with conexion:
+                conexion.execute("INSERT OR REPLACE INTO marcas_indice VALUES ('carga_completa', ?)",
+                                 (datetime.now().isoformat(timespec='seconds'),))
+        finally:
+            conexion.close()
+
+@medir('indice')
+def registrar_factura_indice(invoice_id, invoice_number, customer_id, customer_name, datos_certificacion, estado='Certificada'):
+    """Guarda (o reemplaza) una factura certificada (DatosCertificacion) en el indice local"""
+    fila = (
+        invoice_id, invoice_number, customer_id, customer_name,
+        datos_certificacion.uuid, datos_certificacion.serie,
+        datos_certificacion.numero, datos_certificacion.fecha,
+        estado, datetime.now().isoformat(timespec='seconds')
+    )
+    with _indice_lock:
+        conexion = conectar_indice()
+        try:
+            with conexion:
+                conexion.execute("INSERT OR REPLACE INTO facturas_fel VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", fila)
+        finally:
+            conexion.close()
+
+def marcar_anulada_indice(invoice_id):
+    """Cambia el estado de una factura del indice local a Anulada"""
+    with _indice_lock:
+        conexion = conectar_indice()
+        try:
+            with conexion:
+                conexion.execute(
+                    "UPDATE facturas_fel SET estado = 'Anulada', actualizado = ? WHERE invoice_id = ?",
+                    (datetime.now().isoformat(timespec='seconds'), invoice_id)
+                )
+        finally:
+            conexion.close()
+
+def listar_certificadas_indice():
+    """Devuelve las facturas Certificadas del indice local con el formato del menu de anulacion"""
+    with _indice_lock:
+        conexion = conectar_indice()
+        try:
+            filas = conexion.execute(
+                "SELECT * FROM facturas_fel WHERE estado = 'Certificada' ORDER BY fecha_certificacion DESC"
+            ).fetchall()
+        finally:
+            conexion.close()
+    return [{
+        'invoice_id': fila['invoice_id'],
+        'invoice_number': fila['invoice_number'],
+        'customer_id': fila['customer_id'],
+        'customer_name': fila['customer_name'],
+        '_fel_uuid': fila['uuid']
+    } for fila in filas]
+
+def registrar_detalle_indice(factura):
+    """Guarda en el indice local una Factura de Zoho con sus campos fel_*"""
+    certificacion = factura.certificacion
+    estado = 'Anulada' if factura.status == 'void' else certificacion.estado
+    registrar_factura_indice(factura.invoice_id, factura.invoice_number, factura.customer_id,
+                             factura.customer_name, certificacion, estado)
+
+def conectar_copia_local():
+    """Abre el indice local con las tablas de la copia de Zoho (facturas, contactos y marcas)"""
+    conexion = conectar_indice()
+    conexion.executescript("""
+        CREATE TABLE IF NOT EXISTS facturas_zoho (
+            invoice_id TEXT PRIMARY KEY,
+            status TEXT,
+            fecha TEXT,
+            nombre TEXT,
+            last_modified_time TEXT,
+            datos TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_facturas_zoho_status ON facturas_zoho (status, fecha);
+        CREATE TABLE IF NOT EXISTS contactos_zoho (
+            contact_id TEXT PRIMARY KEY,
+            status TEXT,
+            fecha TEXT,
+            nombre TEXT,
+            last_modified_time TEXT,
+            datos TEXT
+        );
+        CREATE TABLE IF NOT EXISTS marcas_sincronizacion (
+            recurso TEXT PRIMARY KEY,
+            marca TEXT,
+            ultima_completa REAL
+        );
+    """)
+    return conexion
+
+def instante_zoho(texto):
+    """Convierte un last_modified_time de Zoho (2026-01-31T10:20:30-0600) a datetime; None si no se entiende"""
+    try:
+        return datetime.strptime(texto, '%Y-%m-%dT%H:%M:%S%z')
+    except (TypeError, ValueError):
+        return None
+
+def marca_sincronizacion(recurso):
+    """(marca de last_modified_time, time.time() de la ultima sincronizacion completa) del recurso; (None, 0) si nunca se sincronizo"""
+    with _indice_lock:
+        conexion = conectar_copia_local()
+        try:
+            fila = conexion.execute("SELECT marca, ultima_completa FROM marcas_sincronizacion WHERE recurso = ?",
+                                    (recurso,)).fetchone()
+        finally:
+            conexion.close()
+    return (fila['marca'], fila['ultima_completa'] or 0) if fila else (None, 0)
+
+def guardar_sincronizacion(recurso, registros, completa):
+    """Copia a la tabla local los registros de un listado de Zoho y avanza la marca del recurso.
+
+    Solo se escriben los nuevos o con otro last_modified_time, que es lo que se
+    devuelve. Con completa=True el listado es todo lo que hay en Zoho y se borra
+    de la copia lo que no vino.
+    """
+    _, _, campo_id, campo_nombre, tabla = RECURSOS_SINCRONIZACION[recurso]
+    with _indice_lock:
+        conexion = conectar_copia_local()
+        try:
+            fila = conexion.execute("SELECT marca, ultima_completa FROM marcas_sincronizacion WHERE recurso = ?",
+                                    (recurso,)).fetchone()
+            anteriores = dict(conexion.execute(f"SELECT {campo_id}, last_modified_time FROM {tabla}").fetchall())
+            marca = fila['marca'] if fila else None
+
+            cambiados, vistos = [], set()
+            nueva_marca, instante_marca = marca, instante_zoho(marca)
+            for registro in registros:
+                identificador = str(registro.get(campo_id))
+                vistos.add(identificador)
+                modificado = registro.get('last_modified_time', '')
+                if anteriores.get(identificador) != modificado:
+                    cambiados.append(registro)
+                instante = instante_zoho(modificado)
+                if instante and (instante_marca is None or instante > instante_marca):
+                    nueva_marca, instante_marca = modificado, instante
+
+            with conexion:
+                conexion.executemany(f"INSERT OR REPLACE INTO {tabla} VALUES (?, ?, ?, ?, ?, ?)", [(
+                    str(registro.get(campo_id)), registro.get('status', ''), registro.get('date', ''),
+                    registro.get(campo_nombre, ''), registro.get('last_modified_time', ''),
+                    json.dumps(registro, ensure_ascii=False)
+                ) for registro in cambiados])
+                if completa:
+                    borrados = [(i,) for i in anteriores if i not in vistos]
+                    conexion.executemany(f"DELETE FROM {tabla} WHERE {campo_id} = ?", borrados)
+                conexion.execute(
+                    "INSERT OR REPLACE INTO marcas_sincronizacion VALUES (?, ?, ?)",
+                    (recurso, nueva_marca, time.time() if completa else fila['ultima_completa'])
+                )
+        finally:
+            conexion.close()
+    return cambiados
+
+def quitar_borradores_ausentes(en_zoho):
+    """Quita de la copia local los borradores cuyo invoice_id no esta en en_zoho; devuelve los quitados"""
+    with _indice_lock:
+        conexion = conectar_copia_local()
+        try:
+            locales = [fila['invoice_id'] for fila in conexion.execute("SELECT invoice_id FROM facturas_zoho WHERE status = 'draft'")]
+        finally:
+            conexion.close()
+    borradas = [i for i in locales if i not in en_zoho]
+    if borradas:
+        descartar_copia_local(borradas)
+    return borradas
+
+def descartar_copia_local(invoice_ids):
+    """Quita facturas de la copia local (borradas en Zoho)"""
+    with _indice_lock:
+        conexion = conectar_copia_local()
+        try:
+            with conexion:
+                conexion.executemany("DELETE FROM facturas_zoho WHERE invoice_id = ?", [(str(i),) for i in invoice_ids])
+        finally:
+            conexion.close()
+
+def listar_copia_local(status):
+    """Facturas de la copia local con el status indicado, las mas recientes primero"""
+    with _indice_lock:
+        conexion = conectar_copia_local()
+        try:
+            filas = conexion.execute(
+                "SELECT datos FROM facturas_zoho WHERE status = ? ORDER BY fecha DESC, nombre DESC", (status,)
+            ).fetchall()
+        finally:
+            conexion.close()
+    return [json.loads(fila['datos']) for fila in filas]
+
+def sincronizacion_habilitada(config):
+    opciones = dict(OPCIONES_SINCRONIZACION)
+    opciones.update(config.get('sincronizacion', {}))
+    return bool(opciones['habilitada'])
+
+def conectar_verificaciones():
+    """Abre el indice local con las tablas de verificaciones en SAT (UUID y NIT) y los campos fel_* de Zoho"""
+    conexion = conectar_indice()
+    conexion.executescript("""
+        CREATE TABLE IF NOT EXISTS uuids_verificados (
+            uuid TEXT PRIMARY KEY,
+            estado_sat TEXT,
+            serie TEXT,
+            numero TEXT,
+            verificado REAL
+        );
+        CREATE TABLE IF NOT EXISTS nits_verificados (
+            nit TEXT PRIMARY KEY,
+            nombre TEXT,
+            encontrado INTEGER,
+            verificado REAL
+        );
+        CREATE TABLE IF NOT EXISTS fel_zoho (
+            invoice_id TEXT PRIMARY KEY,
+            last_modified_time TEXT,
+            invoice_number TEXT,
+            status TEXT,
+            fel_uuid TEXT,
+            fel_estado TEXT
+        );
+    """)
+    return conexion
+
+def nit_verificado(nit):
+    """Ultima verificacion guardada del NIT ({'nombre', 'encontrado', 'verificado'}) o None"""
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            fila = conexion.execute("SELECT * FROM nits_verificados WHERE nit = ?", (nit,)).fetchone()
+        finally:
+            conexion.close()
+    return dict(fila) if fila else None
+
+def guardar_nit_verificado(nit, nombre, encontrado):
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            with conexion:
+                conexion.execute("INSERT OR REPLACE INTO nits_verificados VALUES (?, ?, ?, ?)",
+                                 (nit, nombre, int(encontrado), time.time()))
+        finally:
+            conexion.close()
+
+def fel_zoho_guardados():
+    """Campos fel_* de Zoho guardados en la ultima conciliacion ({invoice_id: {...}})"""
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            return {fila['invoice_id']: dict(fila) for fila in conexion.execute("SELECT * FROM fel_zoho")}
+        finally:
+            conexion.close()
+
+def guardar_fel_zoho(filas):
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            with conexion:
+                conexion.executemany("INSERT OR REPLACE INTO fel_zoho VALUES (?, ?, ?, ?, ?, ?)", [(
+                    fila['invoice_id'], fila['last_modified_time'], fila['invoice_number'],
+                    fila['status'], fila['fel_uuid'], fila['fel_estado']
+                ) for fila in filas])
+        finally:
+            conexion.close()
+
+def uuids_verificados():
+    """UUID ya consultados en SAT ({uuid: {'estado_sat', 'serie', 'numero', 'verificado'}})"""
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            return {fila['uuid']: dict(fila) for fila in conexion.execute("SELECT * FROM uuids_verificados")}
+        finally:
+            conexion.close()
+
+def guardar_uuids_verificados(consultas):
+    """Guarda las consultas a SAT que trajeron estado"""
+    with _indice_lock:
+        conexion = conectar_verificaciones()
+        try:
+            with conexion:
+                conexion.executemany("INSERT OR REPLACE INTO uuids_verificados VALUES (?, ?, ?, ?, ?)", [(
+                    consulta['uuid'], consulta['estado_sat'], consulta.get('serie', ''),
+                    consulta.get('numero', ''), time.time()
+                ) for consulta in consultas if consulta['estado_sat']])
+        finally:
+            conexion.close()
@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+"""
+Servidores simulados de Zoho Books, INFILE y report.feel.com.gt
+
+Imitan los endpoints que usa el asistente, incluida la consulta de NIT de
+INFILE, para poder medir y probar los flujos de certificacion y anulacion
+sin tocar produccion. Cada servicio
+escucha en su propio puerto local y tiene latencia, tasa de errores 5xx y
+tasa de respuestas 429 configurables, ademas de una cuota de peticiones por
+minuto que responde 429 con Retry-After al excederse.
+
+Uso:
+    python servidores_simulados.py [--facturas 100] [--latencia-zoho 0.05] ...
+
+Escribe config_simulado.json con las URLs locales para usarlo con:
+    python asistente_facturacion.py --config config_simulado.json certify --all-drafts
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# PDF minimo valido para las descargas de report.feel.com.gt
+PDF_SIMULADO = (
+    b'%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+    b'2 0 obj<</Type/Pages/Count 0/Kids[]>>endobj\ntrailer<</Root 1 0 R>>\n%%EOF\n'
+)
+
+CONFIG_BASE = {
+    'emisor': {
+        'nit': '12345679',
+        'nombre': 'PROYECTOS DE TECNOLOGIA Y COMUNICACIONES, S.A.',
+        'nombre_comercial': 'ADSTTER',
+        'afiliacion_iva': 'GEN',
+        'codigo_establecimiento': '1',
+        'direccion': 'Ciudad de Guatemala',
+        'codigo_postal': '01001',
+        'municipio': 'Guatemala',
+        'departamento': 'Guatemala',
+        'pais': 'GT'
+    },
+    'frases': [
+        {'tipo_frase': '1', 'codigo_escenario': '1'}
+    ]
+}
+
+
+class Comportamiento:
+    """Latencia, errores y limites de un servicio simulado"""
+
+    def __init__(self, latencia=0.0, variacion=0.0, tasa_error=0.0, tasa_429=0.0, retry_after=1, cuota_por_minuto=0):
+        self.latencia = latencia
+        self.variacion = variacion
+        self.tasa_error = tasa_error
+        self.tasa_429 = tasa_429
+        self.retry_after = retry_after
+        self.cuota_por_minuto = cuota_por_minuto
+        self.recientes = deque()
+        self.excedidas = 0
+        self.lock = threading.Lock()
+
+    def consumir_cuota(self):
+        """Cuenta una peticion en la ventana de 60 s; devuelve (segundos de Retry-After o None, restantes)"""
+        if not self.cuota_por_minuto:
+            return None, None
+        with self.lock:
+            ahora = time.monotonic()
+            while self.recientes and self.recientes[0] <= ahora - 60:
+                self.recientes.popleft()
+            if len(self.recientes) >= self.cuota_por_minuto:
+                self.excedidas += 1
+                return max(1, int(self.recientes[0] + 60 - ahora + 0.999)), 0
+            self.recientes.append(ahora)
+            return None, self.cuota_por_minuto - len(self.recientes)
+
+
+class EstadoSimulado:
+    """Facturas, contactos y documentos certificados compartidos por los servidores"""
+
+    def __init__(self, facturas=10, contactos=5, lineas=3, semilla=2026):
+        self.lock = threading.Lock()
+        self.rnd = random.Random(semilla)
+        self.tokens = set()
+        self.contactos = {}
+        self.facturas = {}
+        self.certificados = {}
+        self.por_identificador = {}
+        self.adjuntos = {}
+        self.correos = []
+        self.solicitudes = {}
+        # Padron de NIT de SAT para la consulta de receptores: NIT sin guion -> nombre
+        self.nits = {}
+        for i in range(contactos):
+            self.agregar_contacto(f"{460000000000 + i}", f"Cliente {i}")
+        for i in range(facturas):
+            self.agregar_factura(lineas=lineas)
+
+    def agregar_contacto(self, contact_id, nombre, pais='Guatemala', nit=None):
+        ahora = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-0600')
+        nit = nit or nit_simulado(1000000 + len(self.contactos))
+        self.nits[nit.replace('-', '').upper()] = f"{nombre.upper()}, SOCIEDAD ANONIMA"
+        self.contactos[contact_id] = {
+            'contact_id': contact_id,
+            'contact_name': nombre,
+            'company_name': f"{nombre}, S.A.",
+            'email': f"facturas{len(self.contactos)}@example.com",
+            'tax_number': '',
+            'last_modified_time': ahora,
+            'custom_fields': [
+                {'label': 'ID DE EMPRESA', 'value': nit},
+                {'label': 'NOMBRE A FACTURAR', 'value': f"{nombre.upper()}, SOCIEDAD ANONIMA"}
+            ],
+            'billing_address': {
+                'address': '5a Avenida 10-20 Zona 1', 'city': 'Guatemala',
+                'state': 'Guatemala', 'zip': '01001', 'country': pais
+            }
+        }
+        return self.contactos[contact_id]
+
+    def agregar_factura(self, contact_id=None, lineas=3, status='draft'):
+        with self.lock:
+            numero = len(self.facturas) + 1
+            invoice_id = f"{980000000000 + numero}"
+            contact_id = contact_id or list(self.contactos)[numero % len(self.contactos)]
+            items = [{
+                'line_item_id': f"{invoice_id}{j}",
+                'name': f"Servicio {j + 1}",
+                'description': 'Periodo mensual',
+                'quantity': 1 + j % 3,
+                'rate': round(self.rnd.uniform(50, 400), 2),
+                'discount_amount': 0
+            } for j in range(lineas)]
+            subtotal = sum(item['quantity'] * item['rate'] for item in items)
+            ahora = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-0600')
+            self.facturas[invoice_id] = {
+                'invoice_id': invoice_id,
+                'invoice_number': f"INV-{numero:06d}",
+                'status': status,
+                'date': datetime.now().strftime('%Y-%m-%d'),
+                'customer_id': contact_id,
+                'customer_name': self.contactos[contact_id]['contact_name'],
+                'currency_code': 'GTQ',
+                'total': round(subtotal * 1.12, 2),
+                'line_items': items,
+                'custom_fields': [],
+                'notes': '',
+                'created_time': ahora,
+                'last_modified_time': ahora
+            }
+            return self.facturas[invoice_id]
+
+    def contar(self, clave):
+        with self.lock:
+            self.solicitudes[clave] = self.solicitudes.get(clave, 0) + 1
+
+
+def nit_simulado(numero):
+    """NIT con guion y digito verificador (modulo 11) valido para el numero dado"""
+    cuerpo = str(numero)
+    digito = (11 - sum(int(d) * (len(cuerpo) + 1 - i) for i, d in enumerate(cuerpo)) % 11) % 11
+    return f"{cuerpo}-{'K' if digito == 10 else digito}"
+
+
+def modificacion(texto):
+    """last_modified_time de Zoho como datetime (None si no viene)"""
+    return datetime.strptime(texto, '%Y-%m-%dT%H:%M:%S%z') if texto else None
+
+
+def resumen_contacto(contacto):
+    """Campos que Zoho devuelve en el listado de contactos"""
+    campos = ('contact_id', 'contact_name', 'company_name', 'email', 'last_modified_time')
+    return {campo: contacto[campo] for campo in campos}
+
+
+def resumen_factura(factura):
+    """Campos que Zoho devuelve en el listado de facturas"""
+    campos = ('invoice_id', 'invoice_number', 'status', 'date', 'customer_id', 'customer_name',
+              'currency_code', 'total', 'created_time', 'last_modified_time', 'custom_fields')
+    return {campo: factura[campo] for campo in campos}
+
+
+class ManejadorBase(BaseHTTPRequestHandler):
+    """Manejador con latencia, errores y 429 simulados"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    servicio = ''
+
+    def log_message(self, formato, *args):
+        pass
+
+    @property
+    def estado(self):
+        return self.server.estado
+
+    def leer_cuerpo(self):
+        """Lee el cuerpo de la peticion, con Content-Length o chunked"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            partes = []
+            while True:
+                tamano = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if tamano == 0:
+                    self.rfile.readline()
+                    break
+                partes.append(self.rfile.read(tamano))
+                self.rfile.readline()
+            return b''.join(partes)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+
+    def responder(self, codigo, cuerpo, tipo='application/json', headers=None):
+        if not isinstance(cuerpo, bytes):
+            cuerpo = json.dumps(cuerpo).encode('utf-8')
+        self.send_response(codigo)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        for nombre, valor in {**getattr(self, 'headers_cuota', {}), **(headers or {})}.items():
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def simular(self):
+        """Aplica latencia y decide si responder con 429 o 5xx. Devuelve True si ya respondio"""
+        comportamiento = self.server.comportamiento
+        espera = comportamiento.latencia + random.uniform(0, comportamiento.variacion)
+        if espera > 0:
+            time.sleep(espera)
+        retry_after, restantes = comportamiento.consumir_cuota()
+        self.headers_cuota = {}
+        if restantes is not None:
+            self.headers_cuota = {'X-Rate-Limit-Limit': str(comportamiento.cuota_por_minuto),
+                                  'X-Rate-Limit-Remaining': str(restantes)}
+        if retry_after is not None:
+            self.leer_cuerpo()
+            self.responder(429, {'code': 44, 'message': 'Cuota por minuto excedida (simulado)'},
+                           headers={'Retry-After': str(retry_after)})
+            return True
+        azar = random.random()
+        if azar < comportamiento.tasa_429:
+            self.leer_cuerpo()
+            self.responder(429, {'code': 44, 'message': 'Too many requests'},
+                           headers={'Retry-After': str(comportamiento.retry_after)})
+            return True
+        if azar < comportamiento.tasa_429 + comportamiento.tasa_error:
+            self.leer_cuerpo()
+            self.responder(503, {'code': 503, 'message': 'Servicio no disponible (simulado)'})
+            return True
+        return False
+
+    def atender(self, metodo):
+        ruta = urlsplit(self.path)
+        self.estado.contar(f"{self.servicio} {metodo}")
+        if self.simular():
+            return
+        try:
+            self.despachar(metodo, ruta.path.strip('/').split('/'), parse_qs(ruta.query))
+        except KeyError:
+            self.responder(404, {'code': 1002, 'message': 'Recurso no encontrado'})
+
+    def do_GET(self):
+        self.atender('GET')
+
+    def do_POST(self):
+        self.atender('POST')
+
+    def do_PUT(self):
+        self.atender('PUT')
+
+
+class ManejadorZoho(ManejadorBase):
+    """OAuth y API de Zoho Books (/books/v3)"""
+
+    servicio = 'zoho'
+
+    def despachar(self, metodo, partes, query):
+        if partes == ['oauth', 'v2', 'token']:
+            self.leer_cuerpo()
+            token = uuid.uuid4().hex
+            with self.estado.lock:
+                self.estado.tokens.add(token)
+            return self.responder(200, {'access_token': token, 'expires_in': 3600, 'token_type': 'Bearer'})
+
+        autorizacion = self.headers.get('Authorization', '').replace('Zoho-oauthtoken ', '')
+        if self.server.validar_token and autorizacion not in self.estado.tokens:
+            self.leer_cuerpo()
+            return self.responder(401, {'code': 57, 'message': 'You are not authorized to perform this operation'})
+
+        if partes[:2] != ['books', 'v3']:
+            raise KeyError(self.path)
+        recurso = partes[2:]
+
+        if recurso == ['invoices'] and metodo == 'GET':
+            return self.listar_facturas(query)
+        if recurso == ['contacts'] and metodo == 'GET':
+            return self.listar_contactos(query)
+        if recurso[0] == 'contacts' and len(recurso) == 2 and metodo == 'GET':
+            return self.responder(200, {'code': 0, 'contact': self.estado.contactos[recurso[1]]})
+        if recurso[0] != 'invoices':
+            raise KeyError(self.path)
+
+        factura = self.estado.facturas[recurso[1]]
+        cuerpo = self.leer_cuerpo()
+        if len(recurso) == 2 and metodo == 'GET':
+            return self.responder(200, {'code': 0, 'invoice': factura})
+        if len(recurso) == 2 and metodo == 'PUT':
+            return self.actualizar_factura(factura, json.loads(cuerpo or b'{}'))
+        if len(recurso) == 4 and recurso[2] == 'status' and metodo == 'POST':
+            with self.estado.lock:
+                factura['status'] = recurso[3]
+                factura['last_modified_time'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-0600')
+            return self.responder(200, {'code': 0, 'message': f"Invoice status has been changed to {recurso[3]}."})
+        if len(recurso) == 3 and recurso[2] == 'attachment' and metodo == 'POST':
+            return self.adjuntar(factura, cuerpo)
+        if len(recurso) == 3 and recurso[2] == 'email' and metodo == 'POST':
+            return self.enviar_correo(factura, cuerpo)
+        raise KeyError(self.path)
+
+    def listar_facturas(self, query):
+        status = query.get('status', [None])[0]
+        with self.estado.lock:
+            facturas = [resumen_factura(f) for f in self.estado.facturas.values() if status in (None, f['status'])]
+        return self.responder_pagina('invoices', facturas, query)
+
+    def listar_contactos(self, query):
+        with self.estado.lock:
+            contactos = [resumen_contacto(c) for c in self.estado.contactos.values()]
+        return self.responder_pagina('contacts', contactos, query)
+
+    def responder_pagina(self, clave, registros, query):
+        """Aplica last_modified_time (desde, incluido), sort_column/sort_order y la paginacion"""
+        desde_modificacion = modificacion(query.get('last_modified_time', [None])[0])
+        if desde_modificacion:
+            registros = [r for r in registros if modificacion(r['last_modified_time']) >= desde_modificacion]
+        columna = query.get('sort_column', [None])[0]
+        if columna:
+            ordenar = modificacion if columna == 'last_modified_time' else str
+            registros.sort(key=lambda r: ordenar(r.get(columna, '')), reverse=query.get('sort_order', ['A'])[0] == 'D')
+        por_pagina = min(int(query.get('per_page', ['200'])[0]), 200)
+        pagina = int(query.get('page', ['1'])[0])
+        desde = (pagina - 1) * por_pagina
+        return self.responder(200, {
+            'code': 0,
+            clave: registros[desde:desde + por_pagina],
+            'page_context': {'page': pagina, 'per_page': por_pagina, 'has_more_page': desde + por_pagina < len(registros)}
+        })
+
+    def actualizar_factura(self, factura, datos):
+        with self.estado.lock:
+            campos = {cf['label']: cf for cf in factura['custom_fields']}
+            for cf in datos.get('custom_fields', []):
+                campos[cf['label']] = cf
+            factura['custom_fields'] = list(campos.values())
+            for campo in ('invoice_number', 'date', 'notes'):
+                if campo in datos:
+                    factura[campo] = datos[campo]
+            factura['last_modified_time'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S-0600')
+        return self.responder(200, {'code': 0, 'message': 'Invoice information has been updated.', 'invoice': factura})
+
+    def partes_multipart(self, cuerpo):
+        """Partes de un cuerpo multipart/form-data por nombre de campo"""
+        cabecera = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('latin-1')
+        mensaje = BytesParser(policy=HTTP).parsebytes(cabecera + cuerpo)
+        partes = {}
+        for parte in mensaje.iter_parts():
+            partes.setdefault(parte.get_param('name', header='content-disposition'), []).append(parte)
+        return partes
+
+    def enviar_correo(self, factura, cuerpo):
+        """JSON, o multipart con el JSON en JSONString y los archivos en attachments"""
+        if 'multipart/' in self.headers.get('Content-Type', ''):
+            partes = self.partes_multipart(cuerpo)
+            datos = json.loads(partes['JSONString'][0].get_payload(decode=True))
+            datos['adjuntos'] = [(p.get_filename(), len(p.get_payload(decode=True) or b'')) for p in partes.get('attachments', [])]
+        else:
+            datos = json.loads(cuerpo or b'{}')
+        with self.estado.lock:
+            self.estado.correos.append((factura['invoice_id'], datos))
+        return self.responder(200, {'code': 0, 'message': 'Your invoice has been sent.'})
+
+    def adjuntar(self, factura, cuerpo):
+        partes = self.partes_multipart(cuerpo).get('attachment', [])
+        if not partes:
+            return self.responder(400, {'code': 9, 'message': 'Falta el campo attachment'})
+        contenido = partes[0].get_payload(decode=True) or b''
+        if not contenido.startswith(b'%PDF-'):
+            return self.responder(400, {'code': 9, 'message': 'El adjunto no es un PDF'})
+        with self.estado.lock:
+            self.estado.adjuntos[factura['invoice_id']] = (partes[0].get_filename(), len(contenido))
+        return self.responder(200, {'code': 0, 'message': 'Your file has been successfully attached to the invoice.'})
+
+
+class ManejadorInfile(ManejadorBase):
+    """Certificacion y anulacion FEL de INFILE"""
+
+    servicio = 'infile'
+
+    def despachar(self, metodo, partes, query):
+        if partes[-2:] == ['rest', 'action']:
+            return self.consultar_nit(json.loads(self.leer_cuerpo() or b'{}'))
+        xml = self.leer_cuerpo().decode('utf-8')
+        identificador = self.headers.get('identificador', '')
+        if not self.headers.get('UsuarioApi') or not self.headers.get('LlaveApi'):
+            return self.responder(200, {'resultado': False, 'descripcion': 'Credenciales incompletas'})
+        if metodo == 'GET' and partes[-2:] == ['consulta', 'dte']:
+            return self.consultar(query.get('uuid', [''])[0])
+
+        with self.estado.lock:
+            # Mismo identificador = misma respuesta, como el servicio real
+            if identificador and identificador in self.estado.por_identificador:
+                return self.responder(200, self.estado.por_identificador[identificador])
+
+            if 'GTAnulacionDocumento' in xml:
+                inicio = xml.index('NumeroDocumentoAAnular="') + len('NumeroDocumentoAAnular="')
+                uuid_fel = xml[inicio:xml.index('"', inicio)]
+                documento = self.estado.certificados.get(uuid_fel)
+                if documento is None or documento['estado'] == 'Anulado':
+                    respuesta = {'resultado': False, 'descripcion': 'Documento no existe o ya fue anulado',
+                                 'descripcion_errores': [{'categoria': 'ANULACION', 'mensaje_error': 'Documento no valido'}]}
+                else:
+                    documento['estado'] = 'Anulado'
+                    respuesta = {'resultado': True, 'descripcion': 'Documento anulado', 'uuid': uuid_fel,
+                                 'fecha': datetime.now().strftime('%Y-%m-%dT%H:%M:%S-06:00')}
+            elif '<dte:Items>' not in xml:
+                respuesta = {'resultado': False, 'descripcion': 'XML invalido',
+                             'descripcion_errores': [{'categoria': 'XML', 'mensaje_error': 'Sin Items'}]}
+            else:
+                uuid_fel = str(uuid.uuid4()).upper()
+                respuesta = {
+                    'resultado': True,
+                    'descripcion': 'Documento certificado',
+                    'uuid': uuid_fel,
+                    'serie': uuid_fel[:8],
+                    'numero': str(int(uuid_fel[9:18].replace('-', ''), 16)),
+                    'fecha': datetime.now().strftime('%Y-%m-%dT%H:%M:%S-06:00'),
+                    'xml_certificado': ''
+                }
+                self.estado.certificados[uuid_fel] = {'estado': 'Vigente', 'xml': xml, 'identificador': identificador}
+            if identificador:
+                self.estado.por_identificador[identificador] = respuesta
+        return self.responder(200, respuesta)
+
+    def consultar_nit(self, datos):
+        """Consulta de receptores (consultareceptores.feel.com.gt): nombre vacio si el NIT no existe"""
+        self.estado.contar('infile nit')
+        if not datos.get('emisor_codigo') or not datos.get('emisor_clave'):
+            return self.responder(200, {'nit': '', 'nombre': '', 'mensaje': 'Credenciales incompletas'})
+        nit = str(datos.get('nit_consulta', '')).replace('-', '').upper()
+        with self.estado.lock:
+            nombre = self.estado.nits.get(nit, '')
+        return self.responder(200, {'nit': nit, 'nombre': nombre, 'mensaje': '' if nombre else 'NIT no valido'})
+
+    def consultar(self, uuid_fel):
+        with self.estado.lock:
+            documento = self.estado.certificados.get(uuid_fel)
+            if documento is None:
+                return self.responder(200, {'resultado': False, 'descripcion': 'Documento no encontrado'})
+            return self.responder(200, {'resultado': True, 'uuid': uuid_fel, 'estado': documento['estado']})
+
+
+class ManejadorReportes(ManejadorBase):
+    """Descarga del PDF en report.feel.com.gt"""
+
+    servicio = 'reportes'
+
+    def despachar(self, metodo, partes, query):
+        uuid_fel = query.get('uuid', [''])[0]
+        if uuid_fel not in self.estado.certificados:
+            return self.responder(200, b'<html>Documento no encontrado</html>', tipo='text/html')
+        return self.responder(200, PDF_SIMULADO + b'%' + uuid_fel.encode('ascii') + b'\n' + b'0' * self.server.relleno_pdf,
+                              tipo='application/pdf')
+
+
+class ServidorSimulado(ThreadingHTTPServer):
+    """Servidor HTTP que ignora las conexiones que el cliente cierra a medias"""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class ServidoresSimulados:
+    """Levanta los tres servidores en hilos de fondo y genera la configuracion del asistente"""
+
+    def __init__(self, estado=None, zoho=None, infile=None, reportes=None, relleno_pdf=20000, validar_token=True):
+        self.estado = estado or EstadoSimulado()
+        self.comportamientos = {
+            'zoho': zoho or Comportamiento(),
+            'infile': infile or Comportamiento(),
+            'reportes': reportes or Comportamiento()
+        }
+        self.relleno_pdf = relleno_pdf
+        self.validar_token = validar_token
+        self.servidores = {}
+        self.hilos = []
+
+    def iniciar(self):
+        manejadores = {'zoho': ManejadorZoho, 'infile': ManejadorInfile, 'reportes': ManejadorReportes}
+        for nombre, manejador in manejadores.items():
+            servidor = ServidorSimulado(('127.0.0.1', 0), manejador)
+            servidor.estado = self.estado
+            servidor.comportamiento = self.comportamientos[nombre]
+            servidor.relleno_pdf = self.relleno_pdf
+            servidor.validar_token = self.validar_token
+            hilo = threading.Thread(target=servidor.serve_forever, name=f"simulado-{nombre}", daemon=True)
+            hilo.start()
+            self.servidores[nombre] = servidor
+            self.hilos.append(hilo)
+        return self
+
+    def detener(self):
+        for servidor in self.servidores.values():
+            servidor.shutdown()
+            servidor.server_close()
+
+    def url(self, nombre):
+        host, puerto = self.servidores[nombre].server_address[:2]
+        return f"http://{host}:{puerto}"
+
+    def config(self, **secciones):
+        """Configuracion del asistente apuntando a los servidores simulados"""
+        config = json.loads(json.dumps(CONFIG_BASE))
+        config['zoho'] = {
+            'organization_id': '700000000',
+            'api_domain': self.url('zoho'),
+            'accounts_url': self.url('zoho'),
+            'client_id': 'cliente-simulado',
+            'client_secret': 'secreto-simulado',
+            'refresh_token': 'refresh-simulado'
+        }
+        config['infile'] = {
+            'ambiente': 'PRUEBAS',
+            'url_certificacion': f"{self.url('infile')}/fel/certificacion/v2/dte",
+            'url_consulta': f"{self.url('infile')}/fel/consulta/dte",
+            'url_consulta_nit': f"{self.url('infile')}/consultareceptores/rest/action",
+            'url_reportes': self.url('reportes'),
+            'usuario_firma': 'ADSTTER_SIM',
+            'llave_firma': 'llave-firma',
+            'usuario_api': 'ADSTTER_SIM',
+            'llave_api': 'llave-api'
+        }
+        config.update(secciones)
+        return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidores simulados de Zoho Books, INFILE y report.feel.com.gt')
+    parser.add_argument('--facturas', type=int, default=20, help='Facturas borrador iniciales')
+    parser.add_argument('--contactos', type=int, default=5)
+    parser.add_argument('--lineas', type=int, default=3, help='Lineas por factura')
+    for servicio in ('zoho', 'infile', 'reportes'):
+        parser.add_argument(f'--latencia-{servicio}', type=float, default=0.05, help='Segundos por peticion')
+        parser.add_argument(f'--errores-{servicio}', type=float, default=0.0, help='Fraccion de respuestas 503')
+        parser.add_argument(f'--tasa-429-{servicio}', type=float, default=0.0, help='Fraccion de respuestas 429')
+        parser.add_argument(f'--cuota-{servicio}', type=int, default=0, help='Peticiones por minuto antes de responder 429 (0 = sin cuota)')
+    parser.add_argument('--config', default=os.path.join(SCRIPT_DIR, 'config_simulado.json'),
+                        help='Donde escribir la configuracion para el asistente')
+    args = parser.parse_args()
+
+    def comportamiento(servicio):
+        return Comportamiento(
+            latencia=getattr(args, f'latencia_{servicio}'),
+            tasa_error=getattr(args, f'errores_{servicio}'),
+            tasa_429=getattr(args, f'tasa_429_{servicio}'),
+            cuota_por_minuto=getattr(args, f'cuota_{servicio}')
+        )
+
+    servidores = ServidoresSimulados(
+        EstadoSimulado(facturas=args.facturas, contactos=args.contactos, lineas=args.lineas),
+        zoho=comportamiento('zoho'), infile=comportamiento('infile'), reportes=comportamiento('reportes')
+    ).iniciar()
+
+    with open(args.config, 'w', encoding='utf-8') as f:
+        json.dump(servidores.config(), f, indent=2)
+
+    print(f"Zoho:     {servidores.url('zoho')}")
+    print(f"INFILE:   {servidores.url('infile')}")
+    print(f"Reportes: {servidores.url('reportes')}")
+    print(f"Configuracion: {args.config}")
+    print("Ctrl+C para detener")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        servidores.detener()
+
+
+if __name__ == '__main__':
+    main()
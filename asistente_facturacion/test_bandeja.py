@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de la bandeja de salida: toma atomica, plazo de las tareas, orden PDF/email y reintentos
+"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import bandeja
+
+OPCIONES = dict(bandeja.OPCIONES_BANDEJA, plazo_tarea=600, max_intentos=3, espera_inicial=10, espera_maxima=15)
+
+
+@pytest.fixture
+def reloj(tmp_path, monkeypatch):
+    """Bandeja en un archivo temporal y un reloj (time.time) que se adelanta a mano"""
+    monkeypatch.setattr(bandeja, 'BANDEJA_FILE', str(tmp_path / 'bandeja_salida.db'))
+    monkeypatch.setattr(bandeja, 'DUENO_BANDEJA', 'proceso-a')
+    reloj = [1_000_000.0]
+    monkeypatch.setattr(bandeja, 'time', SimpleNamespace(time=lambda: reloj[0]))
+    return reloj
+
+
+def estado(id_tarea):
+    conexion = bandeja.conectar_bandeja()
+    try:
+        return conexion.execute("SELECT estado FROM tareas WHERE id = ?", (id_tarea,)).fetchone()['estado']
+    finally:
+        conexion.close()
+
+
+def test_una_tarea_se_toma_una_sola_vez(reloj):
+    id_tarea = bandeja.encolar_tarea('pdf', 'INV1', 'F-1', {})
+
+    tarea = bandeja.tomar_tarea(OPCIONES)
+    assert tarea['id'] == id_tarea
+    assert bandeja.tomar_tarea(OPCIONES) is None
+    assert estado(id_tarea) == 'en_proceso'
+
+
+def test_hilos_concurrentes_no_repiten_tareas(tmp_path, monkeypatch):
+    monkeypatch.setattr(bandeja, 'BANDEJA_FILE', str(tmp_path / 'bandeja_salida.db'))
+    ids = [bandeja.encolar_tarea('pdf', f"INV{i}", f"F-{i}", {}) for i in range(40)]
+    tomadas = []
+
+    def vaciar():
+        while True:
+            tarea = bandeja.tomar_tarea(OPCIONES)
+            if tarea is None:
+                return
+            tomadas.append(tarea['id'])
+
+    hilos = [threading.Thread(target=vaciar) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(30)
+
+    assert sorted(tomadas) == ids
+
+
+def test_plazo_vigente_no_se_retoma(reloj, monkeypatch):
+    id_tarea = bandeja.encolar_tarea('pdf', 'INV1', 'F-1', {})
+    bandeja.tomar_tarea(OPCIONES)
+
+    reloj[0] += 599
+    monkeypatch.setattr(bandeja, 'DUENO_BANDEJA', 'proceso-b')
+    assert bandeja.tomar_tarea(OPCIONES) is None
+    assert bandeja.recuperar_tareas_interrumpidas() == 0
+    assert estado(id_tarea) == 'en_proceso'
+
+
+def test_plazo_vencido_lo_retoma_otro_proceso(reloj, monkeypatch):
+    id_tarea = bandeja.encolar_tarea('pdf', 'INV1', 'F-1', {})
+    tarea_a = bandeja.tomar_tarea(OPCIONES)
+
+    reloj[0] += 601
+    monkeypatch.setattr(bandeja, 'DUENO_BANDEJA', 'proceso-b')
+    tarea_b = bandeja.tomar_tarea(OPCIONES)
+    assert tarea_b['id'] == id_tarea
+
+    # El resultado tardio del primer dueno ya no cuenta
+    monkeypatch.setattr(bandeja, 'DUENO_BANDEJA', 'proceso-a')
+    bandeja.terminar_tarea(tarea_a, False, 'se cerro', OPCIONES)
+    assert estado(id_tarea) == 'en_proceso'
+
+    monkeypatch.setattr(bandeja, 'DUENO_BANDEJA', 'proceso-b')
+    assert bandeja.terminar_tarea(tarea_b, True, opciones=OPCIONES) == 'hecha'
+    assert estado(id_tarea) == 'hecha'
+
+
+def test_recuperar_tareas_interrumpidas(reloj):
+    id_tarea = bandeja.encolar_tarea('pdf', 'INV1', 'F-1', {})
+    bandeja.tomar_tarea(OPCIONES)
+
+    reloj[0] += 601
+    assert bandeja.recuperar_tareas_interrumpidas() == 1
+    assert estado(id_tarea) == 'pendiente'
+    assert bandeja.tomar_tarea(OPCIONES)['id'] == id_tarea
+
+
+def test_email_espera_a_su_pdf(reloj):
+    datos = SimpleNamespace(uuid='U1', serie='S1', numero='1', fecha='2026-01-01')
+    id_pdf, id_email = bandeja.encolar_pdf_y_email('INV1', 'F-1', 'https://pdf', datos, ['a@b.com'], {})
+    assert bandeja.encolar_pdf_y_email('INV1', 'F-1', 'https://pdf', datos, ['a@b.com'], {}) == (id_pdf, id_email)
+
+    pdf = bandeja.tomar_tarea(OPCIONES)
+    assert pdf['id'] == id_pdf
+    assert bandeja.tomar_tarea(OPCIONES) is None
+
+    bandeja.terminar_tarea(pdf, True, opciones=OPCIONES)
+    assert bandeja.tomar_tarea(OPCIONES)['id'] == id_email
+
+
+def test_reintentos_con_espera_exponencial_hasta_fallar(reloj):
+    id_tarea = bandeja.encolar_tarea('pdf', 'INV1', 'F-1', {})
+
+    tarea = bandeja.tomar_tarea(OPCIONES)
+    assert bandeja.terminar_tarea(tarea, False, 'HTTP 500', OPCIONES) == 'pendiente'
+    reloj[0] += 9
+    assert bandeja.tomar_tarea(OPCIONES) is None
+    reloj[0] += 1
+    tarea = bandeja.tomar_tarea(OPCIONES)
+    assert tarea['intentos'] == 1
+
+    # Segunda espera: 20 s, recortada a espera_maxima (15 s)
+    assert bandeja.terminar_tarea(tarea, False, 'HTTP 500', OPCIONES) == 'pendiente'
+    reloj[0] += 15
+    tarea = bandeja.tomar_tarea(OPCIONES)
+    assert tarea['intentos'] == 2
+
+    assert bandeja.terminar_tarea(tarea, False, 'HTTP 500', OPCIONES) == 'fallida'
+    assert estado(id_tarea) == 'fallida'
+    assert bandeja.tomar_tarea(OPCIONES) is None
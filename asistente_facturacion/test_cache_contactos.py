@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de CacheContactos: TTL, limite LRU, errores sin guardar y una sola descarga por contacto
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import asistente_facturacion as asistente
+from asistente_facturacion import CacheContactos
+
+
+class Cargador:
+    """cargar(contact_id) de prueba que cuenta las descargas por contacto"""
+
+    def __init__(self, resultado=lambda contact_id: {'contact_id': contact_id}):
+        self.resultado = resultado
+        self.llamadas = []
+
+    def __call__(self, contact_id):
+        self.llamadas.append(contact_id)
+        return self.resultado(contact_id)
+
+
+def reloj_falso(monkeypatch):
+    """Reemplaza time.monotonic del modulo por un reloj que se adelanta a mano"""
+    reloj = [1000.0]
+    monkeypatch.setattr(asistente, 'time', SimpleNamespace(monotonic=lambda: reloj[0]))
+    return reloj
+
+
+def test_acierto_dentro_del_ttl(monkeypatch):
+    reloj_falso(monkeypatch)
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+    cargar = Cargador()
+
+    assert cache.obtener('C1', cargar) == {'contact_id': 'C1'}
+    assert cache.obtener('C1', cargar) == {'contact_id': 'C1'}
+    assert cargar.llamadas == ['C1']
+    assert cache.estadisticas() == {'aciertos': 1, 'fallos': 1}
+
+
+def test_vence_al_cumplir_el_ttl(monkeypatch):
+    reloj = reloj_falso(monkeypatch)
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+    cargar = Cargador()
+
+    cache.obtener('C1', cargar)
+    reloj[0] += 59
+    cache.obtener('C1', cargar)
+    assert cargar.llamadas == ['C1']
+
+    reloj[0] += 1
+    cache.obtener('C1', cargar)
+    assert cargar.llamadas == ['C1', 'C1']
+
+
+def test_lru_saca_el_menos_usado():
+    cache = CacheContactos(ttl_segundos=60, max_contactos=2)
+    cargar = Cargador()
+
+    cache.obtener('C1', cargar)
+    cache.obtener('C2', cargar)
+    cache.obtener('C1', cargar)  # C1 pasa a ser el mas reciente
+    cache.obtener('C3', cargar)  # sale C2
+
+    assert list(cache.entradas) == ['C1', 'C3']
+    cache.obtener('C1', cargar)
+    cache.obtener('C2', cargar)
+    assert cargar.llamadas == ['C1', 'C2', 'C3', 'C2']
+
+
+def test_none_no_se_guarda():
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+    cargar = Cargador(lambda contact_id: None)
+
+    assert cache.obtener('C1', cargar) is None
+    assert cache.obtener('C1', cargar) is None
+    assert cargar.llamadas == ['C1', 'C1']
+    assert 'C1' not in cache.entradas
+
+
+def test_descartar_obliga_a_descargar():
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+    cargar = Cargador()
+
+    cache.obtener('C1', cargar)
+    cache.descartar('C1')
+    cache.descartar('C9')
+    cache.obtener('C1', cargar)
+    assert cargar.llamadas == ['C1', 'C1']
+
+
+def test_error_al_cargar_se_propaga_y_no_queda_en_curso():
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+
+    def fallar(contact_id):
+        raise ConnectionError('Zoho no responde')
+
+    try:
+        cache.obtener('C1', fallar)
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError('se esperaba ConnectionError')
+    assert cache.en_curso == {}
+    assert cache.obtener('C1', Cargador()) == {'contact_id': 'C1'}
+
+
+def test_una_sola_descarga_con_hilos_concurrentes():
+    cache = CacheContactos(ttl_segundos=60, max_contactos=10)
+    liberar = threading.Event()
+
+    def lento(contact_id):
+        liberar.wait(5)
+        return {'contact_id': contact_id}
+
+    cargar = Cargador(lento)
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(cache.obtener('C1', cargar))) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    # Todos los hilos deben quedar esperando la misma descarga antes de liberarla
+    limite = time.monotonic() + 5
+    while cache.estadisticas()['aciertos'] + cache.estadisticas()['fallos'] < 8 and time.monotonic() < limite:
+        time.sleep(0.01)
+    liberar.set()
+    for hilo in hilos:
+        hilo.join(5)
+
+    assert cargar.llamadas == ['C1']
+    assert resultados == [{'contact_id': 'C1'}] * 8
+    assert cache.estadisticas() == {'aciertos': 7, 'fallos': 1}
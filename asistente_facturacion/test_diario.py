@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del diario: identificador estable para INFILE, XML en disco y etapas al reanudar
+"""
+
+import hashlib
+import os
+
+import pytest
+
+import diario
+from diario import identificador_estable
+
+
+@pytest.fixture
+def diario_temporal(tmp_path, monkeypatch):
+    """Diario y carpeta de XML en un directorio temporal"""
+    monkeypatch.setattr(diario, 'DIARIO_FILE', str(tmp_path / 'diario_fel.db'))
+    monkeypatch.setattr(diario, 'DIARIO_XML_DIR', str(tmp_path / 'diario_xml'))
+    return tmp_path
+
+
+def test_identificador_depende_solo_de_factura_y_huella():
+    huella = hashlib.sha256(b'<dte:GTDocumento/>').digest()
+
+    identificador = identificador_estable('ADSTTER', 'INV1', huella)
+    assert identificador == f"ADSTTER_INV1_{huella.hex()[:16]}"
+    assert identificador_estable('ADSTTER', 'INV1', huella) == identificador
+
+
+def test_identificador_cambia_con_el_xml_la_factura_o_el_prefijo():
+    huella = hashlib.sha256(b'<dte:GTDocumento/>').digest()
+    otra = hashlib.sha256(b'<dte:GTDocumento version="2"/>').digest()
+
+    identificadores = {
+        identificador_estable('ADSTTER', 'INV1', huella),
+        identificador_estable('ADSTTER', 'INV1', otra),
+        identificador_estable('ADSTTER', 'INV2', huella),
+        identificador_estable('ANULA', 'INV1', huella),
+    }
+    assert len(identificadores) == 4
+
+
+def test_reenviar_el_mismo_xml_repite_el_identificador(diario_temporal):
+    primera = diario.guardar_xml_diario([b'<dte:GTDocumento>', b'<dte:Total>1.00</dte:Total>', b'</dte:GTDocumento>'])
+    # Otros bloques, mismo contenido: la huella es la del XML completo
+    segunda = diario.guardar_xml_diario([b'<dte:GTDocumento><dte:Total>1.00</dte:Total></dte:GTDocumento>'])
+
+    assert primera == segunda
+    assert identificador_estable('ADSTTER', 'INV1', primera) == identificador_estable('ADSTTER', 'INV1', segunda)
+    with open(diario.ruta_xml_diario(primera), 'rb') as f:
+        assert hashlib.sha256(f.read()).digest() == primera
+    assert [n for n in os.listdir(diario.DIARIO_XML_DIR) if n.endswith('.tmp')] == []
+
+    diario.descartar_xml_diario(primera)
+    diario.descartar_xml_diario(primera)
+    assert not os.path.exists(diario.ruta_xml_diario(primera))
+
+
+def test_estado_y_pendientes_al_reanudar(diario_temporal):
+    diario.registrar_etapa('certificacion', 'INV1', 'F-1', 'xml_generado', huella='aa', identificador='ID1')
+    diario.registrar_etapa('certificacion', 'INV1', 'F-1', 'enviado')
+    diario.registrar_etapa('certificacion', 'INV2', 'F-2', 'xml_generado', huella='bb')
+    diario.registrar_etapa('certificacion', 'INV2', 'F-2', 'completado')
+
+    estado = diario.estado_diario('certificacion', 'INV1')
+    assert estado == {'huella': 'aa', 'identificador': 'ID1', 'etapa': 'enviado'}
+    assert [f['invoice_id'] for f in diario.pendientes_diario('certificacion')] == ['INV1']
+
+    # Un intento nuevo (xml_generado) descarta los datos del anterior
+    diario.registrar_etapa('certificacion', 'INV1', 'F-1', 'xml_generado', huella='cc')
+    assert diario.estado_diario('certificacion', 'INV1') == {'huella': 'cc', 'etapa': 'xml_generado'}
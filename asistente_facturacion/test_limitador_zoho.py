@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas de LimitadorZoho (cubeta de fichas, 429 y Retry-After) y de segundos_retry_after
+"""
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+
+import asistente_facturacion as asistente
+from asistente_facturacion import LimitadorZoho, segundos_retry_after
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    """Reloj falso para el modulo: time.sleep adelanta time.monotonic en vez de dormir"""
+    reloj = [1000.0]
+
+    def dormir(segundos):
+        reloj[0] += segundos
+
+    monkeypatch.setattr(asistente, 'time', SimpleNamespace(
+        monotonic=lambda: reloj[0], sleep=dormir, time=lambda: reloj[0]
+    ))
+    return reloj
+
+
+def respuesta(status_code=200, **headers):
+    return SimpleNamespace(status_code=status_code, headers={k.replace('_', '-'): v for k, v in headers.items()})
+
+
+def test_rafaga_sin_espera_y_luego_a_la_tasa(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=3)
+
+    assert [limitador.tomar() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limitador.tomar() == pytest.approx(1.0)
+    assert limitador.tomar() == pytest.approx(1.0)
+    assert limitador.estadisticas()['peticiones'] == 5
+
+
+def test_las_fichas_se_reponen_hasta_la_rafaga(reloj):
+    limitador = LimitadorZoho(por_minuto=120, rafaga=4)
+    for _ in range(4):
+        limitador.tomar()
+
+    reloj[0] += 60
+    assert [limitador.tomar() for _ in range(4)] == [0.0] * 4
+    assert limitador.tomar() == pytest.approx(0.5)
+
+
+def test_429_pausa_hasta_retry_after_y_baja_la_tasa(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=5)
+    limitador.tomar()
+
+    limitador.registrar(respuesta(429, Retry_After='7'))
+    assert limitador.tomar() == pytest.approx(7)
+    # Durante la pausa se repusieron 3.5 fichas a la mitad de la tasa; despues, una cada 2 s
+    assert [limitador.tomar() for _ in range(3)] == pytest.approx([0, 0, 1.0])
+    assert limitador.tomar() == pytest.approx(2.0)
+    estadisticas = limitador.estadisticas()
+    assert estadisticas['respuestas_429'] == 1
+    assert estadisticas['por_minuto'] == pytest.approx(30)
+
+
+def test_retry_after_se_recorta_a_espera_maxima(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=1, espera_maxima_429=120)
+
+    limitador.registrar(respuesta(429, Retry_After='3600'))
+    assert limitador.pausa_hasta - reloj[0] == pytest.approx(120)
+
+
+def test_429_sin_retry_after_espera_una_ficha(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=1)
+
+    limitador.registrar(respuesta(429))
+    assert limitador.pausa_hasta - reloj[0] == pytest.approx(2.0)
+
+
+def test_la_tasa_no_baja_del_decimo_y_se_recupera(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=1)
+    for _ in range(10):
+        limitador.registrar(respuesta(429, Retry_After='0'))
+    assert limitador.estadisticas()['por_minuto'] == pytest.approx(6)
+
+    for _ in range(17):
+        limitador.registrar(respuesta(200))
+    assert limitador.estadisticas()['por_minuto'] == pytest.approx(57)
+    for _ in range(5):
+        limitador.registrar(respuesta(200))
+    assert limitador.estadisticas()['por_minuto'] == pytest.approx(60)
+
+
+def test_cuota_restante_de_los_headers(reloj):
+    limitador = LimitadorZoho(por_minuto=60, rafaga=1, por_dia=1000)
+    limitador.tomar()
+    assert limitador.estadisticas()['restante'] == 999
+
+    limitador.registrar(respuesta(200, X_Rate_Limit_Limit='5000', X_Rate_Limit_Remaining='120'))
+    estadisticas = limitador.estadisticas()
+    assert estadisticas['restante'] == 120
+    assert estadisticas['limite'] == 5000
+
+
+def test_segundos_retry_after_numero():
+    assert segundos_retry_after('30') == 30.0
+    assert segundos_retry_after(' 1.5 ') == 1.5
+    assert segundos_retry_after('-4') == 0.0
+
+
+def test_segundos_retry_after_fecha_http():
+    futura = datetime.now(timezone.utc) + timedelta(seconds=90)
+    assert segundos_retry_after(format_datetime(futura, usegmt=True)) == pytest.approx(90, abs=2)
+    assert segundos_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+
+
+@pytest.mark.parametrize('valor', [None, '', 'pronto', 'Mon, 99 Foo 2026'])
+def test_segundos_retry_after_invalido(valor):
+    assert segundos_retry_after(valor) is None
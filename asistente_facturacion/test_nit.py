@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Pruebas del digito verificador (modulo 11) de los NIT guatemaltecos
+"""
+
+import pytest
+
+from asistente_facturacion import digito_verificador_nit, nit_valido
+
+
+@pytest.mark.parametrize('cuerpo, digito', [
+    ('123456', '0'),  # 7*1 + 6*2 + 5*3 + 4*4 + 3*5 + 2*6 = 77, 77 % 11 = 0
+    ('1234', '3'),    # 5*1 + 4*2 + 3*3 + 2*4 = 30, 11 - 8 = 3
+    ('5', '1'),       # 2*5 = 10, 11 - 10 = 1
+    ('6', 'K'),       # 2*6 = 12, 11 - 1 = 10 -> K
+])
+def test_digito_verificador(cuerpo, digito):
+    assert digito_verificador_nit(cuerpo) == digito
+
+
+@pytest.mark.parametrize('nit', ['1234560', '12343', '1234-3', '6K', '6-k', ' 51 ', 1234560])
+def test_nit_valido(nit):
+    assert nit_valido(nit)
+
+
+@pytest.mark.parametrize('nit', [
+    '1234561',   # verificador equivocado
+    '12344',
+    '6-1',       # le corresponde K
+    '5K',
+    'CF',        # consumidor final no es un NIT
+    '12A43',
+    '1234X',
+    '7',         # solo un digito
+    '',
+    None,
+])
+def test_nit_invalido(nit):
+    assert not nit_valido(nit)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Traza de tiempos por etapa del Asistente de Facturacion (seccion "traza" de config.json).
+
+Cada tramo medido se escribe en JSONL y se acumula para el resumen de percentiles.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Traza de tiempos por etapa (seccion "traza" de config.json); deshabilitada por defecto
+OPCIONES_TRAZA = {
+    'habilitada': False,
+    'archivo': 'traza_fel.jsonl'
+}
+
+_trazador = None
+_TRAMO_NULO = nullcontext()
+
+class Trazador:
+    """Mide la duracion de cada etapa (tramo), la escribe en un archivo JSONL y la acumula para el resumen.
+
+    Los tramos se anidan por hilo: cada registro indica su tramo padre y
+    hereda sus atributos (por ejemplo el numero de factura).
+    """
+
+    def __init__(self, archivo=None):
+        self.archivo = open(archivo, 'a', encoding='utf-8') if archivo else None
+        self.duraciones = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def tramo(self, etapa, **atributos):
+        padre = getattr(self.local, 'actual', None)
+        if padre:
+            atributos = {**padre[1], **atributos}
+        self.local.actual = (etapa, atributos)
+        inicio = time.time()
+        contador = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duracion = time.perf_counter() - contador
+            self.local.actual = padre
+            with self.lock:
+                self.duraciones.setdefault(etapa, []).append(duracion)
+                if self.archivo:
+                    registro = {
+                        'etapa': etapa,
+                        'padre': padre[0] if padre else None,
+                        'inicio': datetime.fromtimestamp(inicio).isoformat(timespec='milliseconds'),
+                        'duracion_ms': round(duracion * 1000, 3),
+                        'hilo': threading.current_thread().name
+                    }
+                    registro.update(atributos)
+                    if error:
+                        registro['error'] = error
+                    self.archivo.write(json.dumps(registro, ensure_ascii=False) + '\n')
+                    self.archivo.flush()
+
+    def estadisticas(self):
+        """Devuelve {etapa: {cantidad, total, p50, p95, max}} con tiempos en segundos"""
+        with self.lock:
+            copia = {etapa: list(valores) for etapa, valores in self.duraciones.items()}
+        return {etapa: {
+            'cantidad': len(valores),
+            'total': sum(valores),
+            'p50': percentil(valores, 50),
+            'p95': percentil(valores, 95),
+            'max': max(valores)
+        } for etapa, valores in copia.items()}
+
+    def cerrar(self):
+        if self.archivo:
+            self.archivo.close()
+            self.archivo = None
+
+def percentil(valores, p):
+    """Percentil p (0-100) por rango mas cercano; 0 si no hay valores"""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados))) - 1))
+    return ordenados[indice]
+
+def tramo(etapa, **atributos):
+    """Bloque medido como etapa de la traza; sin traza habilitada no hace nada"""
+    if _trazador is None:
+        return _TRAMO_NULO
+    return _trazador.tramo(etapa, **atributos)
+
+def medir(etapa):
+    """Decorador: cada llamada a la funcion es un tramo de la traza"""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def medida(*args, **kwargs):
+            if _trazador is None:
+                return funcion(*args, **kwargs)
+            with _trazador.tramo(etapa):
+                return funcion(*args, **kwargs)
+        return medida
+    return decorador
+
+def configurar_traza(config, archivo=None):
+    """Activa la traza segun la seccion 'traza' del config (o el archivo indicado); devuelve el Trazador o None"""
+    global _trazador
+    opciones = dict(OPCIONES_TRAZA)
+    opciones.update(config.get('traza', {}))
+    if _trazador is not None:
+        _trazador.cerrar()
+        _trazador = None
+    if archivo or opciones['habilitada']:
+        ruta = archivo or opciones['archivo']
+        if ruta and not os.path.isabs(ruta):
+            ruta = os.path.join(SCRIPT_DIR, ruta)
+        _trazador = Trazador(ruta)
+    return _trazador
+
+def imprimir_resumen_tramos():
+    """Imprime la tabla de tiempos por etapa acumulados por la traza (si esta habilitada)"""
+    if _trazador is None:
+        return
+    estadisticas = _trazador.estadisticas()
+    if not estadisticas:
+        return
+    print(f"\nTiempos por etapa (ms):")
+    print(f"  {'Etapa':<20}{'Cant.':>7}{'Total':>11}{'p50':>9}{'p95':>9}{'Max':>9}")
+    for etapa, datos in sorted(estadisticas.items(), key=lambda e: -e[1]['total']):
+        print(f"  {etapa:<20}{datos['cantidad']:>7}{datos['total'] * 1000:>11.1f}"
+              f"{datos['p50'] * 1000:>9.1f}{datos['p95'] * 1000:>9.1f}{datos['max'] * 1000:>9.1f}")
+    if _trazador.archivo:
+        print(f"  Traza: {_trazador.archivo.name}")
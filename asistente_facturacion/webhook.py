@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio HTTP que recibe los webhooks de Zoho Books y certifica las facturas con un grupo de trabajadores
+"""
+
+import hmac
+import io
+import ipaddress
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from consola import capturar_salida, escribir_consola
+from traza import percentil
+
+# Servicio que certifica al recibir los webhooks de Zoho Books (seccion "webhook" de config.json)
+# Con token, cada llamada debe traer el header X-Webhook-Token o el parametro ?token= con ese valor.
+# Sin token el servicio solo arranca escuchando en loopback (127.0.0.1), con un aviso
+OPCIONES_WEBHOOK = {
+    'host': '127.0.0.1',
+    'puerto': 8765,
+    'ruta': '/zoho/webhook',
+    'token': '',
+    'trabajadores': 2
+}
+
+def invoice_ids_webhook(datos):
+    """invoice_id que trae el cuerpo de un webhook de Zoho ({"invoice": {...}}, {"invoices": [...]} o {"invoice_id": ...})"""
+    if not isinstance(datos, dict):
+        return []
+    facturas = []
+    if isinstance(datos.get('invoice'), dict):
+        facturas.append(datos['invoice'])
+    if isinstance(datos.get('invoices'), list):
+        facturas.extend(f for f in datos['invoices'] if isinstance(f, dict))
+    ids = [datos['invoice_id']] if datos.get('invoice_id') else []
+    ids += [f['invoice_id'] for f in facturas if f.get('invoice_id')]
+    return list(dict.fromkeys(str(invoice_id) for invoice_id in ids))
+
+class ColaCertificacion:
+    """Cola de facturas por certificar; un invoice_id que ya espera o se procesa no se agrega de nuevo"""
+
+    def __init__(self):
+        self.cola = queue.Queue()
+        self.en_cola = set()
+        self.lock = threading.Lock()
+
+    def agregar(self, invoice_id, factura=None):
+        """Encola la factura (o solo su invoice_id); devuelve False si ya estaba"""
+        with self.lock:
+            if invoice_id in self.en_cola:
+                return False
+            self.en_cola.add(invoice_id)
+        self.cola.put((invoice_id, factura, time.monotonic()))
+        return True
+
+    def tomar(self, espera=1):
+        """Devuelve (invoice_id, factura o None, momento en que se encolo) o None si no llego nada"""
+        try:
+            return self.cola.get(timeout=espera)
+        except queue.Empty:
+            return None
+
+    def terminar(self, invoice_id):
+        with self.lock:
+            self.en_cola.discard(invoice_id)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.en_cola)
+
+def es_loopback(host):
+    """True si host es localhost o una direccion de loopback"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class ServicioWebhook:
+    """Escucha los webhooks de Zoho Books y certifica cada factura borrador con un grupo de trabajadores.
+
+    El servidor HTTP solo encola el invoice_id y responde 202; los trabajadores
+    llaman a certificar(invoice_id, factura o None), que devuelve (clave, registro)
+    como el resto de los lotes ('exitosas', 'fallidas' u 'omitidas').
+    al_completar(invoice_id, clave, registro) se llama al terminar cada una.
+    """
+
+    def __init__(self, config, certificar, al_completar=None, **opciones):
+        self.certificar = certificar
+        self.al_completar = al_completar
+        self.opciones = dict(OPCIONES_WEBHOOK)
+        self.opciones.update(config.get('webhook', {}))
+        self.opciones.update({clave: valor for clave, valor in opciones.items() if valor is not None})
+        self.cola = ColaCertificacion()
+        self.detenido = threading.Event()
+        self.hilos = []
+        self.servidor = None
+        self.lock = threading.Lock()
+        self.contadores = {'recibidos': 0, 'exitosas': 0, 'fallidas': 0, 'omitidas': 0}
+        self.demoras = []
+
+    @property
+    def url(self):
+        host, puerto = self.servidor.server_address[:2]
+        return f"http://{host}:{puerto}{self.opciones['ruta']}"
+
+    def autorizado(self, headers, query):
+        token = str(self.opciones['token'] or '')
+        if not token:
+            return True
+        recibido = headers.get('X-Webhook-Token') or query.get('token', [''])[0]
+        return hmac.compare_digest(recibido.encode(), token.encode())
+
+    def recibir(self, cuerpo, tipo):
+        """Interpreta el cuerpo del webhook (JSON o formulario con JSONString) y encola sus facturas"""
+        if 'application/x-www-form-urlencoded' in tipo:
+            campos = {clave: valores[0] for clave, valores in parse_qs(cuerpo.decode('utf-8')).items()}
+            datos = json.loads(campos['JSONString']) if 'JSONString' in campos else campos
+        else:
+            datos = json.loads(cuerpo or b'{}')
+        ids = invoice_ids_webhook(datos)
+        with self.lock:
+            self.contadores['recibidos'] += 1
+        return [invoice_id for invoice_id in ids if self.cola.agregar(invoice_id)]
+
+    def estado(self):
+        with self.lock:
+            estado = dict(self.contadores)
+            demoras = list(self.demoras)
+        estado['en_cola'] = len(self.cola)
+        estado['demora_p50'] = round(percentil(demoras, 50), 3)
+        estado['demora_p95'] = round(percentil(demoras, 95), 3)
+        return estado
+
+    def crear_manejador(self):
+        servicio = self
+
+        class ManejadorWebhook(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, formato, *args):
+                pass
+
+            def responder(self, codigo, datos):
+                cuerpo = json.dumps(datos).encode('utf-8')
+                self.send_response(codigo)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def do_GET(self):
+                if urlsplit(self.path).path != servicio.opciones['ruta']:
+                    return self.responder(404, {'error': 'Ruta no encontrada'})
+                self.responder(200, servicio.estado())
+
+            def do_POST(self):
+                partes = urlsplit(self.path)
+                cuerpo = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+                if partes.path != servicio.opciones['ruta']:
+                    return self.responder(404, {'error': 'Ruta no encontrada'})
+                if not servicio.autorizado(self.headers, parse_qs(partes.query)):
+                    return self.responder(401, {'error': 'Token invalido'})
+                try:
+                    encoladas = servicio.recibir(cuerpo, self.headers.get('Content-Type', ''))
+                except (ValueError, KeyError) as e:
+                    return self.responder(400, {'error': f"Cuerpo no valido: {e}"})
+                self.responder(202, {'encoladas': encoladas})
+
+        return ManejadorWebhook
+
+    def procesar(self, invoice_id, factura, encolada):
+        """Certifica una factura de la cola y escribe su salida en la consola de una sola vez"""
+        with capturar_salida(io.StringIO()) as buffer:
+            try:
+                clave, registro = self.certificar(invoice_id, factura)
+            except Exception as e:
+                numero = (factura or {}).get('invoice_number', invoice_id)
+                clave, registro = 'fallidas', {'numero': numero, 'error': str(e)}
+        demora = time.monotonic() - encolada
+        with self.lock:
+            self.contadores[clave] += 1
+            if clave == 'exitosas':
+                self.demoras.append(demora)
+        marca = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if clave == 'omitidas':
+            escribir_consola(f"[{marca}] {registro['numero']} omitida: {registro['error']}\n")
+        else:
+            escribir_consola(buffer.getvalue())
+            detalle = f"UUID {registro.get('uuid')}" if clave == 'exitosas' else registro.get('error', '')
+            escribir_consola(f"[{marca}] {registro.get('numero', invoice_id)} {'certificada' if clave == 'exitosas' else 'fallida'} en {demora:.1f}s: {detalle}\n")
+        if self.al_completar:
+            self.al_completar(invoice_id, clave, registro)
+
+    def iniciar(self):
+        host = self.opciones['host']
+        if not self.opciones['token']:
+            if not es_loopback(host):
+                raise ValueError(f"Sin webhook.token en config.json el servicio solo puede escuchar en 127.0.0.1, no en '{host}'")
+            print("*" * 70)
+            print("AVISO: webhook SIN TOKEN. Cualquier programa de este equipo puede pedir certificaciones en SAT.")
+            print("Configure webhook.token en config.json.")
+            print("*" * 70)
+        self.servidor = ThreadingHTTPServer((host, int(self.opciones['puerto'])), self.crear_manejador())
+        self.servidor.daemon_threads = True
+        hilo = threading.Thread(target=self.servidor.serve_forever, name='webhook-http', daemon=True)
+        hilo.start()
+        self.hilos.append(hilo)
+
+        def trabajar():
+            while not self.detenido.is_set():
+                elemento = self.cola.tomar()
+                if elemento is None:
+                    continue
+                try:
+                    self.procesar(*elemento)
+                finally:
+                    self.cola.terminar(elemento[0])
+
+        for i in range(max(1, int(self.opciones['trabajadores']))):
+            hilo = threading.Thread(target=trabajar, name=f'webhook-{i + 1}', daemon=True)
+            hilo.start()
+            self.hilos.append(hilo)
+        return self
+
+    def detener(self):
+        """Deja de aceptar webhooks y espera a que los trabajadores terminen la factura en curso"""
+        self.detenido.set()
+        if self.servidor:
+            self.servidor.shutdown()
+            self.servidor.server_close()
+        for hilo in self.hilos:
+            hilo.join()
+        self.hilos = []